@@ -0,0 +1,162 @@
+"""
+Reading of EEGLAB data sets without loading their data into memory.
+- read_header: the fields of a .set file except the data
+- open_data: the float32 data of a .fdt file as read-only numpy.memmap
+- read_dataset: the header and the data of a data set, like pop_loadset
+
+EEGLAB saves the data in a .fdt file (or in the .set file, if it is saved as
+one file) as float32 in MATLAB's column order: all channels of the first
+sample, then all channels of the second sample and so on, and for epoched
+data the trials one after the other. The memmap has the same order
+(order='F'), thus an epoch or a trial is one contiguous block of the file
+and only the pages that are indexed are read. Opening a data set reads the
+header only, which takes milliseconds independent of the size of the data.
+
+Data saved inside the .set file cannot be mapped and is loaded, as are the
+HDF5 based .set files of MATLAB 7.3, which are not supported.
+
+The headers are MATLAB files, thus scipy is needed to read them.
+"""
+
+import os
+import numpy as np
+
+try:
+    from scipy import io as scipy_io # reads the MATLAB files of EEGLAB
+except ImportError:
+    scipy_io = None
+
+DATA_TYPE = '<f4'
+# Type of the samples in a .fdt file (float32, little endian)
+
+
+def _event_type(value):
+    """Returns an event type as the string pop_epoch compares, e.g. 1.0 -> '1'."""
+    if isinstance(value, str):
+        return value.strip()
+    value = np.asarray(value).item() if np.size(value) == 1 else value
+    if isinstance(value, (int, float, np.integer, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _load_fields(file_name, with_data):
+    """
+    Returns a function that returns a field of the EEG struct of a .set file.
+
+    Older EEGLAB versions save one variable EEG, newer ones every field of it
+    as a variable, whose data is skipped unless with_data is True.
+    """
+    if scipy_io is None:
+        raise ImportError('scipy is needed to read .set files')
+    try:
+        variables = {name: matlab_class for name, _, matlab_class in scipy_io.whosmat(file_name)}
+    except NotImplementedError:
+        raise NotImplementedError('%s is a MATLAB 7.3 file, save it with pop_saveset in the MATLAB 7 format'
+                                  % file_name)
+    if 'EEG' in variables:
+        header = scipy_io.loadmat(file_name, squeeze_me=True, struct_as_record=False, variable_names=['EEG'])['EEG']
+        return lambda name: getattr(header, name)
+    names = [name for name in variables
+             if name != 'data' or with_data or variables['data'] == 'char']
+    header = scipy_io.loadmat(file_name, squeeze_me=True, struct_as_record=False, variable_names=names)
+    return lambda name: header[name]
+
+
+def read_header(file_name):
+    """
+    Reads the header of an EEGLAB data set.
+
+    Parameters
+    ----------
+    file_name : str
+        The .set file.
+
+    Returns
+    -------
+    dict
+        'shape' (channels x samples, or channels x times x trials for epoched
+        data), 'srate', 'xmin' (start of an epoch in seconds), 'labels' (channel
+        labels), 'event_types' (str array), 'event_latencies' (samples, 1-based
+        like EEGLAB), 'data_file' (the .fdt file, None if the data is inside the
+        .set file) and 'name' (file name without extension).
+
+    Exception
+    ---------
+    Raises an ImportError without scipy and a NotImplementedError for the
+    HDF5 based .set files of MATLAB 7.3.
+    """
+    field = _load_fields(file_name, with_data=False)
+    n_channels, n_points, n_trials = int(field('nbchan')), int(field('pnts')), int(field('trials'))
+    try:
+        data = field('data')
+    except (AttributeError, KeyError):
+        data = None
+    data_file = os.path.join(os.path.dirname(file_name), data) if isinstance(data, str) else None
+
+    events = np.atleast_1d(field('event'))
+    chanlocs = np.atleast_1d(field('chanlocs'))
+    return {'shape': (n_channels, n_points, n_trials) if n_trials > 1 else (n_channels, n_points),
+            'srate': float(field('srate')),
+            'xmin': float(field('xmin')),
+            'labels': [str(channel.labels) for channel in chanlocs],
+            'event_types': np.array([_event_type(event.type) for event in events], dtype=str),
+            'event_latencies': np.array([float(event.latency) for event in events]),
+            'data_file': data_file,
+            'name': os.path.splitext(os.path.basename(file_name))[0]}
+
+
+def open_data(data_file, shape, mode='r'):
+    """
+    Maps the data of a .fdt file.
+
+    Parameters
+    ----------
+    data_file : str
+        The .fdt file.
+    shape : tuple
+        channels x samples, or channels x times x trials.
+    mode : str
+        The mode of numpy.memmap, 'r' for read-only, 'c' for copy-on-write.
+
+    Returns
+    -------
+    numpy.memmap
+        The data, float32 in the given shape.
+
+    Exception
+    ---------
+    Raises a ValueError if the size of the file does not match the shape.
+    """
+    expected = int(np.prod(shape)) * np.dtype(DATA_TYPE).itemsize
+    size = os.path.getsize(data_file)
+    if size != expected:
+        raise ValueError('%s has %i bytes, %s float32 samples need %i' % (data_file, size, 'x'.join(map(str, shape)),
+                                                                         expected))
+    return np.memmap(data_file, dtype=DATA_TYPE, mode=mode, shape=tuple(shape), order='F')
+
+
+def read_dataset(file_name, mode='r'):
+    """
+    Reads an EEGLAB data set, the data mapped from its .fdt file.
+
+    Parameters
+    ----------
+    file_name : str
+        The .set file.
+    mode : str
+        The mode of the memmap, see open_data.
+
+    Returns
+    -------
+    dict
+        The header (see read_header) and 'data', a numpy.memmap, or an array if
+        the data is inside the .set file.
+    """
+    dataset = read_header(file_name)
+    if dataset['data_file'] is not None:
+        dataset['data'] = open_data(dataset['data_file'], dataset['shape'], mode)
+    else:
+        data = np.asarray(_load_fields(file_name, with_data=True)('data'))
+        dataset['data'] = data.reshape(dataset['shape'], order='F')
+    return dataset
@@ -0,0 +1,338 @@
+"""
+Epoching of the cleaned EEG data, the Python version of CleanDataAnalysis.m.
+
+Splits the continuous data of every participant into the epochs of the eight
+conditions (waist, wrist, ankle and visual, each oddball and standard) and
+removes the baseline:
+- event_index: the indices of the events of every trigger code, built once
+- epoch_conditions: cuts the epochs of all conditions in one pass
+- align_channels: fills the channels removed during cleaning with NaN rows,
+  such that all participants have the channels of the original recording
+- epoch_file: epochs one data set and saves the conditions in one .npz file
+- average_trials: the mean over the trials of epochs, mean(data, 3, 'omitnan')
+
+The epochs follow pop_epoch and pop_rmbase of EEGLAB: the window of
+[-0.2 0.8] s is rounded to samples like epoch.m, an epoch starts at the sample
+floor(latency) of its event, epochs that do not fit into the data or contain
+a boundary event are dropped, and the baseline is the mean of the samples of
+[-199 0] ms. compare_with_eeglab checks the result against epoch files saved
+by CleanDataAnalysis.m. The agreement has only been shown against a Python
+port of these functions (see epoching_benchmark.py), not against EEGLAB
+itself; run compare_with_eeglab on real epoch files before relying on it.
+
+Instead of one pop_epoch call per trigger code, which searches the event list
+and cuts the data again for every condition, the events are grouped by code
+once and the epochs of all conditions are taken from one strided view of the
+data with a single fancy index. The data sets are read with eeglab_io,
+which maps the .fdt files, thus only the samples of the epochs are read from
+the disk.
+
+Usage:
+    python epoching.py <directory of the cleaned .set files> <output directory> [<.set file of step 1>]
+The .set file of step 1 gives the original channel list, like pop_loadset() in
+CleanDataAnalysis.m; without it the channels of every data set are kept.
+"""
+
+import glob, os, sys
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import eeglab_io
+
+CONDITIONS = {'waist_odd': '1', 'waist_stand': '3',
+              'wrist_odd': '5', 'wrist_stand': '7',
+              'ankle_odd': '9', 'ankle_stand': '11',
+              'visual_odd': '14', 'visual_stand': '13'}
+# Trigger code of every condition. This is the legacy mapping of the first
+# study, taken from CleanDataAnalysis.m; it does not describe the trigger codes
+# of this follow-up (see Experiment_code/TriggerNumbers.md)
+
+EPOCH_WINDOW = (-0.2, 0.8)
+# Epoch limits in seconds relative to the trigger
+
+BASELINE_WINDOW = (-199, 0)
+# Baseline in milliseconds, None keeps the baseline
+
+EXCLUDED_CHANNELS = ('BIP2', 'BIP3', 'BIP4', 'AUX1', 'AUX2', 'AUX3', 'AUX4')
+# Channels of the recording that are not part of the original channel list
+
+BOUNDARY_TYPE = 'boundary'
+# Event type of the discontinuities EEGLAB inserts when data is removed
+
+AVERAGE_CHUNK_TRIALS = 64
+# Trials read at once by average_trials
+
+
+def matlab_round(values):
+    """Rounds halves away from zero like MATLAB's round (numpy rounds them to even)."""
+    values = np.asarray(values, dtype=np.float64)
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+def event_index(event_types):
+    """
+    Groups the events by type.
+
+    Parameters
+    ----------
+    event_types : array_like
+        The type of every event as string.
+
+    Returns
+    -------
+    dict
+        The indices of the events of every type, in the order of the events.
+    """
+    types, inverse = np.unique(np.asarray(event_types, dtype=str), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    ends = np.cumsum(np.bincount(inverse, minlength=len(types)))
+    starts = ends - np.bincount(inverse, minlength=len(types))
+    return {event_type: order[start:end] for event_type, start, end in zip(types, starts, ends)}
+
+
+def epoch_limits(window, srate):
+    """
+    Returns the first and the last sample of an epoch relative to its event,
+    rounded like epoch.m of EEGLAB, e.g. (-100, 399) for [-0.2 0.8] s at 500 Hz.
+    """
+    return int(matlab_round(window[0] * srate)), int(matlab_round(window[1] * srate - 1))
+
+
+def epoch_times(window, srate):
+    """Returns the times of the samples of an epoch in milliseconds (EEG.times)."""
+    first, last = epoch_limits(window, srate)
+    return np.arange(first, last + 1) / srate * 1000
+
+
+def baseline_points(baseline, window, srate):
+    """
+    Returns the first and the last sample (0-based, inclusive) of the
+    baseline within an epoch, rounded like pop_rmbase.
+    """
+    xmin = epoch_limits(window, srate)[0] / srate
+    first, last = matlab_round((np.asarray(baseline) / 1000 - xmin) * srate)
+    return max(int(first), 0), int(last)
+
+
+def epoch_conditions(data, event_types, event_latencies, srate, conditions=CONDITIONS,
+                     window=EPOCH_WINDOW, baseline=BASELINE_WINDOW, reject_boundaries=True):
+    """
+    Cuts the epochs of all conditions from continuous data.
+
+    Parameters
+    ----------
+    data : ndarray
+        The continuous data, channels x samples.
+    event_types : array_like
+        The type of every event as string.
+    event_latencies : array_like
+        The latency of every event in samples, 1-based like EEGLAB.
+    srate : float
+        The sampling rate in Hz.
+    conditions : dict
+        The event type of every condition.
+    window : tuple
+        The epoch limits in seconds.
+    baseline : tuple
+        The baseline in milliseconds, None keeps the baseline.
+    reject_boundaries : bool
+        Drops the epochs that contain a boundary event, like pop_epoch.
+
+    Returns
+    -------
+    epochs : dict
+        The epochs of every condition, channels x times x trials.
+    event_indices : dict
+        The index of the event of every epoch of every condition (0-based,
+        orig_indices in CleanDataAnalysis.m).
+    times : ndarray
+        The times of the samples of an epoch in milliseconds.
+    """
+    event_latencies = np.asarray(event_latencies, dtype=np.float64)
+    first, last = epoch_limits(window, srate)
+    n_times = last - first + 1
+    n_samples = data.shape[1]
+
+    # The events of all conditions, grouped by condition
+    index = event_index(event_types)
+    empty = np.zeros(0, dtype=np.int64)
+    selected = [index.get(event_type, empty) for event_type in conditions.values()]
+    events = np.concatenate(selected)
+    condition = np.repeat(np.arange(len(selected)), [len(s) for s in selected])
+
+    # Epochs within the data and, optionally, without boundary events
+    starts = np.floor(event_latencies[events]).astype(np.int64) + first # 1-based like epoch.m
+    ends = starts + n_times - 1
+    keep = (starts >= 1) & (ends <= n_samples)
+    if reject_boundaries and BOUNDARY_TYPE in index:
+        boundaries = np.sort(event_latencies[index[BOUNDARY_TYPE]])
+        keep &= np.searchsorted(boundaries, ends, 'right') == np.searchsorted(boundaries, starts, 'left')
+    events, condition, starts = events[keep], condition[keep], starts[keep]
+
+    # One fancy index into the windows of the data: channels x trials x times
+    trials = sliding_window_view(data, n_times, axis=1)[:, starts - 1]
+    if baseline is not None:
+        base_first, base_last = baseline_points(baseline, window, srate)
+        trials -= trials[:, :, base_first:base_last + 1].mean(axis=2, dtype=np.float64,
+                                                              keepdims=True).astype(trials.dtype)
+    trials = trials.transpose(0, 2, 1)
+
+    bounds = np.searchsorted(condition, np.arange(len(selected) + 1))
+    epochs, event_indices = {}, {}
+    for i, name in enumerate(conditions):
+        epochs[name] = trials[:, :, bounds[i]:bounds[i + 1]]
+        event_indices[name] = events[bounds[i]:bounds[i + 1]]
+    return epochs, event_indices, epoch_times(window, srate)
+
+
+def align_channels(data, labels, original_labels):
+    """
+    Arranges the data in the original channel order, with NaN rows for the
+    channels that were removed.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data, channels x samples or channels x times x trials.
+    labels : list
+        The labels of the channels of the data.
+    original_labels : list
+        The labels of the original channels.
+
+    Returns
+    -------
+    ndarray
+        The data with the original channels as rows.
+    """
+    aligned = np.full((len(original_labels),) + data.shape[1:], np.nan, dtype=data.dtype)
+    rows = {label: row for row, label in enumerate(labels)}
+    present = [i for i, label in enumerate(original_labels) if label in rows]
+    aligned[present] = data[[rows[original_labels[i]] for i in present]]
+    return aligned
+
+
+def original_channels(file_name):
+    """Returns the channel labels of a step 1 data set without EXCLUDED_CHANNELS."""
+    return [label for label in eeglab_io.read_header(file_name)['labels'] if label not in EXCLUDED_CHANNELS]
+
+
+def epoch_file(file_name, output_directory, original_labels=None, conditions=CONDITIONS,
+               window=EPOCH_WINDOW, baseline=BASELINE_WINDOW):
+    """
+    Epochs one cleaned data set and saves the epochs of all conditions in
+    <output_directory>/<name>_epochs.npz with the arrays '<condition>' (channels
+    x times x trials), '<condition>_indices' (event indices), 'times', 'srate'
+    and 'labels'.
+
+    Parameters
+    ----------
+    file_name : str
+        The .set file.
+    output_directory : str
+        The directory of the .npz file.
+    original_labels : list
+        The original channel labels, None keeps the channels of the data set.
+
+    Returns
+    -------
+    str
+        The name of the .npz file.
+
+    Exception
+    ---------
+    Raises a ValueError if the data set is already epoched.
+    """
+    dataset = eeglab_io.read_dataset(file_name)
+    labels = dataset['labels']
+    if dataset['data'].ndim != 2:
+        raise ValueError('%s is already epoched' % file_name)
+    epochs, event_indices, times = epoch_conditions(dataset['data'], dataset['event_types'],
+                                                    dataset['event_latencies'], dataset['srate'],
+                                                    conditions, window, baseline)
+    # Aligned after epoching, such that only the epochs are read from the mapped data
+    if original_labels is not None:
+        epochs = {condition: align_channels(epochs[condition], labels, original_labels) for condition in epochs}
+        labels = list(original_labels)
+
+    os.makedirs(output_directory, exist_ok=True)
+    output_file_name = os.path.join(output_directory, '%s_epochs.npz' % dataset['name'])
+    arrays = {'times': times, 'srate': dataset['srate'], 'labels': np.array(labels, dtype=str)}
+    for condition in conditions:
+        arrays[condition] = epochs[condition]
+        arrays[condition + '_indices'] = event_indices[condition]
+    np.savez(output_file_name, **arrays)
+    return output_file_name
+
+
+def average_trials(epochs, chunk_trials=AVERAGE_CHUNK_TRIALS):
+    """
+    Averages epochs over the trials ignoring NaN, like mean(data, 3, 'omitnan')
+    in CleanedDataAnalysis_Averaging.m.
+
+    The trials are read in chunks, thus epochs mapped with eeglab_io are never
+    loaded at once.
+
+    Parameters
+    ----------
+    epochs : ndarray
+        The epochs, channels x times x trials.
+    chunk_trials : int
+        The number of trials read at once.
+
+    Returns
+    -------
+    ndarray
+        The average, channels x times, NaN where no trial has a value.
+    """
+    total = np.zeros(epochs.shape[:2])
+    count = np.zeros(epochs.shape[:2])
+    for start in range(0, epochs.shape[2], chunk_trials):
+        chunk = np.asarray(epochs[:, :, start:start + chunk_trials], dtype=np.float64)
+        valid = ~np.isnan(chunk)
+        total += np.where(valid, chunk, 0).sum(axis=2)
+        count += valid.sum(axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+def compare_with_eeglab(epochs, eeglab_file_name):
+    """
+    Compares epochs with an epoch file of EEGLAB, e.g. <name>_cleaned_waist_odd.set.
+
+    Returns
+    -------
+    float
+        The largest absolute difference, NaN channels excluded, or inf if the
+        shapes differ.
+    """
+    reference = eeglab_io.read_dataset(eeglab_file_name)['data']
+    if reference.ndim == 2:
+        reference = reference[:, :, None]
+    if reference.shape != epochs.shape:
+        return np.inf
+    difference = np.abs(np.asarray(reference, dtype=np.float64) - epochs)
+    return float(np.nanmax(difference)) if np.isfinite(difference).any() else 0.0
+
+
+def main():
+    """Epochs all cleaned data sets of a directory and prints the number of epochs per condition."""
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return
+    data_directory, output_directory = sys.argv[1], sys.argv[2]
+    original_labels = original_channels(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    print('%-40s' % 'data set' + ''.join('%13s' % condition for condition in CONDITIONS))
+    for file_name in sorted(glob.glob(os.path.join(data_directory, '**', '*.set'), recursive=True)):
+        try:
+            output_file_name = epoch_file(file_name, output_directory, original_labels)
+        except ValueError as e:
+            print('%-40s skipped: %s' % (os.path.basename(file_name), e))
+            continue
+        with np.load(output_file_name) as epochs:
+            print('%-40s' % os.path.basename(file_name)
+                  + ''.join('%13i' % len(epochs[condition + '_indices']) for condition in CONDITIONS))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark of the epoching (see epoching.py) against the procedure of
+CleanDataAnalysis.m.
+
+Creates a continuous data set like one session (64 channels at 500 Hz, the
+triggers of the eight conditions about once per second, a few boundary
+events) and epochs it twice:
+- per code: the steps of CleanDataAnalysis.m, one pop_epoch per trigger code
+  that searches the event list and copies the epochs one by one (epoch.m),
+  followed by one pop_rmbase per condition
+- one pass: epoching.epoch_conditions
+and prints the times and the largest difference between the epochs.
+
+Usage:
+    python epoching_benchmark.py [<minutes of data>] [<repetitions>]
+"""
+
+import os, sys, time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import epoching
+
+N_CHANNELS = 64
+# Channels of the simulated data set
+
+SRATE = 500.0
+# Sampling rate of the simulated data set in Hz
+
+TRIGGER_INTERVAL = (0.8, 1.2)
+# Range of the intervals between two triggers in seconds
+
+N_BOUNDARIES = 5
+# Boundary events in the simulated data set
+
+
+def simulated_dataset(minutes=40, seed=0):
+    """
+    Returns a continuous data set with the triggers of all conditions.
+
+    Returns
+    -------
+    dict
+        'data', 'srate', 'event_types' and 'event_latencies' like eeglab_io.read_dataset.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(minutes * 60 * SRATE)
+    data = rng.standard_normal((N_CHANNELS, n_samples), dtype=np.float32)
+
+    intervals = rng.uniform(*TRIGGER_INTERVAL, size=int(minutes * 60 / TRIGGER_INTERVAL[0]))
+    latencies = 1 + np.cumsum(intervals) * SRATE
+    latencies = latencies[latencies < n_samples]
+    codes = list(epoching.CONDITIONS.values()) + ['2', '4']  # with break triggers of no condition
+    types = rng.choice(codes, size=len(latencies))
+    boundaries = np.sort(rng.uniform(1, n_samples, N_BOUNDARIES)).round() + 0.5
+    order = np.argsort(np.concatenate((latencies, boundaries)), kind='stable')
+    return {'data': data,
+            'srate': SRATE,
+            'event_types': np.concatenate((types, [epoching.BOUNDARY_TYPE] * N_BOUNDARIES))[order],
+            'event_latencies': np.concatenate((latencies, boundaries))[order]}
+
+
+def epoch_per_code(data, event_types, event_latencies, srate, conditions=epoching.CONDITIONS,
+                   window=epoching.EPOCH_WINDOW, baseline=epoching.BASELINE_WINDOW):
+    """
+    Epochs the data like CleanDataAnalysis.m: one pass over the events and
+    one copy per epoch for every condition, then the baseline per condition.
+
+    Returns
+    -------
+    epochs : dict
+        The epochs of every condition, channels x times x trials.
+    event_indices : dict
+        The index of the event of every epoch of every condition.
+    """
+    first, last = epoching.epoch_limits(window, srate)
+    boundaries = [latency for event_type, latency in zip(event_types, event_latencies)
+                  if event_type == epoching.BOUNDARY_TYPE]
+    epochs, event_indices = {}, {}
+    for name, code in conditions.items():
+        # pop_epoch: find the events of the code
+        selected = [i for i, event_type in enumerate(event_types) if event_type == code]
+        # epoch.m: copy the epochs that fit into the data
+        trials, indices = [], []
+        for i in selected:
+            start = int(np.floor(event_latencies[i])) + first
+            end = int(np.floor(event_latencies[i])) + last
+            if start < 1 or end > data.shape[1]:
+                continue
+            if any(start <= boundary <= end for boundary in boundaries):
+                continue
+            trials.append(data[:, start - 1:end].copy())
+            indices.append(i)
+        condition_epochs = np.stack(trials, axis=2)
+        # pop_rmbase
+        if baseline is not None:
+            base_first, base_last = epoching.baseline_points(baseline, window, srate)
+            condition_epochs -= condition_epochs[:, base_first:base_last + 1, :].mean(
+                axis=1, dtype=np.float64, keepdims=True).astype(condition_epochs.dtype)
+        epochs[name] = condition_epochs
+        event_indices[name] = np.array(indices)
+    return epochs, event_indices
+
+
+def _best_time(function, repetitions):
+    """Returns the result and the shortest time of some calls of a function."""
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    """Prints the times of both procedures and the largest difference of their epochs."""
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 40
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    dataset = simulated_dataset(minutes)
+    arguments = (dataset['data'], dataset['event_types'], dataset['event_latencies'], dataset['srate'])
+
+    (reference, reference_indices), per_code_time = _best_time(lambda: epoch_per_code(*arguments), repetitions)
+    (epochs, event_indices, times), one_pass_time = _best_time(lambda: epoching.epoch_conditions(*arguments),
+                                                               repetitions)
+
+    print('%i channels, %.0f min at %.0f Hz, %i events' % (N_CHANNELS, minutes, SRATE, len(arguments[1])))
+    print('%-14s %7s %16s %13s' % ('condition', 'epochs', 'same events', 'max diff'))
+    for condition in epoching.CONDITIONS:
+        print('%-14s %7i %16s %13.2e' % (condition, epochs[condition].shape[2],
+                                          np.array_equal(event_indices[condition], reference_indices[condition]),
+                                          np.max(np.abs(epochs[condition] - reference[condition]))))
+    print('per code: %8.1f ms' % (per_code_time * 1000))
+    print('one pass: %8.1f ms (%.1fx)' % (one_pass_time * 1000, per_code_time / one_pass_time))
+
+if __name__ == "__main__":
+    main()
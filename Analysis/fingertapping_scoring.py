@@ -0,0 +1,192 @@
+"""
+Scoring of the fingertapping task.
+
+Loads the fingertapping data of all participants from the fingertapping store
+(see Experiment_code/fingertapping_store.py) and computes for every participant
+and round:
+- the number of correctly completed sequences
+- the error rate (share of key presses that are not part of a correct sequence)
+- mean and coefficient of variation of the inter-tap intervals
+and the learning curves (correct sequences per round) across participants.
+
+All computations work on the whole data set at once with numpy, there is no
+loop over key presses, rounds or participants.
+
+Usage:
+    python fingertapping_scoring.py ../Experiment_code/Fingertapping_Data_followUp/store
+"""
+
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Experiment_code'))
+import fingertapping_store
+
+SEQUENCE_LENGTH = 5
+# Number of key presses in one sequence, e.g. 2-3-1-4-2
+
+
+def load_tapping_data(store_directory):
+    """
+    Loads the key presses of all participants and rounds.
+
+    Parameters
+    ----------
+    store_directory : str
+        The directory of the fingertapping store.
+
+    Returns
+    -------
+    dict
+        One array per column of the store ('key', 'time', 'round', 'sequence',
+        'participant').
+    """
+    return fingertapping_store.FingertappingStore(store_directory).load()
+
+
+def sequence_digits(sequence_codes):
+    """
+    Splits sequence codes like 23142 into their digits.
+
+    Parameters
+    ----------
+    sequence_codes : array_like
+        The sequence codes, one per key press.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n, SEQUENCE_LENGTH) with the expected keys.
+    """
+    powers = 10 ** np.arange(SEQUENCE_LENGTH - 1, -1, -1)
+    return (np.asarray(sequence_codes, dtype=np.int64)[:, None] // powers) % 10
+
+
+def score_taps(data):
+    """
+    Scores every round of every participant.
+
+    A correct sequence is a run of five consecutive key presses that equals the
+    sequence shown on the screen. As the first digit of the sequence is
+    repeated at its end, two matches can share one key press (when the sequence
+    is typed cyclically); such matches are counted like non-overlapping ones,
+    i.e. a chain of L matches four key presses apart counts ceil(L/2) times.
+
+    Parameters
+    ----------
+    data : dict
+        The columns as returned by ``load_tapping_data``.
+
+    Returns
+    -------
+    dict
+        Arrays with one entry per participant and round: 'participant',
+        'round', 'taps', 'correct_sequences', 'error_rate', 'iti_mean' and
+        'iti_cv' (intervals in seconds).
+    """
+    participant = np.asarray(data['participant'], dtype=np.int64)
+    ft_round = np.asarray(data['round'], dtype=np.int64)
+
+    # Sort by participant, round and time and number the rounds
+    order = np.lexsort((data['time'], ft_round, participant))
+    participant = participant[order]
+    ft_round = ft_round[order]
+    keys = np.asarray(data['key'], dtype=np.int64)[order]
+    times = np.asarray(data['time'], dtype=np.float64)[order]
+    sequences = np.asarray(data['sequence'])[order]
+
+    group_keys, group = np.unique(participant * 256 + ft_round, return_inverse=True)
+    n_groups = len(group_keys)
+    taps = np.bincount(group, minlength=n_groups)
+
+    # Windows of five key presses within one round that equal the sequence
+    n_windows = max(len(keys) - SEQUENCE_LENGTH + 1, 0)
+    expected = sequence_digits(sequences[:n_windows])
+    match = group[:n_windows] == group[SEQUENCE_LENGTH - 1:SEQUENCE_LENGTH - 1 + n_windows]
+    for k in range(SEQUENCE_LENGTH):
+        match &= keys[k:k + n_windows] == expected[:, k]
+    match_positions = np.flatnonzero(match)
+
+    # Chains of matches that share their first/last key press
+    chain_start = np.ones(len(match_positions), dtype=bool)
+    chain_start[1:] = ((np.diff(match_positions) != SEQUENCE_LENGTH - 1) |
+                       (group[match_positions[1:]] != group[match_positions[:-1]]))
+    chain = np.cumsum(chain_start) - 1
+    chain_length = np.bincount(chain)
+    chain_group = group[match_positions[chain_start]]
+    correct_sequences = np.bincount(chain_group, weights=(chain_length + 1) // 2,
+                                    minlength=n_groups).astype(np.int64)
+
+    error_rate = np.full(n_groups, np.nan)
+    has_taps = taps > 0
+    error_rate[has_taps] = 1 - np.minimum(correct_sequences[has_taps] * SEQUENCE_LENGTH,
+                                          taps[has_taps]) / taps[has_taps]
+
+    # Inter-tap intervals within a round
+    same_round = group[1:] == group[:-1]
+    iti = np.diff(times)[same_round]
+    iti_group = group[1:][same_round]
+    n_iti = np.bincount(iti_group, minlength=n_groups)
+    iti_sum = np.bincount(iti_group, weights=iti, minlength=n_groups)
+    iti_sum_squares = np.bincount(iti_group, weights=iti ** 2, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        iti_mean = iti_sum / n_iti
+        iti_std = np.sqrt(np.maximum(iti_sum_squares / n_iti - iti_mean ** 2, 0))
+        iti_cv = iti_std / iti_mean
+
+    return {'participant': group_keys // 256,
+            'round': group_keys % 256,
+            'taps': taps,
+            'correct_sequences': correct_sequences,
+            'error_rate': error_rate,
+            'iti_mean': iti_mean,
+            'iti_cv': iti_cv}
+
+
+def learning_curves(scores, measure='correct_sequences'):
+    """
+    Arranges a score as participants x rounds.
+
+    Parameters
+    ----------
+    scores : dict
+        The scores as returned by ``score_taps``.
+    measure : str
+        The score to arrange, e.g. 'correct_sequences' or 'iti_mean'.
+
+    Returns
+    -------
+    participants : ndarray
+        The participant IDs (rows).
+    rounds : ndarray
+        The fingertapping rounds (columns).
+    curves : ndarray
+        The score per participant and round, NaN for missing rounds.
+    """
+    participants, row = np.unique(scores['participant'], return_inverse=True)
+    rounds, column = np.unique(scores['round'], return_inverse=True)
+    curves = np.full((len(participants), len(rounds)), np.nan)
+    curves[row, column] = scores[measure]
+    return participants, rounds, curves
+
+
+def main():
+    """Prints the scores and the mean learning curve of a fingertapping store."""
+    store_directory = (sys.argv[1] if len(sys.argv) > 1 else
+                       os.path.join('..', 'Experiment_code', 'Fingertapping_Data_followUp', 'store'))
+    scores = score_taps(load_tapping_data(store_directory))
+
+    print('participant  round  taps  correct  error rate  ITI mean (ms)  ITI CV')
+    for i in range(len(scores['participant'])):
+        print('%11i  %5i  %4i  %7i  %10.3f  %13.1f  %6.3f'
+              % (scores['participant'][i], scores['round'][i], scores['taps'][i],
+                 scores['correct_sequences'][i], scores['error_rate'][i],
+                 scores['iti_mean'][i] * 1000, scores['iti_cv'][i]))
+
+    participants, rounds, curves = learning_curves(scores)
+    print('\nMean correct sequences per round (%i participants):' % len(participants))
+    for ft_round, mean in zip(rounds, np.nanmean(curves, axis=0)):
+        print('round %i: %.2f' % (ft_round, mean))
+
+if __name__ == "__main__":
+    main()
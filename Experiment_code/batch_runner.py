@@ -0,0 +1,179 @@
+"""
+Runs many sessions of the Experiment in parallel worker processes.
+- session_settings: the settings of the session of one participant
+- run_session: runs one session in a worker and summarises it
+- run_batch: runs the sessions of a range of participant IDs in a process pool
+- print_report: prints one line per session
+
+Every session runs in a fresh worker process, which gets its settings as
+EEGTACTILE_* environment variables (see config.py) before it imports the
+experiment. Thus every session has its own participant ID, seed, output
+directory and session log, and no session asks for input.
+
+A session runs either simulated, on the virtual clock of simulation.py, or
+headless, on the real clock with the same fake window, belt and participant,
+such that it takes as long as the real session.
+
+The seed of a session is its participant ID, like in the experiment. With
+--random_seed=N the sessions use the seeds N + participant ID instead.
+
+Usage:
+    python batch_runner.py [first ID] [last ID] [processes] [simulated|headless] [output directory] [--name=value ...]
+"""
+
+import multiprocessing, os, sys, time, traceback
+import config, console
+
+OUTPUT_DIRECTORY = 'Batch_Data'
+# Directory that receives one sub-directory per session
+
+MODES = ('simulated', 'headless')
+# The modes of the sessions, see the module docstring
+
+
+def session_settings(participant_ID, output_directory, overrides=None):
+    """
+    Returns the settings of the session of a participant.
+
+    Parameters
+    ----------
+    participant_ID : int
+        The ID of the participant.
+    output_directory : str
+        The directory of the batch. The session writes to its sub-directory
+        participant_<ID>.
+    overrides : dict
+        Settings that apply to all sessions. random_seed is the base of the
+        seeds of the sessions.
+
+    Returns
+    -------
+    dict
+        The settings that differ from the configuration of the batch.
+    """
+    settings = dict(overrides or {})
+    if settings.get('random_seed') is not None:
+        settings['random_seed'] = settings['random_seed'] + participant_ID
+    settings['participant_ID'] = participant_ID
+    settings['output_directory'] = os.path.join(output_directory, 'participant_%i' % participant_ID)
+    return settings
+
+
+def run_session(task):
+    """
+    Runs one session in a worker process. The worker must not have imported
+    the experiment yet, see run_batch.
+
+    Parameters
+    ----------
+    task : tuple
+        The settings of the session (see session_settings) and its mode.
+
+    Returns
+    -------
+    dict
+        'participant_ID', 'seed', 'blocks', 'duration' (session time),
+        'wall_time', 'events', 'taps', the trigger comparison of
+        simulation.compare_triggers and 'error' (None or the traceback).
+    """
+    settings, mode = task
+    os.environ.update(config.environment_overrides(settings))
+    # A spawned worker gets the arguments of the batch, whose --name=value
+    # overrides would beat the settings of the session in parameter.py
+    sys.argv = sys.argv[:1]
+    summary = {'participant_ID': settings['participant_ID'], 'error': None}
+    start = time.perf_counter()
+    try:
+        import parameter, session_timeline, simulation, trial_sequences
+        run = simulation.ExperimentSimulation(parameter.participant_ID, parameter.output_directory,
+                                              realtime=(mode == 'headless'))
+        events = run.run()
+        seed, block_names, sequences = trial_sequences.load_session(run.session_file_name)
+        planned = session_timeline.compile_session(
+            block_names, sequences, parameter, run.frame_rate if parameter.frame_locked else None)
+        summary.update(simulation.compare_triggers(events, planned, run.participant.response_time))
+        summary.update({'seed': seed, 'blocks': block_names, 'duration': run.duration, 'events': len(events),
+                        'taps': sum(event.kind == simulation.KEY_PRESS for event in events)})
+    except Exception:
+        summary['error'] = traceback.format_exc()
+    summary['wall_time'] = time.perf_counter() - start
+    # Pool workers exit without running atexit, thus the console is written here
+    console.flush()
+    return summary
+
+
+def run_batch(participant_IDs, output_directory=OUTPUT_DIRECTORY, mode='simulated', processes=None,
+              overrides=None):
+    """
+    Runs the sessions of the given participants in a pool of worker processes.
+
+    The workers are spawned, not forked, and run one session each, such that
+    no session inherits the imported parameter module of another.
+
+    Parameters
+    ----------
+    participant_IDs : list
+        The IDs of the participants.
+    output_directory : str
+        The directory that receives one sub-directory per session.
+    mode : str
+        'simulated' or 'headless', see the module docstring.
+    processes : int
+        The number of worker processes, None for one per CPU.
+    overrides : dict
+        Settings that apply to all sessions.
+
+    Returns
+    -------
+    list
+        The summaries of run_session, sorted by participant ID.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown mode %r, use one of %s' % (mode, ', '.join(MODES)))
+    overrides = dict(overrides or {})
+    # Validate the settings once, before any worker starts
+    config.load_config(overrides=dict(overrides, participant_ID=min(participant_IDs)))
+    tasks = [(session_settings(participant_ID, output_directory, overrides), mode)
+             for participant_ID in participant_IDs]
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, maxtasksperchild=1) as pool:
+        summaries = list(pool.imap_unordered(run_session, tasks))
+    return sorted(summaries, key=lambda summary: summary['participant_ID'])
+
+
+def print_report(summaries):
+    """Prints one line per session and the failed sessions with their traceback."""
+    print('%5s %6s %10s %8s %7s %6s %9s %12s %12s' % ('ID', 'seed', 'duration', 'wall', 'events', 'taps',
+                                                      'triggers', 'mismatches', 'max dev ms'))
+    for summary in summaries:
+        if summary['error'] is not None:
+            print('%5i failed after %.1f s' % (summary['participant_ID'], summary['wall_time']))
+            continue
+        print('%5i %6i %9.1fs %7.1fs %7i %6i %9i %12i %12.3f'
+              % (summary['participant_ID'], summary['seed'], summary['duration'], summary['wall_time'],
+                 summary['events'], summary['taps'], summary['triggers'], summary['mismatches'],
+                 summary['max_deviation'] * 1000))
+    for summary in summaries:
+        if summary['error'] is not None:
+            print('\nParticipant %i:\n%s' % (summary['participant_ID'], summary['error']))
+
+
+def main():
+    """Runs the sessions of the participant IDs given on the command line."""
+    overrides = config.parse_overrides(sys.argv[1:])
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    first_ID = int(arguments[0]) if len(arguments) > 0 else 1
+    last_ID = int(arguments[1]) if len(arguments) > 1 else first_ID + 11
+    processes = int(arguments[2]) if len(arguments) > 2 else None
+    mode = arguments[3] if len(arguments) > 3 else 'simulated'
+    output_directory = arguments[4] if len(arguments) > 4 else OUTPUT_DIRECTORY
+
+    start = time.perf_counter()
+    summaries = run_batch(range(first_ID, last_ID + 1), output_directory, mode, processes, overrides)
+    print_report(summaries)
+    print('%i sessions (%i failed) in %.1f s' % (len(summaries), sum(s['error'] is not None for s in summaries),
+                                                 time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmarks for the parts of the experiment that can run without belt, screen or participant.
+- benchmark_sequences: generation time of the block sequences
+- benchmark_scheduler: drift of relative waits and of the DeadlineScheduler over a block
+- benchmark_telemetry: cost of publishing a trial on the stimulus thread
+- benchmark_console: cost of a console line on the stimulus thread with a slow console
+- benchmark_realtime: jitter of the trial onsets with and without the real-time mode
+
+Usage:
+    python benchmark.py
+"""
+
+import gc, os, time
+import numpy as np
+import trial_sequences
+import scheduler
+import telemetry
+import console
+import realtime
+
+
+def time_call(function, repetitions):
+    """Returns the mean duration of ``function()`` in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions * 1000
+
+
+def benchmark_sequences(trial_counts=(200, 2000, 20000), oddball_ratio=0.3, max_oddball_run=1,
+                        min_standards_after=1, repetitions=100):
+    """
+    Prints the time needed to generate one block sequence, with and without
+    constraints, for different numbers of trials.
+    """
+    rng = np.random.default_rng(0)
+    print('Sequence generation (oddball ratio %.2f, max oddball run %i, min standards after a run %i)'
+          % (oddball_ratio, max_oddball_run, min_standards_after))
+    print('trials  shuffled (ms)  constrained (ms)')
+    for trials in trial_counts:
+        shuffled = time_call(lambda: trial_sequences.generate_block_sequence(trials, oddball_ratio, rng),
+                             repetitions)
+        constrained = time_call(lambda: trial_sequences.generate_constrained_block_sequence(
+                                    trials, oddball_ratio, rng, max_oddball_run, min_standards_after),
+                                repetitions)
+        print('%6i  %13.3f  %16.3f' % (trials, shuffled, constrained))
+
+
+def benchmark_scheduler(trials=20, trial_break=0.07, trial_length=0.08, overhead=0.01):
+    """
+    Prints the drift at the end of a block of ``trials`` trials, timed with
+    relative waits and with the DeadlineScheduler. ``overhead`` stands for the
+    trigger pulses and prints between two waits. The durations are a tenth of
+    the experiment's to keep the benchmark short.
+    """
+    print('Block timing (%i trials, break %.3f s, length %.3f s, %.0f ms work per trial)'
+          % (trials, trial_break, trial_length, overhead * 1000))
+    planned = trials * (trial_break + trial_length)
+
+    start = time.perf_counter()
+    for trial in range(trials):
+        time.sleep(overhead)
+        time.sleep(trial_break)
+        time.sleep(trial_length)
+    print('relative waits: drift %.3f ms' % ((time.perf_counter() - start - planned) * 1000))
+
+    block_scheduler = scheduler.DeadlineScheduler('deadline scheduler')
+    for trial in range(trials):
+        time.sleep(overhead)
+        block_scheduler.wait(trial_break)
+        block_scheduler.wait(trial_length)
+    print(block_scheduler.report())
+
+
+def benchmark_telemetry(repetitions=100000):
+    """
+    Prints the time needed to publish a trial, with telemetry off and with
+    telemetry on (without server, which only adds threads that read the buffer).
+    """
+    print('Telemetry publish (%i trials)' % repetitions)
+    telemetry.metrics = None
+    off = time_call(lambda: telemetry.publish('block', 1, 'standard', 0.0001, 0), repetitions) * 1000
+    telemetry.metrics = telemetry.MetricsBuffer()
+    on = time_call(lambda: telemetry.publish('block', 1, 'standard', 0.0001, 0), repetitions) * 1000
+    telemetry.metrics = None
+    print('off: %.3f us per trial, on: %.3f us per trial' % (off, on))
+
+
+class SlowStream():
+    """A console that blocks for ``delay`` seconds on every write, like a busy terminal."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def benchmark_console(lines=200, delay=0.002):
+    """
+    Prints the time a console line costs the calling thread, written with
+    print and logged through the queue of console.py, on a console that
+    blocks for ``delay`` seconds per write.
+    """
+    stream = SlowStream(delay)
+    log = console.get_logger('benchmark')
+    print('Console line (%i lines, console blocking %.1f ms per write)' % (lines, delay * 1000))
+    direct = time_call(lambda: print('MODE (standard or oddball): ', 'standard', file=stream), lines)
+    console.start_console('INFO', stream)
+    queued = time_call(lambda: log.info('MODE (standard or oddball): %s', 'standard'), lines)
+    console.stop_console()
+    print('print: %.3f ms per line, queued: %.4f ms per line' % (direct, queued))
+
+
+def _onset_latencies(trials, period, heap):
+    """
+    Runs a loop of trials that, like the trial loop of a block, keeps a
+    record with the frame times of every trial, next to a heap of ``heap``
+    live objects. Returns the time from every deadline until the record of
+    the onset is stored, in milliseconds.
+    """
+    live = [{'trial': index, 'stimulus': [index]} for index in range(heap)]
+    records = []
+    latencies = np.empty(trials)
+    gc.collect()
+    start = time.perf_counter()
+    for trial in range(trials):
+        deadline = start + (trial + 1) * period
+        scheduler.sleep_until(deadline)
+        records.append({'trial': trial, 'frames': [[frame] for frame in range(200)]})
+        latencies[trial] = (time.perf_counter() - deadline) * 1000
+    del live, records
+    return latencies
+
+
+def benchmark_realtime(trials=1000, period=0.005, heap=100000):
+    """
+    Prints the jitter of the trial onsets of a block, in the normal mode and
+    in the real-time mode (see realtime.py), and which real-time settings took
+    effect. In the normal mode the garbage collector interrupts the onsets to
+    scan the whole heap.
+    """
+    print('Trial onset latency (%i trials every %.0f ms, %i live objects)' % (trials, period * 1000, heap))
+    print('mode        mean (ms)  sd (ms)  99% (ms)  max (ms)')
+    normal = _onset_latencies(trials, period, heap)
+    session = realtime.RealtimeSession(stimulus_cores=[max(os.sched_getaffinity(0))] if hasattr(os, 'sched_getaffinity') else [])
+    session.enter()
+    session.start_block()
+    realtime_latencies = _onset_latencies(trials, period, heap)
+    session.end_block()
+    session.exit()
+    for mode, latencies in (('normal', normal), ('real-time', realtime_latencies)):
+        print('%-10s  %9.4f  %7.4f  %8.4f  %8.3f' % (mode, latencies.mean(), latencies.std(),
+                                                     np.percentile(latencies, 99), latencies.max()))
+    print(session.describe())
+
+
+def main():
+    benchmark_sequences()
+    print('')
+    benchmark_scheduler()
+    print('')
+    benchmark_telemetry()
+    print('')
+    benchmark_console()
+    print('')
+    benchmark_realtime()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Planning of the block order of a session.
+- enumerate_valid_orders: all orders in which every block type is run once, then
+  every block type once more, without the same block twice in a row
+- williams_square: balanced Latin square for the block types
+- BlockOrderPlanner: assigns the valid orders to participant IDs in a balanced way.
+  The table is computed once and cached on disk, together with a hash of the
+  planning code (planning_version).
+
+Blocks are identified by their index in BLOCK_NAMES.
+"""
+
+import hashlib, inspect, itertools, os
+import numpy as np
+
+BLOCK_NAMES = ['visual_oddball',
+               'visual_swapped_oddball',
+               'vibrotactile_oddball_ankle',
+               'vibrotactile_swapped_oddball_ankle']
+# Names of the block functions of the ScreenController and VibrationController
+
+
+def enumerate_valid_orders(n_blocks=len(BLOCK_NAMES)):
+    """
+    Returns all valid block orders: a permutation of the blocks followed by a
+    second permutation that does not start with the last block of the first one.
+
+    Returns
+    -------
+    ndarray
+        uint8 array of shape (n_orders, 2 * n_blocks), in lexicographic order.
+    """
+    permutations = list(itertools.permutations(range(n_blocks)))
+    orders = [first + second for first in permutations for second in permutations
+              if second[0] != first[-1]]
+    return np.array(orders, dtype=np.uint8)
+
+
+def williams_square(n_blocks=len(BLOCK_NAMES)):
+    """
+    Returns a Williams design for an even number of blocks: every block appears
+    once at every position and every block directly follows every other block
+    exactly once.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n_blocks, n_blocks), one order per row.
+    """
+    first_row = [0]
+    for i in range(1, n_blocks):
+        # 0, 1, n-1, 2, n-2, ...
+        first_row.append((i + 1) // 2 if i % 2 == 1 else n_blocks - i // 2)
+    return (np.array(first_row)[None, :] + np.arange(n_blocks)[:, None]) % n_blocks
+
+
+def balanced_assignment(valid_orders, n_blocks=len(BLOCK_NAMES)):
+    """
+    Selects the valid orders that are assigned to consecutive participants.
+
+    Both halves of a session are rows of the Williams square. For the first
+    half the participants cycle through the rows, for the second half through
+    the shifts between the rows that do not repeat the last block of the first
+    half. Every group of n_blocks participants is balanced for the position of
+    the blocks and their first-order carry-over within each half, and all
+    combinations of the two halves are used before one is repeated.
+
+    Returns
+    -------
+    ndarray
+        Indices into ``valid_orders``, one per participant slot.
+    """
+    square = williams_square(n_blocks)
+    index_of_order = {tuple(order): i for i, order in enumerate(valid_orders.tolist())}
+
+    assignment = []
+    for shift in range(1, n_blocks + 1):
+        shift = shift % n_blocks
+        for row in range(n_blocks):
+            order = tuple(square[row]) + tuple(square[(row + shift) % n_blocks])
+            if order in index_of_order:
+                assignment.append(index_of_order[order])
+    return np.array(assignment, dtype=np.int64)
+
+
+def planning_version():
+    """
+    Returns a hash of the block names and of the source code of the functions
+    that compute the assignment table, such that a cached table is rebuilt
+    whenever one of them changes.
+    """
+    digest = hashlib.sha1(repr(BLOCK_NAMES).encode())
+    for function in (enumerate_valid_orders, williams_square, balanced_assignment):
+        digest.update(inspect.getsource(function).encode())
+    return digest.hexdigest()
+
+
+class BlockOrderPlanner():
+    """
+    Returns the block order of a participant in constant time.
+
+    Parameters
+    ----------
+    cache_file_name : str
+        The .npz file that caches the valid orders and the assignment table.
+        It is created if it does not exist, and rebuilt if it was made for
+        other block types or by another version of the planning functions
+        (see planning_version).
+
+    Attributes
+    ----------
+    valid_orders : ndarray
+        All valid block orders.
+    assignment : ndarray
+        Indices into ``valid_orders`` for consecutive participant IDs.
+    rebuilt : bool
+        True if an existing cache did not fit and was replaced, i.e. the
+        participants may get other orders than those of earlier sessions.
+    """
+
+    def __init__(self, cache_file_name):
+        self.valid_orders = None
+        self.assignment = None
+        self.rebuilt = False
+        version = planning_version()
+
+        if os.path.exists(cache_file_name):
+            with np.load(cache_file_name) as cache:
+                if (cache['block_names'].tolist() == BLOCK_NAMES and 'version' in cache.files
+                        and str(cache['version']) == version):
+                    self.valid_orders = cache['valid_orders']
+                    self.assignment = cache['assignment']
+                else:
+                    self.rebuilt = True
+
+        if self.valid_orders is None:
+            self.valid_orders = enumerate_valid_orders()
+            self.assignment = balanced_assignment(self.valid_orders)
+            directory = os.path.dirname(cache_file_name)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            np.savez(cache_file_name, block_names=np.array(BLOCK_NAMES), version=np.array(version),
+                     valid_orders=self.valid_orders, assignment=self.assignment)
+
+    def order_for_participant(self, participant_ID):
+        """
+        Returns the block order of a participant.
+
+        Parameters
+        ----------
+        participant_ID : int
+            The ID of the participant, starting at 1.
+
+        Returns
+        -------
+        ndarray
+            The block indices (see BLOCK_NAMES) in the order they are run.
+        """
+        slot = (int(participant_ID) - 1) % len(self.assignment)
+        return self.valid_orders[self.assignment[slot]]
+
+    def names_for_participant(self, participant_ID):
+        """Returns the block names of a participant in the order they are run."""
+        return [BLOCK_NAMES[index] for index in self.order_for_participant(participant_ID)]
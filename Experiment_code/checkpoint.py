@@ -0,0 +1,96 @@
+"""
+Checkpoints of a running session, such that it can be resumed after a crash.
+- save_checkpoint: writes the state of the session atomically
+- load_checkpoint: reads it back, None if there is none
+- check_resumable: checks that a checkpoint belongs to the session to resume
+
+The checkpoint is a small JSON file that is rewritten after every block. It
+stores the participant ID, the seed, the block order, the index of the next
+block and the number of finished fingertapping rounds. The stimulus sequences
+are not copied: they stay in the session file (see trial_sequences.py), which
+the checkpoint refers to.
+
+A block that was interrupted is run again from its first trial.
+"""
+
+import json, os
+
+CHECKPOINT_VERSION = 1
+# Version of the checkpoint format
+
+
+def save_checkpoint(file_name, participant_ID, seed, block_order, session_file_name, next_block,
+                    fingertapping_round, finished=False):
+    """
+    Writes the state of a session.
+
+    The state is written to a temporary file, flushed to the disk and then
+    renamed, such that a crash leaves either the old or the new checkpoint.
+
+    Parameters
+    ----------
+    file_name : str
+        The .json file of the checkpoint.
+    participant_ID : int
+        The ID of the participant.
+    seed : int
+        The seed of the session.
+    block_order : list
+        The names of the blocks in the order they are run.
+    session_file_name : str
+        The session file with the stimulus sequences.
+    next_block : int
+        The index of the block that is run next.
+    fingertapping_round : int
+        The number of finished fingertapping rounds.
+    finished : bool
+        True once the whole session is finished.
+    """
+    state = {'version': CHECKPOINT_VERSION, 'participant_ID': int(participant_ID), 'seed': int(seed),
+             'block_order': list(block_order), 'session_file_name': session_file_name,
+             'next_block': int(next_block), 'fingertapping_round': int(fingertapping_round),
+             'finished': bool(finished)}
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'w') as file:
+        json.dump(state, file, indent=1)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file_name, file_name)
+
+
+def load_checkpoint(file_name):
+    """
+    Reads the checkpoint of a session.
+
+    Returns
+    -------
+    dict
+        The state written by save_checkpoint, or None if there is no checkpoint.
+    """
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as file:
+        return json.load(file)
+
+
+def check_resumable(state, participant_ID, seed):
+    """
+    Checks that a checkpoint can be resumed by the given session.
+
+    Exception
+    ---------
+    Raises a ValueError if there is no checkpoint, if it belongs to another
+    participant or seed, or if its session is already finished.
+    """
+    if state is None:
+        raise ValueError('There is no checkpoint to resume.')
+    if state['version'] != CHECKPOINT_VERSION:
+        raise ValueError('The checkpoint has version %s, expected %i.' % (state['version'], CHECKPOINT_VERSION))
+    if state['participant_ID'] != int(participant_ID) or state['seed'] != int(seed):
+        raise ValueError('The checkpoint belongs to participant %i with seed %i, not participant %s with seed %s.'
+                         % (state['participant_ID'], state['seed'], participant_ID, seed))
+    if state['finished']:
+        raise ValueError('The session of participant %i is already finished.' % state['participant_ID'])
@@ -0,0 +1,265 @@
+"""
+Loading and validation of the experiment configuration.
+- SETTINGS: all settings with their type and default value
+- load_config: the settings from the defaults, a JSON file, environment
+  variables and command line overrides, validated once
+- parse_overrides: the --name=value overrides of a command line
+- environment_overrides: the settings as environment variables, e.g. for
+  starting a session in another process
+
+A setting is taken from, in increasing priority:
+1. its default in SETTINGS
+2. the JSON file given by the environment variable EEGTACTILE_CONFIG, or
+   experiment_config.json in the working directory if it exists
+3. the environment variable EEGTACTILE_<NAME>, e.g. EEGTACTILE_TRIALS=200
+4. a command line argument --<name>=<value>, e.g. --trials=200
+
+parameter.py loads the configuration when it is imported. Only if no
+participant ID is configured, it asks for one.
+"""
+
+import json, os
+
+ENV_PREFIX = 'EEGTACTILE_'
+# Prefix of the environment variables of the settings
+
+CONFIG_FILE_VARIABLE = 'EEGTACTILE_CONFIG'
+# Environment variable with the name of the configuration file
+
+DEFAULT_CONFIG_FILE = 'experiment_config.json'
+# Configuration file that is used if it exists and no other file is given
+
+SCREEN_TRIGGERS = (16, 17, 18, 19, 20, 21)
+# Fixed trigger codes of the screens and the fingertapping (see TriggerNumbers.md)
+
+SETTINGS = {'participant_ID': ('optional int', None),
+            'output_directory': ('str', ''),
+            'trials': ('int', 20),
+            'oddball_ratio': ('float', 0.3),
+            'random_seed': ('optional int', None),
+            'max_oddball_run': ('optional int', None),
+            'min_standards_after': ('int', 0),
+            'trial_break': ('float', 0.7),
+            'trial_length': ('float', 0.8),
+            'frame_locked': ('bool', True),
+            'io_process': ('bool', False),
+            'telemetry_port': ('optional int', None),
+            'profiling': ('bool', False),
+            'console_level': ('str', 'INFO'),
+            'realtime': ('bool', False),
+            'stimulus_cores': ('int list', []),
+            'io_cores': ('int list', []),
+            'realtime_priority': ('int', 50),
+            'circle_colors': ('str list', ['cyan', 'pink']),
+            'cache_circle_stimuli': ('bool', True),
+            'ankle_vibromotor': ('int', 12),
+            'vibration_weak': ('int', 30),
+            'vibration_strong': ('int', 100),
+            'belt_interface': ('str', 'usb'),
+            'belt_name': ('str', ''),
+            'belt_watchdog': ('bool', True),
+            'belt_gap_trigger': ('int', 22),
+            'ankle_trigger': ('int list', [9, 11, 12]),
+            'ankle_swapped_trigger': ('int list', [5, 7, 8]),
+            'visual_trigger': ('int list', [1, 3, 4]),
+            'visual_swapped_trigger': ('int list', [14, 13, 15])}
+# Type and default value of every setting. The parameters are described in parameter.py.
+
+
+def parse_value(name, text):
+    """
+    Converts the text of an environment variable or command line argument to
+    the type of a setting. Lists are given as JSON ([1, 2, 3]) or separated
+    by commas (1,2,3), an optional setting is unset by 'none'.
+
+    Exception
+    ---------
+    Raises a ValueError if the text does not fit the type.
+    """
+    kind = SETTINGS[name][0]
+    text = text.strip()
+    if kind.startswith('optional'):
+        if text.lower() in ('none', 'null', ''):
+            return None
+        kind = kind.split()[1]
+    if kind == 'int':
+        return int(text)
+    if kind == 'float':
+        return float(text)
+    if kind == 'bool':
+        if text.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if text.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError('%s: %r is not a boolean' % (name, text))
+    if kind.endswith('list'):
+        values = json.loads(text) if text.startswith('[') else [value.strip() for value in text.split(',') if value.strip()]
+        return [int(value) for value in values] if kind == 'int list' else [str(value) for value in values]
+    return text
+
+
+def parse_overrides(arguments):
+    """
+    Returns the settings given as --name=value in a list of command line
+    arguments. Other arguments are ignored, such that scripts can have their
+    own positional arguments.
+
+    Exception
+    ---------
+    Raises a ValueError for an unknown setting or a value of the wrong type.
+    """
+    overrides = {}
+    for argument in arguments:
+        if not argument.startswith('--') or '=' not in argument:
+            continue
+        name, text = argument[2:].split('=', 1)
+        if name not in SETTINGS:
+            raise ValueError('Unknown setting on the command line: %s' % name)
+        overrides[name] = parse_value(name, text)
+    return overrides
+
+
+def environment_overrides(settings):
+    """Returns the environment variables that set the given settings."""
+    return {ENV_PREFIX + name.upper(): 'none' if value is None else
+                                        json.dumps(value) if isinstance(value, list) else str(value)
+            for name, value in settings.items()}
+
+
+def _check_type(name, value):
+    """Returns an error message if the value does not fit the type of the setting, else None."""
+    kind = SETTINGS[name][0]
+    if kind.startswith('optional'):
+        if value is None:
+            return None
+        kind = kind.split()[1]
+    if kind == 'int':
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif kind == 'float':
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif kind == 'bool':
+        valid = isinstance(value, bool)
+    elif kind == 'int list':
+        valid = isinstance(value, list) and all(isinstance(v, int) and not isinstance(v, bool) for v in value)
+    elif kind == 'str list':
+        valid = isinstance(value, list) and all(isinstance(v, str) for v in value)
+    else:
+        valid = isinstance(value, str)
+    return None if valid else '%s: %r is not of type %s' % (name, value, SETTINGS[name][0])
+
+
+def validate(settings):
+    """
+    Checks the types and ranges of all settings.
+
+    Exception
+    ---------
+    Raises a ValueError that lists every invalid setting.
+    """
+    errors = [message for message in (_check_type(name, value) for name, value in settings.items())
+              if message is not None]
+    if errors:
+        raise ValueError('Invalid configuration:\n' + '\n'.join(errors))
+
+    def check(condition, message):
+        if not condition:
+            errors.append(message)
+
+    check(settings['participant_ID'] is None or settings['participant_ID'] >= 1,
+          'participant_ID must be at least 1')
+    check(settings['trials'] >= 1, 'trials must be at least 1')
+    check(0 <= settings['oddball_ratio'] <= 1, 'oddball_ratio must lie between 0 and 1')
+    check(settings['max_oddball_run'] is None or settings['max_oddball_run'] >= 1,
+          'max_oddball_run must be at least 1 or none')
+    check(settings['min_standards_after'] >= 0, 'min_standards_after must not be negative')
+    check(settings['trial_break'] > 0 and settings['trial_length'] > 0,
+          'trial_break and trial_length must be positive')
+    check(settings['telemetry_port'] is None or 0 < settings['telemetry_port'] < 65536,
+          'telemetry_port must be a port number (1-65535) or none')
+    check(settings['console_level'] in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+          'console_level must be one of DEBUG, INFO, WARNING, ERROR, CRITICAL')
+    check(all(core >= 0 for core in settings['stimulus_cores'] + settings['io_cores']),
+          'stimulus_cores and io_cores must be core numbers (0, 1, ...)')
+    check(0 <= settings['realtime_priority'] <= 99, 'realtime_priority must lie between 0 and 99')
+    check(len(settings['circle_colors']) == 2, 'circle_colors must have two colors')
+    check(0 <= settings['ankle_vibromotor'] < 16, 'ankle_vibromotor must be a vibromotor of the belt (0-15)')
+    for name in ('vibration_weak', 'vibration_strong'):
+        check(0 <= settings[name] <= 100, '%s must lie between 0 and 100' % name)
+    check(settings['belt_interface'] in ('usb', 'bluetooth', 'loopback'),
+          'belt_interface must be usb, bluetooth or loopback')
+    check(settings['belt_interface'] == 'usb' or not settings['io_process'],
+          'the I/O process connects the belt only via usb')
+    check(0 <= settings['belt_gap_trigger'] <= 255, 'belt_gap_trigger must be a trigger code (1-255) or 0')
+    check(settings['belt_gap_trigger'] not in settings['ankle_trigger'] + settings['ankle_swapped_trigger'] +
+          settings['visual_trigger'] + settings['visual_swapped_trigger'] + list(SCREEN_TRIGGERS),
+          'belt_gap_trigger must differ from the trigger codes of the blocks and the screens (16-21)')
+    for name in ('ankle_trigger', 'ankle_swapped_trigger', 'visual_trigger', 'visual_swapped_trigger'):
+        check(len(settings[name]) == 3 and all(0 < code < 256 for code in settings[name]),
+              '%s must have three trigger codes (1-255): oddball, standard, break' % name)
+    if errors:
+        raise ValueError('Invalid configuration:\n' + '\n'.join(errors))
+
+
+def load_config(file_name=None, overrides=None, environ=None):
+    """
+    Loads and validates the configuration.
+
+    Parameters
+    ----------
+    file_name : str
+        The JSON file with settings, or None for the file given by
+        EEGTACTILE_CONFIG or experiment_config.json if it exists.
+    overrides : dict
+        Settings that override all others, e.g. from parse_overrides.
+    environ : dict
+        The environment variables, or None for os.environ.
+
+    Returns
+    -------
+    dict
+        The value of every setting in SETTINGS.
+
+    Exception
+    ---------
+    Raises a ValueError for unknown or invalid settings.
+    """
+    environ = os.environ if environ is None else environ
+    settings = {name: default for name, (kind, default) in SETTINGS.items()}
+
+    if file_name is None:
+        file_name = environ.get(CONFIG_FILE_VARIABLE)
+        if file_name is None and os.path.exists(DEFAULT_CONFIG_FILE):
+            file_name = DEFAULT_CONFIG_FILE
+    if file_name is not None:
+        with open(file_name) as file:
+            from_file = json.load(file)
+        unknown = sorted(set(from_file) - set(SETTINGS))
+        if unknown:
+            raise ValueError('Unknown settings in %s: %s' % (file_name, ', '.join(unknown)))
+        settings.update(from_file)
+
+    for name in SETTINGS:
+        if ENV_PREFIX + name.upper() in environ:
+            settings[name] = parse_value(name, environ[ENV_PREFIX + name.upper()])
+
+    if overrides:
+        unknown = sorted(set(overrides) - set(SETTINGS))
+        if unknown:
+            raise ValueError('Unknown settings: %s' % ', '.join(unknown))
+        settings.update(overrides)
+
+    validate(settings)
+    return settings
+
+
+def prompt_participant_ID():
+    """Asks for the participant ID until a valid one is entered."""
+    while True:
+        text = input('Please enter the participant ID: ') # e.g. 38
+        try:
+            participant_ID = int(text)
+            if participant_ID >= 1:
+                return participant_ID
+        except ValueError:
+            pass
+        print('The participant ID must be a positive integer.')
@@ -0,0 +1,107 @@
+"""
+Console output of the experiment through a queue and a writer thread.
+- get_logger: the logger of a module, used instead of print
+- start_console: routes all log records through a queue to a thread that
+  formats and writes them
+- flush: waits until the records logged so far are written
+- stop_console: writes the remaining records and stops the thread
+
+A terminal write can block for milliseconds, e.g. when the console window is
+scrolled or slow. With the queue, logging on the stimulus thread only creates
+a record and puts it in an unbounded queue.SimpleQueue, which never blocks.
+The message is formatted (``msg % args``) only by the writer thread, thus the
+arguments of a record must not be changed after logging it.
+
+parameter.py starts the console with the console_level setting. Messages
+below the level are dropped when they are logged, before a record is created.
+"""
+
+import atexit, logging, logging.handlers, queue, sys, threading
+
+CONSOLE_FORMAT = '%(message)s'
+# Format of the console lines, only the message like the former print output
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+# Valid values of the console_level setting
+
+FLUSH_TIMEOUT_SEC = 2.0
+# Timeout to wait for the writer thread in flush
+
+
+def get_logger(name):
+    """Returns the logger of a module, e.g. get_logger(__name__)."""
+    return logging.getLogger(name)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records in the queue as they are. The QueueHandler of the
+    standard library formats the message before, on the logging thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _ConsoleListener(logging.handlers.QueueListener):
+    """The writer thread. A record with a flush_event only sets the event, see flush."""
+
+    def handle(self, record):
+        flush_event = getattr(record, 'flush_event', None)
+        if flush_event is not None:
+            flush_event.set()
+            return
+        logging.handlers.QueueListener.handle(self, record)
+
+
+_listener = None
+# The writer thread of the running console
+
+_handler = None
+# The handler that puts the records in the queue
+
+
+def start_console(level='INFO', stream=None):
+    """
+    Routes the log records of all modules through the queue to the writer thread.
+
+    Parameters
+    ----------
+    level : str
+        The lowest level that is written, one of LEVELS.
+    stream : file
+        Where the records are written, None for sys.stdout.
+    """
+    global _listener, _handler
+    stop_console()
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    _listener = _ConsoleListener(log_queue, stream_handler)
+    _handler = _DeferredQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener.start()
+
+
+def flush(timeout=FLUSH_TIMEOUT_SEC):
+    """Waits until the records logged so far are written, e.g. before printing directly."""
+    if _listener is None:
+        return
+    record = logging.makeLogRecord({'flush_event': threading.Event()})
+    _listener.queue.put(record)
+    record.flush_event.wait(timeout)
+
+
+def stop_console():
+    """Writes the remaining records and stops the writer thread."""
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_console)
@@ -5,107 +5,249 @@
 
 import serial #@UnusedImport # PySerial for USB connection
 import serial.tools.list_ports
+import sys
 import time
-import random
 from psychopy import visual, event
 import vibrotactile_functions
 import visual_functions
+import block_order
+import session_timeline
+import io_process
+from pybelt import classicbelt
+import trial_sequences
+import checkpoint
+import telemetry
+import profiling
+import realtime
+import console
 import parameter
 
+log = console.get_logger(__name__)
+# Console output of the experiment (see console.py)
+
 class Experiment():
 
     def __init__(self):
-        print('----------------')
-        print('Start Experiment')
-        print('----------------\n')
+        log.info('----------------')
+        log.info('Start Experiment')
+        log.info('----------------\n')
+
+        # In the multi-process mode the belt and the trigger port are owned by
+        # the I/O process; the triggers set here are sent to it
+        self.io_client = None
+        if parameter.io_process:
+            self.io_client = io_process.IOProcessClient(belt_watchdog=parameter.belt_watchdog,
+                                                        gap_trigger=parameter.belt_gap_trigger)
+            self.io_client.start()
+            classicbelt.p = self.io_client.trigger_port()
 
         # get the vibrotactile and visual functions
         self.belt = vibrotactile_functions.VibrationController(parameter.ankle_vibromotor, parameter.ankle_trigger,
                                                                parameter.ankle_swapped_trigger, parameter.vibration_strong,
-                                                               parameter.vibration_weak, parameter.trial_break, parameter.trial_length)
+                                                               parameter.vibration_weak, parameter.trial_break, parameter.trial_length,
+                                                               self.io_client, parameter.belt_watchdog,
+                                                               parameter.belt_gap_trigger, parameter.belt_interface,
+                                                               parameter.belt_name)
         self.screen = visual_functions.ScreenController(parameter.circle_colors, parameter.trial_break,
                                                         parameter.trial_length, parameter.visual_trigger,
                                                         parameter.visual_swapped_trigger)
 
+        # Spans of the blocks, trials and I/O calls of the session (off by default)
+        self.profiler = None
+        if parameter.profiling:
+            self.profiler = profiling.Profiler()
+            self.profiler.enable()
+            self.profiler.instrument_experiment(self)
+
+        # Live timing of the trials for the experimenter. The belt gauges are
+        # sampled by the telemetry server, not by the stimulus thread.
+        if parameter.telemetry_port is not None:
+            telemetry.start_telemetry(parameter.telemetry_port)
+            if self.belt.belt_controller is not None:
+                telemetry.register_gauge('belt_ack_latency', self.belt.belt_controller.getAckLatency)
+                telemetry.register_gauge('serial_queue_depth', self.belt.belt_controller.getOutputQueueDepth)
+                telemetry.register_gauge('belt_recovery_times', self.belt.belt_controller.getRecoveryTimes)
+
+        # Real-time mode on Linux (off by default), applied once the belt threads run
+        self.realtime = None
+        if parameter.realtime:
+            self.realtime = realtime.RealtimeSession(parameter.stimulus_cores, parameter.io_cores,
+                                                     parameter.realtime_priority)
+
         # get the parameter from external file
         self.trials_per_block = parameter.trials
         self.oddball_ratio = parameter.oddball_ratio
         self.circle_colors = parameter.circle_colors
+        self.seed = trial_sequences.session_seed(parameter.participant_ID, parameter.random_seed)
+        self.block_planner = block_order.BlockOrderPlanner(parameter.block_order_file_name)
+        if self.block_planner.rebuilt:
+            log.warning('The block order table %s was made by other planning code and is rebuilt, '
+                        'participants may get other block orders than in earlier sessions',
+                        parameter.block_order_file_name)
+
+        log.info("\nThe experiment includes:")
+        log.info('Trials per block: %s', self.trials_per_block)
+        log.info('Seed: %s', self.seed)
+
+    def start(self, resume=False):
+        """
+        Function that starts the experiment
+
+        Parameters
+        ----------
+        resume : bool
+            Continues an interrupted session from the block after the last
+            finished one (see checkpoint.py) instead of starting a new one.
+        """
+        if resume:
+            state = checkpoint.load_checkpoint(parameter.checkpoint_file_name)
+            checkpoint.check_resumable(state, parameter.participant_ID, self.seed)
 
-        print("\nThe experiment includes:")
-        print("Trials per block: ", self.trials_per_block)
-
-    def start(self):
-        """Function that starts the experiment"""
         # Initialize belt controller
         self.belt.connect_to_USB()
 
-        print('+++++++++++++++++++++++++++++++++++')
-        print('          -BELT CONNECTED-         ')
-        print('+++++++++++++++++++++++++++++++++++\n')
+        log.info('+++++++++++++++++++++++++++++++++++')
+        log.info('          -BELT CONNECTED-         ')
+        log.info('+++++++++++++++++++++++++++++++++++\n')
+
+        if self.realtime is not None:
+            self.realtime.enter(self.io_client.process.pid if self.io_client is not None else None)
+            log.info('Real-time mode:\n%s\n', self.realtime.describe())
 
         # Show instructions on screen
-        self.screen.show_instructions()
+        if not resume:
+            self.screen.show_instructions()
 
         # The functions for each of the 4 block types are stored in a list,
-        # enabling to iterate over and ranodmly execute them in the for-loop
-        block_functions = [self.screen.visual_oddball,
-                           self.screen.visual_swapped_oddball,
-                           self.belt.vibrotactile_oddball_ankle,
-                           self.belt.vibrotactile_swapped_oddball_ankle]
-
-        # Keeping track of the fingertapping rounds
-        count_fingertapping = 0
-
-        # Shuffle blocks
-        random.shuffle(block_functions)
-
-        # Execute all the blocks twice. Before executing another time,
-        # all other blocks should have been run at least once.
-        remaining_trials =block_functions[:]
-        
-        # No direct repition of the same trial
-        while len(block_functions)!= 8:
-            next_trial = random.choice(remaining_trials)
-            while next_trial == block_functions[-1]:
-                next_trial = random.choice(remaining_trials)
-            block_functions.append(next_trial)
-            remaining_trials.remove(next_trial)
-        
+        # in the order of block_order.BLOCK_NAMES
+        block_types = [self.screen.visual_oddball,
+                       self.screen.visual_swapped_oddball,
+                       self.belt.vibrotactile_oddball_ankle,
+                       self.belt.vibrotactile_swapped_oddball_ankle]
+
+        if resume:
+            # Continue with the block order, sequences and fingertapping
+            # round of the checkpoint, nothing is generated again
+            seed, block_names, sequences = trial_sequences.load_session(state['session_file_name'])
+            functions_by_name = {function.__name__: function for function in block_types}
+            block_functions = [functions_by_name[name] for name in block_names]
+            first_block = state['next_block']
+            count_fingertapping = state['fingertapping_round']
+            log.info('Resume the session at block %i of %i, after %i fingertapping rounds\n',
+                     first_block + 1, len(block_functions), count_fingertapping)
+        else:
+            # Keeping track of the fingertapping rounds
+            count_fingertapping = 0
+            first_block = 0
+
+            # Execute all the blocks twice. Before executing another time,
+            # all other blocks should have been run at least once. No direct
+            # repetition of the same block. The order is counterbalanced across
+            # participants (see block_order.py).
+            order = self.block_planner.order_for_participant(parameter.participant_ID)
+            block_functions = [block_types[index] for index in order]
+            block_names = [function.__name__ for function in block_functions]
+
+            # Generate the stimulus order of every block before the first one and
+            # save it together with the seed and the block order
+            sequences = trial_sequences.generate_session_sequences(len(block_functions), self.trials_per_block,
+                                                                   self.oddball_ratio, self.seed,
+                                                                   parameter.max_oddball_run,
+                                                                   parameter.min_standards_after)
+            trial_sequences.save_session(parameter.session_file_name, self.seed, block_names, sequences)
+
+            # Compile the planned events of the session and predict its duration
+            timeline = session_timeline.compile_session(block_names, sequences, parameter,
+                                                        self.screen.frame_rate if self.screen.frame_locked else None)
+            session_timeline.save_timeline(parameter.timeline_file_name, timeline)
+            session_timeline.print_summary(timeline)
+            log.info('')
+            self.save_checkpoint(block_names, 0, count_fingertapping)
 
         # Shuffle threw blocks
         for i, function in enumerate(block_functions):
-                print('Start next block section!')
+                if i < first_block:
+                    continue
+                log.info('Start next block section!')
                 time.sleep(1.0)
+                # Collect the garbage before the ready screen, where the
+                # participant sets the pace, such that none interrupts the block
+                if self.realtime is not None:
+                    self.realtime.start_block()
                 self.screen.show_ready_screen()
                 self.screen.show_fixation_cross()
-                print('Execute block %i' % (i+1))
-                function(self.trials_per_block, self.oddball_ratio)
+                log.info('Execute block %i', i+1)
+                function(sequences[i])
+                if self.realtime is not None:
+                    self.realtime.end_block()
 
                 if i%2 == 0:
-                    print('-----------------------------------')
-                    print('-----------FINGER TAPPING----------')
-                    print('-----------------------------------\n')
+                    log.info('-----------------------------------')
+                    log.info('-----------FINGER TAPPING----------')
+                    log.info('-----------------------------------\n')
                     count_fingertapping += 1
                     self.screen.start_fingertapping_screen(count_fingertapping)
 
-                print('\n')
+                # The block and its fingertapping are done, a crash from here
+                # on resumes with the next block
+                self.save_checkpoint(block_names, i + 1, count_fingertapping)
+                log.info('\n')
 
         # At the very end of the experiment, disconnect the belt
         self.belt.disconnect_belt()
+        if self.io_client is not None:
+            self.io_client.stop()
+        telemetry.stop_telemetry()
+        self.finish_profiling()
+        if self.realtime is not None:
+            self.realtime.exit()
+
+        self.save_checkpoint(block_names, len(block_functions), count_fingertapping, finished=True)
 
         # Say good bye and thank the participants
         self.screen.show_thank_you()
 
+    def finish_profiling(self):
+        """Removes the profiling spans, saves the trace and prints where the time went."""
+        if self.profiler is None or not self.profiler.enabled:
+            return
+        self.profiler.disable()
+        self.profiler.save(parameter.trace_file_name)
+        log.info(self.profiler.summary())
+        log.info('Trace of the session (open in https://ui.perfetto.dev): %s', parameter.trace_file_name)
+
+    def save_checkpoint(self, block_names, next_block, count_fingertapping, finished=False):
+        """Saves the state of the session, see checkpoint.save_checkpoint."""
+        checkpoint.save_checkpoint(parameter.checkpoint_file_name, parameter.participant_ID, self.seed, block_names,
+                                   parameter.session_file_name, next_block, count_fingertapping, finished)
+
 
 def main():
-    """ Starts the experiment. """
+    """
+    Starts the experiment. With the argument resume (python experiment_code.py
+    resume) an interrupted session is continued from its checkpoint.
+    """
+    resume = 'resume' in sys.argv[1:]
+    experiment = None
     try:
         experiment = Experiment()
-        experiment.start()
+        experiment.start(resume)
 
     except Exception as e:
-        print(e)
+        log.error('%s', e)
+        if experiment is not None:
+            experiment.finish_profiling()
+            if experiment.realtime is not None:
+                experiment.realtime.exit()
+        state = checkpoint.load_checkpoint(parameter.checkpoint_file_name)
+        if state is not None and not state['finished']:
+            log.info('The session can be resumed at block %i with: python experiment_code.py resume',
+                     state['next_block'] + 1)
+
+    finally:
+        # Release the belt and the ports of the I/O process for a resumed session
+        if experiment is not None and experiment.io_client is not None:
+            experiment.io_client.stop()
 
 if __name__ == "__main__":
     main()
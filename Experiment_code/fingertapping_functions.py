@@ -0,0 +1,237 @@
+"""
+This file includes the helpers for recording the fingertapping task that is started
+by the ScreenController.
+- TappingKeyListener: collects the key presses of one fingertapping round in a
+  background thread, timestamped by the keyboard backend
+- FingertappingWriter: buffers the key presses of one round in memory and writes
+  them to the fingertapping data file in a background thread and, at the end of
+  the round, to the fingertapping store
+"""
+
+import threading, queue, time
+import atexit, csv, os
+import numpy as np
+import realtime
+
+KEY_POLL_INTERVAL = 0.005
+# Time in seconds the listener sleeps between two reads of the keyboard queue.
+# The key times are taken by the keyboard backend when the key goes down, thus
+# the interval only delays the delivery of a key, not its recorded time.
+
+THREAD_JOIN_TIMEOUT_SEC = 1.0
+# Timeout to wait thread termination
+
+FLUSH_INTERVAL_SEC = 1.0
+# Time between two batches written by the FingertappingWriter
+
+BUFFER_CAPACITY = 1024
+# Number of key presses preallocated per fingertapping round
+
+FINGERTAPPING_HEADER = ['KeysPressed', 'StartTappingTime', 'FingertappingRound', 'CorrectSequence', 'ParticipantID']
+# Columns of the fingertapping data file
+
+
+class TappingKeyListener(threading.Thread):
+    """
+    Collects the key presses of one fingertapping round in a background thread.
+
+    The keyboard (psychopy.hardware.keyboard with the psychtoolbox backend) keeps
+    its own event queue with device timestamps. The listener reads that queue
+    and puts every key press into ``key_queue``, such that the main thread can
+    block on it instead of polling the keyboard in a busy loop.
+
+    Parameters
+    ----------
+    keyboard : Keyboard (object of psychopy.hardware.keyboard)
+        The keyboard to read. Its clock defines the time of the key presses.
+    key_list : list
+        The keys that are recorded, e.g. ['1', '2', '3', '4'].
+
+    Attributes
+    ----------
+    keyboard : Keyboard (object of psychopy.hardware.keyboard)
+        Stores the keyboard to read.
+    key_list : list
+        Stores the keys that are recorded.
+    key_queue : Queue
+        Holds a tuple (key name, key time in seconds) for every key press.
+    stop_flag : bool
+        Set to True to stop the thread.
+    """
+
+    def __init__(self, keyboard, key_list):
+        threading.Thread.__init__(self, name="TappingKeyListener", daemon=True)
+        self.keyboard = keyboard
+        self.key_list = key_list
+        self.key_queue = queue.Queue()
+
+        # Flag for stopping the thread
+        self.stop_flag = False
+
+    def run(self):
+        """Starts the thread."""
+        realtime.release_thread()
+        while not self.stop_flag:
+            keys = self.keyboard.getKeys(keyList=self.key_list, waitRelease=False, clear=True)
+            for key in keys:
+                self.key_queue.put((key.name, key.rt))
+            time.sleep(KEY_POLL_INTERVAL)
+
+    def stop(self):
+        """Stops the thread and waits for its termination."""
+        self.stop_flag = True
+        self.join(THREAD_JOIN_TIMEOUT_SEC)
+
+    def get_key(self, deadline):
+        """
+        Blocks until the next key press or the deadline.
+
+        Parameters
+        ----------
+        deadline : float
+            Time of time.perf_counter() at which to stop waiting.
+
+        Returns
+        -------
+        tuple
+            (key name, key time in seconds) or None if the deadline is reached.
+        """
+        timeout = deadline - time.perf_counter()
+        if timeout <= 0:
+            return None
+        try:
+            return self.key_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class FingertappingWriter(threading.Thread):
+    """
+    Writes the key presses of one fingertapping round to the fingertapping data file.
+
+    Key presses are stored in preallocated arrays by ``add``, which does no I/O.
+    A background thread appends the new rows to the file in batches every
+    ``FLUSH_INTERVAL_SEC`` and once more when the writer is closed at the end of
+    the round. If the program exits before ``close`` is called, the remaining
+    rows are written by an exit handler. When the writer is closed, the whole
+    round is also written to the fingertapping store, if one is given.
+
+    Parameters
+    ----------
+    file_name : str
+        The fingertapping data file. The header is written if the file is new or empty.
+    ft_round : int
+        The number of the fingertapping round.
+    correct_sequence : str
+        The sequence shown on the screen, e.g. '23142'.
+    participant_ID : int
+        The ID of the current participant.
+    store : FingertappingStore
+        The columnar store that receives the round when the writer is closed,
+        or None.
+    capacity : int
+        Number of key presses preallocated. The buffer grows if it is exceeded.
+
+    Attributes
+    ----------
+    file_name : str
+        Stores the name of the fingertapping data file.
+    ft_round : int
+        Stores the number of the fingertapping round.
+    correct_sequence : str
+        Stores the sequence shown on the screen.
+    participant_ID : int
+        Stores the ID of the current participant.
+    store : FingertappingStore
+        Stores the columnar store of the fingertapping data, or None.
+    stop_flag : bool
+        Set to True to stop the thread.
+    """
+
+    def __init__(self, file_name, ft_round, correct_sequence, participant_ID, store=None,
+                 capacity=BUFFER_CAPACITY):
+        threading.Thread.__init__(self, name="FingertappingWriter", daemon=True)
+        self.file_name = file_name
+        self.ft_round = ft_round
+        self.correct_sequence = correct_sequence
+        self.participant_ID = participant_ID
+        self.store = store
+        self._stored = False
+
+        # Preallocated buffer, filled by add and written up to _written
+        self._keys = np.zeros(capacity, dtype=np.uint8)
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._count = 0
+        self._written = 0
+        # Lock for growing the buffer while it is read
+        self._buffer_lock = threading.Lock()
+        # Lock for writing to the file (thread and exit handler)
+        self._file_lock = threading.Lock()
+        self._flush_event = threading.Event()
+
+        # Flag for stopping the thread
+        self.stop_flag = False
+
+        atexit.register(self.close)
+
+    def add(self, key, key_time):
+        """
+        Adds a key press to the buffer. No I/O happens here.
+
+        Parameters
+        ----------
+        key : int
+            The pressed key (1-4).
+        key_time : float
+            The time of the key press in seconds from the sequence onset.
+        """
+        if self._count == len(self._keys):
+            with self._buffer_lock:
+                self._keys = np.concatenate([self._keys, np.zeros_like(self._keys)])
+                self._times = np.concatenate([self._times, np.zeros_like(self._times)])
+        self._keys[self._count] = key
+        self._times[self._count] = key_time
+        # Increment last, such that the row is complete when it is read
+        self._count += 1
+
+    def run(self):
+        """Starts the thread."""
+        realtime.release_thread()
+        while not self.stop_flag:
+            self._flush_event.wait(FLUSH_INTERVAL_SEC)
+            self.flush()
+
+    def flush(self):
+        """Appends the rows that are not written yet to the file."""
+        with self._file_lock:
+            count = self._count
+            if count == self._written:
+                return
+            with self._buffer_lock:
+                keys = self._keys[self._written:count].tolist()
+                times = self._times[self._written:count].tolist()
+
+            write_header = not os.path.exists(self.file_name) or os.path.getsize(self.file_name) == 0
+            with open(self.file_name, 'a', newline='') as file:
+                writer = csv.writer(file)
+                if write_header:
+                    writer.writerow(FINGERTAPPING_HEADER)
+                writer.writerows([(key, key_time, self.ft_round, self.correct_sequence, self.participant_ID)
+                                  for key, key_time in zip(keys, times)])
+            self._written = count
+
+    def close(self):
+        """Stops the thread and writes the remaining rows."""
+        self.stop_flag = True
+        self._flush_event.set()
+        if self.is_alive():
+            self.join(THREAD_JOIN_TIMEOUT_SEC)
+        self.flush()
+        if self.store is not None and not self._stored:
+            self.store.write_round(self.participant_ID, self.ft_round, self.correct_sequence,
+                                   self._keys[:self._count], self._times[:self._count])
+            self._stored = True
+        atexit.unregister(self.close)
+
+    def __len__(self):
+        return self._count
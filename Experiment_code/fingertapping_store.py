@@ -0,0 +1,242 @@
+"""
+Columnar storage for the fingertapping data.
+- FingertappingStore: stores every participant's key presses as typed columns in
+  one .npz file, with an index of the rows of every participant and round
+- convert_csv_files: imports the existing fingertapping CSV files into a store
+
+Usage for converting the CSV files of the follow-up study:
+    python fingertapping_store.py Fingertapping_Data_followUp
+"""
+
+import csv, glob, os, sys
+import numpy as np
+
+COLUMNS = {'key': np.uint8,
+           'time': np.float64,
+           'round': np.uint8,
+           'sequence': np.uint16,
+           'participant': np.uint32}
+# Columns of the store and their types
+
+INDEX_FILE_NAME = 'index.npz'
+# File that holds the row ranges of every participant and round
+
+
+class FingertappingStore():
+    """
+    Stores the fingertapping data as typed columns.
+
+    Every participant has one file ``participant_<ID>.npz`` with the columns in
+    ``COLUMNS``, sorted by round. The index file lists for every participant
+    and round the rows [start, stop) in the participant's file, such that a
+    participant or a round can be loaded without reading anything else.
+
+    A round is written to the participant's file first and then to the index,
+    each file replaced at once. If the program stops between the two, the
+    participant's file is not older than the index and its entries are rebuilt
+    when the store is opened.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the store. It is created if it does not exist.
+
+    Attributes
+    ----------
+    directory : str
+        Stores the directory of the store.
+    index : dict
+        Arrays 'participant', 'round', 'start' and 'stop' with one entry per
+        participant and round.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = self._load_index()
+        self._repair_index()
+
+    def participants(self):
+        """Returns the IDs of all participants in the store."""
+        return np.unique(self.index['participant'])
+
+    def rounds(self, participant_ID):
+        """Returns the fingertapping rounds stored for a participant."""
+        return self.index['round'][self.index['participant'] == int(participant_ID)]
+
+    def write_round(self, participant_ID, ft_round, sequence, keys, times):
+        """
+        Stores the key presses of one fingertapping round. A round that is
+        already stored for the participant is replaced.
+
+        Parameters
+        ----------
+        participant_ID : int
+            The ID of the participant.
+        ft_round : int
+            The number of the fingertapping round.
+        sequence : str or int
+            The sequence shown on the screen, e.g. '23142'.
+        keys : array_like
+            The pressed keys (1-4).
+        times : array_like
+            The times of the key presses in seconds from the sequence onset.
+        """
+        participant_ID = int(participant_ID)
+        keys = np.asarray(keys, dtype=COLUMNS['key'])
+        new_round = {'key': keys,
+                     'time': np.asarray(times, dtype=COLUMNS['time']),
+                     'round': np.full(len(keys), ft_round, dtype=COLUMNS['round']),
+                     'sequence': np.full(len(keys), int(sequence), dtype=COLUMNS['sequence']),
+                     'participant': np.full(len(keys), participant_ID, dtype=COLUMNS['participant'])}
+
+        # Keep the other rounds of the participant and sort by round
+        data = self._read_participant(participant_ID)
+        keep = data['round'] != ft_round
+        data = {name: np.concatenate([data[name][keep], new_round[name]]) for name in COLUMNS}
+        order = np.argsort(data['round'], kind='stable')
+        data = {name: column[order] for name, column in data.items()}
+
+        self._write_file(self._participant_file(participant_ID), data)
+        self._update_index(participant_ID, data['round'])
+
+    def load(self, participant_ID=None, ft_round=None):
+        """
+        Loads the key presses of the store.
+
+        Parameters
+        ----------
+        participant_ID : int
+            Only load this participant, or all participants if None.
+        ft_round : int
+            Only load this fingertapping round, or all rounds if None.
+
+        Returns
+        -------
+        dict
+            One array per column in ``COLUMNS``.
+        """
+        selected = np.ones(len(self.index['participant']), dtype=bool)
+        if participant_ID is not None:
+            selected &= self.index['participant'] == int(participant_ID)
+        if ft_round is not None:
+            selected &= self.index['round'] == ft_round
+
+        parts = {name: [] for name in COLUMNS}
+        for participant in np.unique(self.index['participant'][selected]):
+            rows = selected & (self.index['participant'] == participant)
+            with np.load(self._participant_file(participant)) as data:
+                columns = {name: data[name] for name in COLUMNS}
+            for start, stop in zip(self.index['start'][rows], self.index['stop'][rows]):
+                for name in COLUMNS:
+                    parts[name].append(columns[name][start:stop])
+
+        return {name: np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=dtype)
+                for name, dtype in COLUMNS.items()}
+
+    def _participant_file(self, participant_ID):
+        return os.path.join(self.directory, 'participant_%i.npz' % participant_ID)
+
+    def _read_participant(self, participant_ID):
+        file_name = self._participant_file(participant_ID)
+        if not os.path.exists(file_name):
+            return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        with np.load(file_name) as data:
+            return {name: data[name] for name in COLUMNS}
+
+    def _load_index(self):
+        file_name = os.path.join(self.directory, INDEX_FILE_NAME)
+        if not os.path.exists(file_name):
+            return {'participant': np.zeros(0, dtype=np.uint32),
+                    'round': np.zeros(0, dtype=np.uint8),
+                    'start': np.zeros(0, dtype=np.int64),
+                    'stop': np.zeros(0, dtype=np.int64)}
+        with np.load(file_name) as index:
+            return {name: index[name] for name in index.files}
+
+    def _repair_index(self):
+        """Rebuilds the index entries of the participant files that were written after the index."""
+        index_file_name = os.path.join(self.directory, INDEX_FILE_NAME)
+        index_time = os.path.getmtime(index_file_name) if os.path.exists(index_file_name) else None
+        for file_name in glob.glob(os.path.join(self.directory, 'participant_*.npz')):
+            if index_time is None or os.path.getmtime(file_name) >= index_time:
+                participant_ID = int(os.path.basename(file_name)[len('participant_'):-len('.npz')])
+                self._update_index(participant_ID, self._read_participant(participant_ID)['round'])
+
+    def _update_index(self, participant_ID, rounds):
+        """Replaces the index entries of a participant by the round ranges of ``rounds``."""
+        rounds_stored, start = np.unique(rounds, return_index=True)
+        stop = np.append(start[1:], len(rounds))
+
+        keep = self.index['participant'] != participant_ID
+        self.index = {'participant': np.concatenate([self.index['participant'][keep],
+                                                     np.full(len(start), participant_ID, dtype=np.uint32)]),
+                      'round': np.concatenate([self.index['round'][keep], rounds_stored.astype(np.uint8)]),
+                      'start': np.concatenate([self.index['start'][keep], start.astype(np.int64)]),
+                      'stop': np.concatenate([self.index['stop'][keep], stop.astype(np.int64)])}
+        self._write_file(os.path.join(self.directory, INDEX_FILE_NAME), self.index)
+
+    def _write_file(self, file_name, arrays):
+        """Writes the arrays to a temporary file first, such that a crash cannot leave a broken file."""
+        temp_file_name = file_name + '.tmp'
+        with open(temp_file_name, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temp_file_name, file_name)
+
+
+def convert_csv_files(csv_file_names, store):
+    """
+    Imports fingertapping CSV files into a store. Repeated header rows (e.g.
+    from a re-run first round) are skipped. If a round was run more than once,
+    the last run replaces the earlier ones. A new run starts after a header
+    row, when the round or the sequence changes, or when the time of the key
+    presses goes back.
+
+    Parameters
+    ----------
+    csv_file_names : list
+        The CSV files with the columns KeysPressed, StartTappingTime,
+        FingertappingRound, CorrectSequence and ParticipantID.
+    store : FingertappingStore
+        The store to write to.
+
+    Returns
+    -------
+    int
+        The number of key presses written to the store, without those of
+        replaced runs.
+    """
+    rounds = {}
+    for csv_file_name in csv_file_names:
+        previous = None
+        with open(csv_file_name, newline='') as file:
+            for row in csv.reader(file):
+                if not row or row[0] == 'KeysPressed':
+                    previous = None
+                    continue
+                key = (int(row[4]), int(row[2]))
+                key_time = float(row[1])
+                if previous is None or previous[:2] != (key, row[3]) or key_time < previous[2]:
+                    rounds[key] = (row[3], [], [])
+                sequence, keys, times = rounds[key]
+                keys.append(int(row[0]))
+                times.append(key_time)
+                previous = (key, row[3], key_time)
+
+    n_rows = 0
+    for (participant_ID, ft_round), (sequence, keys, times) in rounds.items():
+        store.write_round(participant_ID, ft_round, sequence, keys, times)
+        n_rows += len(keys)
+    return n_rows
+
+
+def main():
+    """Converts all fingertapping CSV files of a directory into a store in its subdirectory 'store'."""
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'Fingertapping_Data_followUp'
+    csv_file_names = sorted(glob.glob(os.path.join(directory, '*.csv')))
+    store = FingertappingStore(os.path.join(directory, 'store'))
+    n_rows = convert_csv_files(csv_file_names, store)
+    print('Converted %i key presses from %i files into %s' % (n_rows, len(csv_file_names), store.directory))
+
+if __name__ == "__main__":
+    main()
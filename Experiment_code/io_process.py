@@ -0,0 +1,444 @@
+"""
+Belt and trigger output in a separate process.
+- CommandRing: a single-producer single-consumer ring buffer of fixed-size
+  command records in shared memory
+- run_io_process: the main loop of the I/O process, which owns the
+  BeltController and the parallel port and runs every command at its deadline
+- IOProcessClient: starts the I/O process and sends it commands from the
+  stimulus process
+- TriggerPort: stands in for classicbelt.p in the stimulus process, such that
+  the existing setData calls are sent to the I/O process
+
+With the I/O process, garbage collection or a stalled flip in the stimulus
+process cannot delay a vibration onset and the belt's listener threads do not
+compete with the rendering for the GIL. The commands of a vibrotactile block
+are sent ahead with their deadlines, the triggers set on a flip are sent
+without deadline and run as soon as the I/O process reads them.
+
+Both processes compare times of time.perf_counter(), which is a system-wide
+monotonic clock on Windows and Linux.
+"""
+
+import os, subprocess, sys, threading, time
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import parallel
+from pybelt import classicbelt
+import scheduler
+import console
+
+RING_CAPACITY = 1024
+# Number of commands the ring buffer holds
+
+LEAD_TIME = 0.05
+# Time in seconds between the start of a vibrotactile block and its first
+# deadline, such that the first commands reach the I/O process in time
+
+IDLE_SLEEP = 0.0
+# Time the I/O process sleeps when no command is due. 0 only yields the CPU,
+# such that a trigger is written within microseconds; the process then needs
+# a core of its own.
+
+PROCESS_JOIN_TIMEOUT_SEC = 10.0
+# Timeout to wait for the I/O process to disconnect the belt and terminate
+
+CONNECT_TIMEOUT_SEC = 30.0
+# Timeout to wait for the belt connection in the I/O process
+
+TRIGGER_PULSE = 0.01
+# Length of a trigger pulse in seconds
+
+RECORD_DTYPE = np.dtype([('deadline', np.float64),
+                         ('sent', np.float64),
+                         ('executed', np.float64),
+                         ('command', np.uint8),
+                         ('value', np.int16),
+                         ('position', np.int16),
+                         ('intensity', np.int16)])
+# A command: its deadline (0 to run it at once), the time it was sent and
+# the time it was executed (only in the result ring), and its arguments
+
+SET_DATA = 1
+VIBRATE = 2
+STOP_VIBRATION = 3
+CONNECT = 4
+DISCONNECT = 5
+SHUTDOWN = 6
+# Commands of the I/O process. value is the trigger code of SET_DATA and
+# VIBRATE, and 1 in the result of CONNECT if the belt is connected.
+
+
+class CommandRing():
+    """
+    A ring buffer of RECORD_DTYPE records in shared memory for one producer
+    and one consumer.
+
+    The first three uint64 of the memory count the records written, read and
+    dropped. Only the producer increments the write and the drop count and
+    only the consumer the read count, in both cases after the record is
+    complete, thus no lock is needed.
+
+    Parameters
+    ----------
+    name : str
+        The name of an existing ring to attach to, or None to create a new one.
+    capacity : int
+        The number of records of a new ring.
+
+    Attributes
+    ----------
+    name : str
+        The name of the shared memory, used to attach to the ring in the other process.
+    capacity : int
+        The number of records the ring holds.
+    """
+
+    def __init__(self, name=None, capacity=RING_CAPACITY):
+        header = 3 * np.dtype(np.uint64).itemsize
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=header + capacity * RECORD_DTYPE.itemsize)
+            self._memory.buf[:header] = bytes(header)
+            self._owner = True
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix':
+                # Only the process that created the ring removes it
+                resource_tracker.unregister(self._memory._name, 'shared_memory')
+            capacity = (self._memory.size - header) // RECORD_DTYPE.itemsize
+            self._owner = False
+        self.name = self._memory.name
+        self.capacity = capacity
+        self._counts = np.ndarray(3, dtype=np.uint64, buffer=self._memory.buf[:header])
+        self._records = np.ndarray(capacity, dtype=RECORD_DTYPE, buffer=self._memory.buf[header:])
+
+    def put(self, command, deadline=0.0, value=0, position=0, intensity=0, executed=0.0, sent=None):
+        """
+        Writes a record. Waits while the ring is full.
+
+        Parameters
+        ----------
+        command : int
+            One of the commands (SET_DATA, VIBRATE, ...).
+        deadline : float
+            The time of time.perf_counter() at which to run the command, 0 to
+            run it at once.
+        value, position, intensity : int
+            The arguments of the command.
+        executed : float
+            The time the command was run (only for results).
+        sent : float
+            The time the command was sent, None for now.
+        """
+        while not self.put_nowait(command, deadline, value, position, intensity, executed, sent, count_drop=False):
+            time.sleep(IDLE_SLEEP)
+
+    def put_nowait(self, command, deadline=0.0, value=0, position=0, intensity=0, executed=0.0, sent=None,
+                   count_drop=True):
+        """
+        Writes a record if the ring is not full, see put.
+
+        Returns
+        -------
+        bool
+            False if the ring is full and the record was dropped (and counted
+            in ``dropped`` if count_drop is True).
+        """
+        written = int(self._counts[0])
+        if written - int(self._counts[1]) >= self.capacity:
+            if count_drop:
+                self._counts[2] += 1
+            return False
+        self._records[written % self.capacity] = (deadline, time.perf_counter() if sent is None else sent,
+                                                  executed, command, value, position, intensity)
+        self._counts[0] = written + 1
+        return True
+
+    @property
+    def dropped(self):
+        """The number of records put_nowait dropped because the ring was full."""
+        return int(self._counts[2])
+
+    def get(self):
+        """Returns the next record or None if the ring is empty."""
+        read = int(self._counts[1])
+        if read == int(self._counts[0]):
+            return None
+        record = self._records[read % self.capacity].copy()
+        self._counts[1] = read + 1
+        return record
+
+    def close(self):
+        """Releases the shared memory. The ring that created it also removes it."""
+        del self._counts, self._records
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+def _execute(record, belt_controller, port, gap_trigger=0):
+    """Runs one command in the I/O process. Returns the value of its result."""
+    command = record['command']
+    if command == SET_DATA:
+        port.setData(int(record['value']))
+    elif command == VIBRATE:
+        if gap_trigger and belt_controller.getBeltConnectionState() != classicbelt.BeltConnectionState.CONNECTED:
+            # Mark the vibration the reconnecting belt cannot play in the EEG
+            port.setData(gap_trigger)
+            time.sleep(TRIGGER_PULSE)
+            port.setData(0)
+        belt_controller.vibrateAtPositions([int(record['position'])], int(record['value']), 1,
+                                           int(record['intensity']))
+    elif command == STOP_VIBRATION:
+        belt_controller.stopVibration()
+    elif command == CONNECT:
+        belt_controller.connectBeltSerial()
+        return int(belt_controller.getBeltConnectionState() == classicbelt.BeltConnectionState.CONNECTED)
+    elif command == DISCONNECT:
+        belt_controller.disconnectBelt()
+    return 0
+
+
+def _watch_parent(parent_gone):
+    """Sets the event when the standard input, a pipe from the stimulus process, is closed."""
+    try:
+        while sys.stdin.buffer.read(1024):
+            pass
+    except (OSError, ValueError):
+        pass
+    parent_gone.set()
+
+
+def run_io_process(command_ring_name, result_ring_name, belt_watchdog=False, gap_trigger=0):
+    """
+    The main loop of the I/O process. Runs the commands of the command ring at
+    their deadlines and writes every executed command to the result ring.
+    The loop never waits for the result ring: a result that does not fit is
+    dropped and counted, only the result of CONNECT, which the client waits
+    for, is written in any case.
+
+    Parameters
+    ----------
+    command_ring_name : str
+        The name of the ring the stimulus process sends the commands to.
+    result_ring_name : str
+        The name of the ring that receives the executed commands.
+    belt_watchdog : bool
+        Reconnects the belt automatically when the connection is lost.
+    gap_trigger : int
+        The trigger code sent instead of a vibration that the belt cannot
+        play while it reconnects, 0 for none.
+
+    The loop also ends when the standard input is closed, i.e. when the
+    stimulus process terminated without sending SHUTDOWN, such that the
+    belt and the ports are released for the next session.
+    """
+    parent_gone = threading.Event()
+    threading.Thread(target=_watch_parent, args=(parent_gone,), name='ParentWatcher', daemon=True).start()
+    commands = CommandRing(command_ring_name)
+    results = CommandRing(result_ring_name)
+    port = parallel.Parallel()
+    # The belt controller sets its triggers on the port of this process
+    classicbelt.p = port
+    belt_controller = classicbelt.BeltController()
+    belt_controller.enableWatchdog(belt_watchdog)
+
+    try:
+        while not parent_gone.is_set():
+            record = commands.get()
+            if record is None:
+                time.sleep(IDLE_SLEEP)
+                continue
+            if record['command'] == SHUTDOWN:
+                break
+            if record['deadline'] > 0:
+                scheduler.sleep_until(record['deadline'])
+            executed = time.perf_counter()
+            value = _execute(record, belt_controller, port, gap_trigger)
+            put = results.put if record['command'] == CONNECT else results.put_nowait
+            put(record['command'], record['deadline'], value if record['command'] == CONNECT else
+                record['value'], record['position'], record['intensity'], executed, record['sent'])
+    finally:
+        if belt_controller.getBeltConnectionState() != classicbelt.BeltConnectionState.DISCONNECTED:
+            belt_controller.disconnectBelt(True)
+        port.setData(0)
+        commands.close()
+        results.close()
+
+
+class IOProcessClient():
+    """
+    Starts the I/O process and sends it the belt and trigger commands.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of commands the rings hold.
+    belt_watchdog : bool
+        Reconnects the belt in the I/O process when the connection is lost.
+    gap_trigger : int
+        The trigger code of a vibration lost while the belt reconnects, 0 for none.
+
+    Attributes
+    ----------
+    commands : CommandRing
+        The ring the commands are sent to.
+    results : CommandRing
+        The ring the I/O process writes the executed commands to.
+    process : Popen
+        The I/O process.
+    lateness : list
+        How late the commands executed since the last report were run, in seconds.
+        The results are read whenever a trigger is sent, such that the
+        triggers of the visual blocks do not fill the result ring.
+    """
+
+    def __init__(self, capacity=RING_CAPACITY, belt_watchdog=False, gap_trigger=0):
+        self.belt_watchdog = belt_watchdog
+        self.gap_trigger = gap_trigger
+        self.commands = CommandRing(capacity=capacity)
+        self.results = CommandRing(capacity=capacity)
+        self.process = None
+        self.lateness = []
+        self._dropped = 0
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts the I/O process. It runs this file as a script, such that it
+        neither inherits the window and the belt threads nor imports the
+        experiment (and its parameter prompt) again.
+
+        The standard input of the process is a pipe that is only closed when
+        this process terminates, which stops the I/O process if it was not
+        stopped.
+        """
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                         self.commands.name, self.results.name,
+                                         str(int(self.belt_watchdog)), str(self.gap_trigger)],
+                                        stdin=subprocess.PIPE)
+
+    def stop(self):
+        """
+        Stops the I/O process, which disconnects the belt, and releases the
+        rings. Calling it again does nothing.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        if self.process is not None and self.process.poll() is None:
+            self.commands.put(SHUTDOWN)
+            self.process.stdin.close()
+            try:
+                self.process.wait(PROCESS_JOIN_TIMEOUT_SEC)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.commands.close()
+        self.results.close()
+
+    def set_data(self, code, deadline=0.0):
+        """Sets the trigger port at the deadline, or at once."""
+        self.commands.put(SET_DATA, deadline, value=code)
+        self._read_results()
+
+    def pulse(self, code, deadline):
+        """Sends a trigger pulse of TRIGGER_PULSE seconds starting at the deadline."""
+        self.set_data(code, deadline)
+        self.set_data(0, deadline + TRIGGER_PULSE)
+
+    def vibrate(self, position, intensity, trigger_code, deadline):
+        """Starts a vibration at the deadline, see BeltController.vibrateAtPositions."""
+        self.commands.put(VIBRATE, deadline, value=trigger_code, position=position, intensity=intensity)
+
+    def stop_vibration(self, deadline):
+        """Stops the vibration at the deadline."""
+        self.commands.put(STOP_VIBRATION, deadline)
+
+    def connect(self):
+        """
+        Connects the belt in the I/O process and waits for the connection.
+
+        Returns
+        -------
+        bool
+            True if the belt is connected.
+        """
+        self.commands.put(CONNECT)
+        end = time.perf_counter() + CONNECT_TIMEOUT_SEC
+        while time.perf_counter() < end and self.process.poll() is None:
+            record = self.results.get()
+            if record is None:
+                time.sleep(0.01)
+            elif record['command'] == CONNECT:
+                return bool(record['value'])
+            else:
+                self._add_result(record)
+        return False
+
+    def disconnect(self):
+        """Disconnects the belt in the I/O process."""
+        self.commands.put(DISCONNECT)
+
+    def trigger_port(self):
+        """Returns a TriggerPort that sends setData calls to the I/O process."""
+        return TriggerPort(self)
+
+    def _add_result(self, record):
+        self.lateness.append(record['executed'] - max(record['deadline'], record['sent']))
+
+    def _read_results(self):
+        record = self.results.get()
+        while record is not None:
+            self._add_result(record)
+            record = self.results.get()
+
+    def report_args(self):
+        """
+        Reads the executed commands and returns the format and the arguments
+        of a line describing how late they were run, such that a logger
+        formats it in the console thread: log.info(*client.report_args()).
+        Commands without deadline count from the moment they were sent.
+        """
+        self._read_results()
+        dropped = self.results.dropped - self._dropped
+        self._dropped += dropped
+        if not self.lateness:
+            return ('I/O process: no commands executed',)
+        lateness = np.array(self.lateness) * 1000
+        self.lateness = []
+        return ('I/O process: %i commands, lateness mean %.3f ms, max %.3f ms, %i results dropped',
+                len(lateness), lateness.mean(), lateness.max(), dropped)
+
+    def report(self):
+        """Reads the executed commands and returns the line of report_args."""
+        message, *args = self.report_args()
+        return message % tuple(args)
+
+
+class TriggerPort():
+    """
+    Stands in for the parallel port (classicbelt.p) in the stimulus process.
+    Every setData call is sent to the I/O process and runs there at once.
+
+    Parameters
+    ----------
+    client : IOProcessClient
+        The client of the I/O process.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def setData(self, data):
+        self.client.set_data(data)
+
+
+def main():
+    """
+    Runs the I/O process with the rings, the watchdog flag and the gap
+    trigger given on the command line (see IOProcessClient.start).
+    """
+    console.start_console()
+    run_io_process(sys.argv[1], sys.argv[2], sys.argv[3] == '1', int(sys.argv[4]))
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,69 @@
+import os, sys
 from psychopy import logging
+import config
+import console
 # Important parameters defined for the main experiment
+# The values are loaded from the defaults in config.py, a configuration file,
+# EEGTACTILE_* environment variables and --name=value command line arguments
+# (see config.py). The participant ID is only asked for if none is configured.
 
-participant_ID = input('Please enter the participant ID: ') # e.g. 38
-fingertapping_file_name = 'Fingertapping_Data_followUp/EEGtactileFollowUp_Fingertapping_participant_' + str(participant_ID) + '.csv'
+settings = config.load_config(overrides=config.parse_overrides(sys.argv[1:]))
+
+participant_ID = settings['participant_ID'] # e.g. 38
+if participant_ID is None:
+    participant_ID = config.prompt_participant_ID()
+output_directory = settings['output_directory'] # prefix of all data files, '' for the working directory
+fingertapping_file_name = os.path.join(output_directory, 'Fingertapping_Data_followUp/EEGtactileFollowUp_Fingertapping_participant_' + str(participant_ID) + '.csv')
+fingertapping_store_directory = os.path.join(output_directory, 'Fingertapping_Data_followUp/store')
+session_file_name = os.path.join(output_directory, 'Session_Data_followUp/EEGtactileFollowUp_Session_participant_' + str(participant_ID) + '.npz')
+block_order_file_name = os.path.join(output_directory, 'Session_Data_followUp/block_orders.npz') # cache of the counterbalanced block orders
+timeline_file_name = os.path.join(output_directory, 'Session_Data_followUp/EEGtactileFollowUp_Timeline_participant_' + str(participant_ID) + '.csv')
+checkpoint_file_name = os.path.join(output_directory, 'Session_Data_followUp/EEGtactileFollowUp_Checkpoint_participant_' + str(participant_ID) + '.json') # state of the session after every block, to resume it
+trace_file_name = os.path.join(output_directory, 'Session_Logs_followUp/EEGtactileFollowUp_Trace_participant_' + str(participant_ID) + '.json') # Chrome trace of the session if profiling is on
+session_log_file_name = os.path.join(output_directory, 'Session_Logs_followUp/EEGtactileFollowUp_Session_participant_' + str(participant_ID) + '.log')
 
 # logging
-#filename = 'EEG_tactile_logging'
-#logFile = logging.LogFile(filename + '.log', level=logging.EXP)
+# The session log stores the refresh rate and the frame statistics of every trial
+os.makedirs(os.path.dirname(session_log_file_name), exist_ok=True)
+logFile = logging.LogFile(session_log_file_name, level=logging.EXP)
 logging.console.setLevel(logging.CRITICAL) # this outputs to the screen, not a file
+# The console output of the experiment is written by a background thread (see console.py)
+console.start_console(settings['console_level'])
 
-trials = 20 #200
-oddball_ratio = 0.3
-trial_break = 0.7
-trial_length = 0.8
+trials = settings['trials'] #200
+oddball_ratio = settings['oddball_ratio']
+random_seed = settings['random_seed'] # seed of the trial sequences, None uses the participant ID
+max_oddball_run = settings['max_oddball_run'] # maximum number of consecutive oddballs, None for unconstrained sequences
+min_standards_after = settings['min_standards_after'] # minimum number of standards after every oddball run
+trial_break = settings['trial_break']
+trial_length = settings['trial_length']
+frame_locked = settings['frame_locked'] # count stimulus durations in frames of the measured refresh rate
+io_process = settings['io_process'] # run the belt and trigger output in a separate process (see io_process.py)
+profiling = settings['profiling'] # record the calls of the session as spans in trace_file_name (see profiling.py)
+telemetry_port = settings['telemetry_port'] # serve live trial timing on http://localhost:<port>/ (see telemetry.py), None for off
+realtime = settings['realtime'] # real-time mode on Linux: no garbage collection in blocks, pinned cores, SCHED_FIFO, locked memory (see realtime.py)
+stimulus_cores = settings['stimulus_cores'] # cores of the stimulus thread in the real-time mode, [] for all
+io_cores = settings['io_cores'] # cores of the belt threads and the I/O process in the real-time mode, [] for all
+realtime_priority = settings['realtime_priority'] # SCHED_FIFO priority in the real-time mode (1-99), 0 keeps the normal scheduling
 
 # Parameters for the visual oddball task
-circle_colors = ["cyan", "pink"] # ["cyan", "pink"] in the swap condition cyan is the oddball color
+circle_colors = settings['circle_colors'] # ["cyan", "pink"] in the swap condition cyan is the oddball color
+cache_circle_stimuli = settings['cache_circle_stimuli'] # False creates a new circle in every trial (only to compare draw + flip times)
 
 # Parameters for the vibrotactile oddball task
-ankle_vibromotor = 12
-vibration_weak = 30
-vibration_strong = 100
+ankle_vibromotor = settings['ankle_vibromotor']
+vibration_weak = settings['vibration_weak']
+vibration_strong = settings['vibration_strong']
+belt_interface = settings['belt_interface'] # 'usb', 'bluetooth' or 'loopback' (belt emulator, see pybelt/transports.py)
+belt_name = settings['belt_name'] # Bluetooth name of the belt or a part of it, '' for any belt
+belt_watchdog = settings['belt_watchdog'] # reconnect the belt automatically when the connection is lost
+belt_gap_trigger = settings['belt_gap_trigger'] # trigger code of a vibration lost while the belt reconnects, 0 for none
 
 # Trigger codes (oddball, standard, break) for the 4 different blocks
-ankle_trigger = [9, 11, 12]
-ankle_swapped_trigger = [5, 7, 8]
-visual_trigger = [1, 3, 4]
-visual_swapped_trigger = [14, 13, 15]
+ankle_trigger = settings['ankle_trigger']
+ankle_swapped_trigger = settings['ankle_swapped_trigger']
+visual_trigger = settings['visual_trigger']
+visual_swapped_trigger = settings['visual_swapped_trigger']
 
 # "Translation" to the attached labels on the feelSpace belt:
 # variable above:attached label
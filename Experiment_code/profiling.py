@@ -0,0 +1,238 @@
+"""
+Profiling of a session as spans on a shared timeline of all threads.
+- SpanRecorder: a preallocated buffer of spans (name, start, end, thread)
+- Profiler: wraps the methods of the experiment, the belt controller and its
+  threads in spans, and removes the wrappers again
+- Profiler.save: exports the spans as Chrome trace JSON, which
+  chrome://tracing and https://ui.perfetto.dev open
+- Profiler.summary: the total time per span name
+
+Profiling is off by default (see the profiling setting in config.py). When
+it is off nothing is wrapped and the experiment runs unchanged; when it is on,
+every wrapped call costs two clock reads and one store in the buffer, about a
+microsecond.
+
+The spans of a session show, per thread, the blocks and trials of the main
+thread with their draw, flip, trigger, belt command, print and sleep calls,
+the packets handled by the SerialPortListener and the notifications of the
+BeltEventNotifier.
+"""
+
+import builtins, functools, itertools, json, logging, os, threading, time
+import numpy as np
+
+SPAN_CAPACITY = 1 << 20
+# Number of spans the buffer holds. Spans after the buffer is full are counted
+# but not stored.
+
+SCREEN_METHODS = ['show_instructions', 'show_ready_screen', 'start_fingertapping_screen', 'show_thank_you',
+                  'show_fixation_cross', 'visual_oddball', 'visual_swapped_oddball', 'present_trial',
+                  'present_frames', 'log_frame_statistics', 'report_block_timing', 'get_circle']
+# Methods of ScreenController that are wrapped in spans
+
+VIBRATION_METHODS = ['connect_to_USB', 'disconnect_belt', 'vibrotactile_oddball_ankle',
+                     'vibrotactile_swapped_oddball_ankle', 'start_trial', 'wait', 'finish_block']
+# Methods of VibrationController that are wrapped in spans
+
+BELT_METHODS = ['_send', 'vibrateAtPositions', 'stopVibration', '_handleDataReceived', '_handlePacketReceived',
+                'connectBeltSerial', 'disconnectBelt']
+# Methods of BeltController that are wrapped in spans. _handleDataReceived
+# runs in the SerialPortListener thread.
+
+NOTIFIER_METHODS = ['_notifyDelegate']
+# Methods of _BeltEventNotifier that are wrapped, they run in its thread
+
+
+class SpanRecorder():
+    """
+    A buffer of spans that any thread can write to.
+
+    The slot of a span is taken from an itertools.count, whose next() is
+    atomic, thus threads never write to the same slot and no lock is needed.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of spans the buffer holds.
+
+    Attributes
+    ----------
+    thread_names : dict
+        The name of every thread that recorded a span, by thread ident.
+    dropped : int
+        The number of spans that did not fit in the buffer.
+    """
+
+    def __init__(self, capacity=SPAN_CAPACITY):
+        self.capacity = capacity
+        self.thread_names = {}
+        self.dropped = 0
+        self._slots = [None] * capacity
+        self._counter = itertools.count()
+
+    def record(self, name, category, start, end, thread):
+        """Stores a span. start and end are times of time.perf_counter(), thread is the thread ident."""
+        index = next(self._counter)
+        if index < self.capacity:
+            self._slots[index] = (name, category, start, end, thread)
+        else:
+            self.dropped += 1
+        if thread not in self.thread_names:
+            self.thread_names[thread] = threading.current_thread().name
+
+    def spans(self):
+        """Returns the stored spans, in the order they ended."""
+        return [span for span in self._slots if span is not None]
+
+
+def _wrap(function, name, category, recorder):
+    """Returns a wrapper of the function that records every call as a span."""
+    perf_counter = time.perf_counter
+    get_ident = threading.get_ident
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recorder.record(name, category, start, perf_counter(), get_ident())
+
+    wrapper.profiled_function = function
+    return wrapper
+
+
+class Profiler():
+    """
+    Wraps the methods of a session in spans and exports them.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of spans the buffer holds.
+
+    Attributes
+    ----------
+    recorder : SpanRecorder
+        The buffer of the spans.
+    enabled : bool
+        True while the methods are wrapped.
+    """
+
+    def __init__(self, capacity=SPAN_CAPACITY):
+        self.recorder = SpanRecorder(capacity)
+        self.enabled = False
+        self._origin = time.perf_counter()
+        self._wrapped = []
+
+    def instrument(self, owner, names, category):
+        """
+        Wraps methods or functions of a class, an object or a module in spans.
+        Names that do not exist or are already wrapped are skipped.
+
+        Parameters
+        ----------
+        owner : class, object or module
+            Where the functions are looked up and replaced.
+        names : list
+            The names of the functions.
+        category : str
+            The category of the spans, e.g. 'screen' or 'belt'.
+        """
+        for name in names:
+            function = getattr(owner, name, None)
+            if function is None or not callable(function) or hasattr(function, 'profiled_function'):
+                continue
+            owner_name = getattr(owner, '__name__', type(owner).__name__)
+            in_dict = name in getattr(owner, '__dict__', {})
+            original = owner.__dict__[name] if in_dict else None
+            try:
+                setattr(owner, name, _wrap(function, '%s.%s' % (owner_name, name), category, self.recorder))
+            except (AttributeError, TypeError):
+                # e.g. objects of extension types without __dict__
+                continue
+            self._wrapped.append((owner, name, in_dict, original))
+
+    def enable(self):
+        """Wraps the controllers, the belt and its threads, the waits and print in spans."""
+        import visual_functions, vibrotactile_functions, scheduler
+        from pybelt import classicbelt
+        self.instrument(visual_functions.ScreenController, SCREEN_METHODS, 'screen')
+        self.instrument(vibrotactile_functions.VibrationController, VIBRATION_METHODS, 'belt')
+        self.instrument(classicbelt.BeltController, BELT_METHODS, 'serial')
+        self.instrument(classicbelt._BeltEventNotifier, NOTIFIER_METHODS, 'notifier')
+        self.instrument(scheduler, ['sleep_until'], 'wait')
+        for module in (visual_functions, vibrotactile_functions):
+            self.instrument(module.core, ['wait'], 'wait')
+        self.instrument(builtins, ['print'], 'print')
+        self.instrument(logging.Logger, ['_log'], 'print')
+        self.enabled = True
+
+    def instrument_experiment(self, experiment):
+        """
+        Wraps the objects an Experiment created: the flips of its window, the
+        draws of its stimuli and the trigger port.
+        """
+        screen = experiment.screen
+        self.instrument(screen.win, ['flip'], 'screen')
+        for value in list(vars(screen).values()):
+            for stim in (value.values() if isinstance(value, dict) else [value]):
+                if hasattr(stim, 'draw') and not isinstance(stim, type):
+                    self.instrument(stim, ['draw'], 'screen')
+        from pybelt import classicbelt
+        if getattr(classicbelt, 'p', None) is not None:
+            self.instrument(classicbelt.p, ['setData'], 'trigger')
+
+    def disable(self):
+        """Removes all wrappers."""
+        for owner, name, in_dict, original in reversed(self._wrapped):
+            if in_dict:
+                setattr(owner, name, original)
+            else:
+                delattr(owner, name)
+        self._wrapped = []
+        self.enabled = False
+
+    def trace_events(self):
+        """Returns the spans as Chrome trace events, in microseconds from the creation of the profiler."""
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}}
+                  for thread, name in self.recorder.thread_names.items()]
+        for name, category, start, end, thread in self.recorder.spans():
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread,
+                           'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6})
+        return events
+
+    def save(self, file_name):
+        """Writes the spans as Chrome trace JSON."""
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_name, 'w') as file:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms',
+                       'otherData': {'dropped_spans': self.recorder.dropped}}, file)
+
+    def summary(self, top=15):
+        """
+        Returns a table of the span names with the largest total time.
+
+        Nested spans count for each level, e.g. a flip counts for the flip and
+        for the trial it belongs to.
+        """
+        spans = self.recorder.spans()
+        if not spans:
+            return 'No spans recorded'
+        names = np.array([span[0] for span in spans])
+        durations = np.array([span[3] - span[2] for span in spans]) * 1000
+        unique, inverse = np.unique(names, return_inverse=True)
+        totals = np.bincount(inverse, weights=durations)
+        counts = np.bincount(inverse)
+        maxima = np.zeros(len(unique))
+        np.maximum.at(maxima, inverse, durations)
+        lines = ['%-52s %8s %12s %10s %10s' % ('span', 'calls', 'total ms', 'mean ms', 'max ms')]
+        for index in np.argsort(totals)[::-1][:top]:
+            lines.append('%-52s %8i %12.3f %10.4f %10.3f' % (unique[index], counts[index], totals[index],
+                                                            totals[index] / counts[index], maxima[index]))
+        if self.recorder.dropped:
+            lines.append('%i spans did not fit in the buffer' % self.recorder.dropped)
+        return '\n'.join(lines)
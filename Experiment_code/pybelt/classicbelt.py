@@ -6,18 +6,20 @@
 
 # Last update: 19.02.2019
 
-#import bluetooth # Bluetooth module from pyBluez
+from . import transports # Wireless transports, PyBluez is imported there
 import serial #@UnusedImport # PySerial for USB connection
 import serial.tools.list_ports
 import threading # For socket listener and event notifier
 import time # For timeouts
 import math # For fmod on float
 import queue
+from concurrent.futures import Future # For orientation requests
 from psychopy import core
 #import parallel
 import sys # Only for Python version
 from builtins import bytes # For Python 2.7/3 compatibility
 import traceback
+import logging # Console output through the queue of the experiment (see console.py)
 #from .. import parameter
 
 BELT_UUID = "00001101-0000-1000-8000-00805F9B34FB"
@@ -62,6 +64,42 @@ SERIAL_READ_TIMEOUT = 1.0
 SERIAL_LOOKUP_ACK_TIMEOUT = 2.0
 # Timeout to received the ACK during port testing
 
+KEEP_ALIVE_PROBE_SEC = 1.0
+# Silence of the belt after which the watchdog requests the firmware version,
+# such that a connected belt answers
+
+KEEP_ALIVE_TIMEOUT_SEC = 1.5
+# Silence of the belt after which the watchdog considers the connection lost
+
+WATCHDOG_PERIOD_SEC = 0.05
+# Period of the connection checks of the watchdog
+
+RECONNECT_READY_TIMEOUT_SEC = 0.5
+# Timeout for the belt to answer on a reopened serial port, and for the ACKs
+# of the handshake after reconnecting
+
+READY_POLL_INTERVAL_SEC = 0.05
+# Interval of the firmware requests that detect a ready belt on a reopened
+# serial port
+
+RECONNECT_RETRY_SEC = 0.1
+# Waiting time between two reconnection attempts
+
+ORIENTATION_MAX_AGE_SEC = 0.2
+# Default age in seconds up to which a received orientation is returned
+# without a new request
+
+ORIENTATION_TIMEOUT_SEC = 0.5
+# Timeout for the answer of an orientation request, after which the request
+# fails and the next caller sends a new one
+
+RECONNECT_GIVE_UP_SEC = 30.0
+# Time after the loss of the connection at which the watchdog stops
+# reconnecting and disconnects the belt
+
+_log = logging.getLogger(__name__)
+# Logger of the belt controller and its threads
+
 #p = parallel.Parallel()
 
 
@@ -145,14 +183,32 @@ class BeltController():
         self._default_vibration_intensity = None
         self._belt_heading = None
         self._belt_heading_offset = None
+        self._belt_heading_time = None
+        # Pending orientation request shared by its callers, and its send time
+        self._orientation_future = None
+        self._orientation_timer = None
+        self._orientation_lock = threading.Lock()
         # Variables for incoming packets
         self._incoming_packet = []
         self._incoming_packet_start_time = time.time();
         # Variables for ACK
         self._wait_ack_id = None
         self._wait_ack_event = threading.Event()
+        # Send times of the commands waiting for their ACK, and the last
+        # measured time between a command and its ACK
+        self._ack_send_times = {}
+        self._ack_latency = None
         # Lock for synchronizing output packets (avoid mix of packets)
         self._output_lock = threading.RLock()
+        # Connection watchdog (see enableWatchdog)
+        self._watchdog_enabled = False
+        self._watchdog = None
+        self._serial_port_name = None
+        self._last_data_time = time.perf_counter()
+        self._connection_lost = False
+        self._connection_lost_time = None
+        self._connection_lost_reason = None
+        self._connection_gaps = []
 
 
     def __del__(self):
@@ -164,11 +220,12 @@ class BeltController():
 
 
 
-    def connectBeltBT(self, address=None, name=None):
+    def connectBeltBT(self, address=None, name=None, transport='bluetooth'):
         """Connects a belt via BT.
 
-        Note that if no address is specified, the lookup procedure may take some
-        time (> 10 seconds).
+        If no address is specified, the address is taken from the cache of the
+        background discovery (see ``startBTDiscovery``). Only if no belt is
+        cached, the lookup waits for the discovery (several seconds).
 
         Parameters
         ----------
@@ -176,6 +233,10 @@ class BeltController():
             The Bluetooth address of the belt.
         :param str name:
             The name of the belt, or a part of the name.
+        :param str transport:
+            The name of the transport in ``transports.TRANSPORTS``:
+            'bluetooth', or 'loopback' for the belt emulator on a local
+            socket pair.
 
         Exception
         ---------
@@ -184,7 +245,7 @@ class BeltController():
         bluetooth communication occurs.
         """
         self._connect(_BeltConnectionInterface.BT_CLASSIC_INTERFACE,
-                      bt_name=name, bt_address=address)
+                      bt_name=name, bt_address=address, bt_transport=transport)
 
 
     def connectBeltSerial(self, port=None):
@@ -210,7 +271,7 @@ class BeltController():
 
 
     def _connect(self, connection_interface, serial_port_name=None,
-                 bt_address=None, bt_name=None):
+                 bt_address=None, bt_name=None, bt_transport='bluetooth'):
         """Connects to a belt with either USB or BT.
 
         Parameters
@@ -225,9 +286,12 @@ class BeltController():
         :param str bt_name:
             The Bluetooth device name if the connection must be established via
             Bluetooth.
+        :param str bt_transport:
+            The name of the transport if the connection must be established
+            via Bluetooth.
         """
         if connection_interface is None:
-            print("BeltController: No connection interface.")
+            _log.warning("BeltController: No connection interface.")
             return
         # Disconnect if necessary
         self.disconnectBelt(True)
@@ -244,16 +308,22 @@ class BeltController():
                 serial_port_name = findBeltSerialPort()
         elif (connection_interface ==
               _BeltConnectionInterface.BT_CLASSIC_INTERFACE):
+            transport = transports.TRANSPORTS.get(bt_transport)
+            if transport is None:
+                _log.warning("BeltController: Unknown transport.")
+                self.disconnectBelt(True)
+                return
             if bt_address is None:
-                bt_address = findBeltBTAddress(bt_name)
+                transport.startDiscovery(BT_LOOKUP_DURATION)
+                bt_address = transport.findAddress(bt_name)
         else:
-            print("BeltController: Unknown connection interface.")
+            _log.warning("BeltController: Unknown connection interface.")
             self.disconnectBelt(True)
             return
         # Connection
         if (connection_interface == _BeltConnectionInterface.USB_INTERFACE):
             if serial_port_name is None:
-                print("BeltController: No belt serial port found.")
+                _log.warning("BeltController: No belt serial port found.")
                 self.disconnectBelt(True)
                 return
             try:
@@ -269,25 +339,28 @@ class BeltController():
                 self._belt_listener = _SerialPortListener(self._serial_port,
                                                           self)
                 self._belt_listener.start()
+                # Port for reconnecting
+                self._serial_port_name = serial_port_name
             except Exception as e:
-                print("BeltController: Serial connection failed.")
-                print(str(e))
+                _log.warning("BeltController: Serial connection failed.")
+                _log.warning('%s', e)
                 self.disconnectBelt(True)
                 return
         elif (connection_interface ==
               _BeltConnectionInterface.BT_CLASSIC_INTERFACE):
             if bt_address is None:
-                print("BeltController: No Bluetooth device found.")
+                _log.warning("BeltController: No Bluetooth device found.")
                 self.disconnectBelt(True)
                 return
             try:
-                self._bt_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-                self._bt_socket.connect((bt_address, BELT_BT_COMM_PORT))
+                self._bt_socket = transport.open(bt_address, BELT_BT_COMM_PORT)
                 self._belt_listener = _BTSocketListener(self._bt_socket, self)
                 self._belt_listener.start()
             except:
-                print("BeltController: Bluetooth connection failed.")
-                traceback.print_exc()
+                _log.warning("BeltController: Bluetooth connection failed.")
+                _log.warning(traceback.format_exc())
+                # A cached address may be outdated
+                transport.forgetAddress(bt_address)
                 self.disconnectBelt(True)
                 return
         # Handshake
@@ -299,13 +372,62 @@ class BeltController():
             self._send(b'\x90\x09\xAA\xAA\xAA\x0A', True, 0xD0,
                        HANDSHAKE_TIMEOUT_SEC)
         except Exception as e:
-            print("BeltController: Handshake failed.")
-            print(str(e))
+            _log.warning("BeltController: Handshake failed.")
+            _log.warning('%s', e)
             self.disconnectBelt(True)
             return
         # Connection state
         self._belt_connection_state = BeltConnectionState.CONNECTED
         self._notifyConnectionState()
+        # Start watchdog
+        if (self._watchdog_enabled and
+            connection_interface == _BeltConnectionInterface.USB_INTERFACE):
+            self._startWatchdog()
+
+
+    def enableWatchdog(self, enabled=True):
+        """Enables or disables the watchdog of the serial connection.
+
+        The watchdog runs in its own thread while a belt is connected via
+        serial port. It considers the connection lost after a read or write
+        error, or when the belt stays silent for ``KEEP_ALIVE_TIMEOUT_SEC``
+        although it was asked for its firmware version. It then reopens the
+        cached serial port, detects that the belt answers instead of waiting
+        ``SERIAL_CONNECTION_INIT_WAIT``, repeats the handshake and switches
+        the belt back to the mode it had. Commands sent while reconnecting are
+        dropped. Every gap is logged and kept for ``getConnectionGaps``.
+
+        Parameters
+        ----------
+        :param bool enabled:
+            'True' to enable the watchdog. It starts with the next connection,
+            or at once if a belt is connected via serial port.
+        """
+        self._watchdog_enabled = enabled
+        if not enabled:
+            self._stopWatchdog()
+        elif (self._belt_connection_state == BeltConnectionState.CONNECTED and
+              self._serial_port is not None):
+            self._startWatchdog()
+
+
+    def _startWatchdog(self):
+        """Starts the watchdog thread if it is not running."""
+        if self._watchdog is None:
+            self._connection_lost = False
+            self._last_data_time = time.perf_counter()
+            self._watchdog = _ConnectionWatchdog(self)
+            self._watchdog.start()
+
+
+    def _stopWatchdog(self, join=False):
+        """Stops the watchdog thread."""
+        watchdog = self._watchdog
+        if watchdog is not None:
+            watchdog.stop_flag = True
+            if join and watchdog is not threading.current_thread():
+                watchdog.join(THREAD_JOIN_TIMEOUT_SEC)
+            self._watchdog = None
 
 
     def disconnectBelt(self, join=False):
@@ -323,9 +445,17 @@ class BeltController():
         self._belt_connection_state = BeltConnectionState.DISCONNECTING
         self._belt_mode = BeltMode.UNKNOWN
         self._notifyConnectionState()
+        # Stop watchdog
+        self._stopWatchdog(join)
         # Stop listener thread
         if (self._belt_listener is not None):
             self._belt_listener.stop_flag = True
+            if (self._bt_socket is not None):
+                try:
+                    # Wake up the listener blocked in recv
+                    self._bt_socket.shutdown(2)
+                except:
+                    pass
             if join:
                 self._belt_listener.join(THREAD_JOIN_TIMEOUT_SEC)
             self._belt_listener = None
@@ -334,7 +464,7 @@ class BeltController():
             try:
                 self._bt_socket.close()
             except:
-                print("BeltController: Failed to close BT socket.")
+                _log.warning("BeltController: Failed to close BT socket.")
             finally:
                 self._bt_socket = None
         # Close serial port
@@ -342,12 +472,17 @@ class BeltController():
             try:
                 self._serial_port.close()
             except:
-                print("BeltController: Failed to close serial port.")
+                _log.warning("BeltController: Failed to close serial port.")
             finally:
                 self._serial_port = None
         # Clear belt values
         self._belt_firm_version = None
         self._default_vibration_intensity = None
+        with self._orientation_lock:
+            self._belt_heading_time = None
+            self._failOrientationRequest(IOError(
+                "BeltController: Disconnected before the orientation was "+
+                "received."))
         # Set connection state
         self._belt_connection_state = BeltConnectionState.DISCONNECTED
         self._notifyBeltMode()
@@ -390,6 +525,60 @@ class BeltController():
             return self._belt_mode
 
 
+    def getAckLatency(self):
+        """Returns the time between the last acknowledged command and its
+        acknowledgment.
+
+        Return
+        ------
+            :rtype float
+            The latency in seconds, or None if no ACK has been received yet.
+        """
+        return self._ack_latency
+
+
+    def getOutputQueueDepth(self):
+        """Returns the number of bytes waiting in the output buffer of the
+        serial port.
+
+        Return
+        ------
+            :rtype int
+            The number of bytes, 0 without serial connection.
+        """
+        serial_port = self._serial_port
+        if serial_port is None:
+            return 0
+        try:
+            return serial_port.out_waiting
+        except Exception:
+            return 0
+
+
+    def getConnectionGaps(self):
+        """Returns the gaps of the connection that the watchdog closed.
+
+        Return
+        ------
+            :rtype list
+            A tuple per gap: the time the connection was lost and the time it
+            was restored, both of time.perf_counter().
+        """
+        return list(self._connection_gaps)
+
+
+    def getRecoveryTimes(self):
+        """Returns the time the watchdog needed to restore each lost
+        connection, from the detection of the loss to the replayed mode.
+
+        Return
+        ------
+            :rtype list
+            The recovery times in seconds.
+        """
+        return [restored - lost for lost, restored in self._connection_gaps]
+
+
     def getFirmwareVersion(self):
         """Returns the firmware version on the belt.
         The firmware version is only available when a belt is connected.
@@ -430,10 +619,10 @@ class BeltController():
         """
         # Check state and parameter
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to switch mode. No connection.")
+            _log.warning("BeltController: Unable to switch mode. No connection.")
             return
         if (belt_mode is None or belt_mode > 7 or belt_mode < 0):
-            print("BeltController: Unable to switch mode. Unknown belt mode.")
+            _log.warning("BeltController: Unable to switch mode. Unknown belt mode.")
             return
         if (belt_mode == self._belt_mode and not force_request):
             return
@@ -484,25 +673,25 @@ class BeltController():
         """
         # Check connection status
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         # Check parameters
         if self._belt_firm_version<30:
             if channel_idx<0 or channel_idx>1:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Illegal argument: channel_idx.")
                 return
             if pattern!=0:
-                print("BeltController: Unable to send the command. Illegal" +
+                _log.warning("BeltController: Unable to send the command. Illegal" +
                       " argument: pattern.")
                 return
         else:
             if channel_idx<0 or channel_idx>5:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Illegal argument: channel_idx.")
                 return
             if pattern<0:
-                print("BeltController: Unable to send the command. "+
+                _log.warning("BeltController: Unable to send the command. "+
                       "Illegal argument: pattern.")
                 return
         # Change mode
@@ -648,37 +837,37 @@ class BeltController():
         """
         # Check connection status
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         # Check parameters
         if self._belt_firm_version<30:
             if channel_idx<0 or channel_idx>1:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Illegal argument: channel_idx.")
                 return
             if pattern!=0:
-                print("BeltController: Unable to send the command. "+
+                _log.warning("BeltController: Unable to send the command. "+
                       "Illegal argument: pattern.")
                 return
             if len(indexes) < 1:
-                print("BeltController: Unable to send the command. "+
+                _log.warning("BeltController: Unable to send the command. "+
                       "Illegal argument: indexes.")
                 return
             if len(indexes) > 1 and channel_idx!=0:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Multiple positions are available only for channel 0.")
                 return
         else:
             if channel_idx<0 or channel_idx>5:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Illegal argument: channel_idx.")
                 return
             if pattern<0:
-                print("BeltController: Unable to send the command. "+
+                _log.warning("BeltController: Unable to send the command. "+
                       "Illegal argument: pattern.")
                 return
             if len(indexes) < 1:
-                print("BeltController: Unable to send the command. "+
+                _log.warning("BeltController: Unable to send the command. "+
                       "Illegal argument: indexes.")
                 return
         # Change mode
@@ -829,25 +1018,25 @@ class BeltController():
         """
         # Check connection status
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         # Check parameters
         if self._belt_firm_version<33:
-            print("BeltController: The belt firmware version is incompatible "+
+            _log.warning("BeltController: The belt firmware version is incompatible "+
                   "for this command. Pulse commands require a minimum "+
                   "firmware version of 33. Actual firmware version is: "+
                   str(self._belt_firm_version))
             return
         if channel_idx<0 or channel_idx>5:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Illegal argument: channel_idx.")
             return
         if on_duration_ms<0:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Illegal argument: on_duration_ms.")
             return
         if off_duration_ms<0:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Illegal argument: off_duration_ms.")
             return
         # Change mode
@@ -1021,29 +1210,29 @@ class BeltController():
         """
         # Check connection status
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         # Check parameters
         if self._belt_firm_version<33:
-            print("BeltController: The belt firmware version is incompatible"+
+            _log.warning("BeltController: The belt firmware version is incompatible"+
                   " for this command. Pulse commands require a minimum "+
                   "firmware version of 33. Actual firmware version is: "+
                   str(self._belt_firm_version))
             return
         if len(indexes) < 1:
-            print("BeltController: Unable to send the command. "+
+            _log.warning("BeltController: Unable to send the command. "+
                   "Illegal argument: indexes.")
             return
         if channel_idx<0 or channel_idx>5:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Illegal argument: channel_idx.")
             return
         if on_duration_ms<0:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Illegal argument: on_duration_ms.")
             return
         if off_duration_ms<0:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Illegal argument: off_duration_ms.")
             return
         # Change mode
@@ -1133,17 +1322,17 @@ class BeltController():
         not connected.
         """
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         # Check parameters
         if self._belt_firm_version<30:
             if channel_idx>1:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Illegal argument: channel_idx.")
                 return
         else:
             if channel_idx>5:
-                print("BeltController: Unable to send the command. " +
+                _log.warning("BeltController: Unable to send the command. " +
                       "Illegal argument: channel_idx.")
                 return
         # Send packet
@@ -1183,10 +1372,10 @@ class BeltController():
             BeltTimeoutException is raised.
         """
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         if self._belt_firm_version<34:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Orientation notifications are available only from "+
                   "firmware version 34.")
             return
@@ -1211,10 +1400,10 @@ class BeltController():
             BeltTimeoutException is raised.
         """
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         if self._belt_firm_version<34:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Orientation notifications are available only from "+
                   "firmware version 34.")
             return
@@ -1235,10 +1424,10 @@ class BeltController():
             in second position.
         """
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
-            print("BeltController: Unable to send the command. No connection.")
+            _log.warning("BeltController: Unable to send the command. No connection.")
             return
         if self._belt_firm_version<34:
-            print("BeltController: Unable to send the command. " +
+            _log.warning("BeltController: Unable to send the command. " +
                   "Orientation notifications are available only from "+
                   "firmware version 34.")
             return
@@ -1259,7 +1448,7 @@ class BeltController():
         if self._belt_connection_state != BeltConnectionState.CONNECTED:
             return None
         if self._belt_firm_version<34:
-            print("BeltController: Unable to know the belt orientation. " +
+            _log.warning("BeltController: Unable to know the belt orientation. " +
                   "Orientation notifications are available only from "+
                   "firmware version 34.")
             return
@@ -1269,6 +1458,99 @@ class BeltController():
         return orientation
 
 
+    def getOrientationFuture(self, max_age=ORIENTATION_MAX_AGE_SEC):
+        """Returns the orientation of the belt as a future, without waiting.
+
+        If the last orientation received is at most ``max_age`` seconds old,
+        the future is already resolved with it. Otherwise one orientation
+        request is sent and the future is resolved when the belt answers.
+        Callers during a pending request get the same future instead of
+        sending another request, thus concurrent callers never poll or flood
+        the belt with requests.
+
+        Example: ``heading, offset = belt.getOrientationFuture(0.1).result(1.0)``
+
+        Parameters
+        ----------
+        :param float max_age:
+            The age in seconds up to which the last orientation is fresh
+            enough.
+
+        Return
+        ------
+        :rtype Future:
+            A ``concurrent.futures.Future`` of the tuple (belt heading,
+            heading offset). It fails with an IOError if the belt is not
+            connected or does not support orientation requests, and with a
+            BeltTimeoutException if the belt does not answer within
+            ``ORIENTATION_TIMEOUT_SEC``.
+        """
+        with self._orientation_lock:
+            heading_time = self._belt_heading_time
+            if (heading_time is not None and
+                time.perf_counter()-heading_time <= max_age):
+                future = Future()
+                future.set_result((self._belt_heading,
+                                   self._belt_heading_offset))
+                return future
+            if self._orientation_future is not None:
+                return self._orientation_future
+            future = Future()
+            if self._belt_connection_state != BeltConnectionState.CONNECTED:
+                future.set_exception(IOError(
+                    "BeltController: Unable to request the orientation. "+
+                    "No connection."))
+                return future
+            if self._belt_firm_version<34:
+                future.set_exception(IOError(
+                    "BeltController: Unable to request the orientation. "+
+                    "Orientation requests are available only from firmware "+
+                    "version 34."))
+                return future
+            self._orientation_future = future
+            # Fails the request if the belt does not answer
+            self._orientation_timer = threading.Timer(
+                ORIENTATION_TIMEOUT_SEC, self._orientationTimeout, (future,))
+            self._orientation_timer.daemon = True
+            self._orientation_timer.start()
+        self._send(b'\x92\x02\x00\x00\x00\x0A', False, 0xD2)
+        return future
+
+
+    def _orientationTimeout(self, future):
+        """Fails an orientation request that is still pending after
+        ``ORIENTATION_TIMEOUT_SEC``. Runs in the timer thread.
+        """
+        with self._orientation_lock:
+            if self._orientation_future is future:
+                self._failOrientationRequest(BeltTimeoutException(
+                    "BeltController: Orientation not received."))
+
+
+    def _failOrientationRequest(self, exception):
+        """Fails the pending orientation request, if any. The orientation lock
+        must be held.
+        """
+        future = self._orientation_future
+        self._orientation_future = None
+        self._cancelOrientationTimer()
+        if future is not None:
+            try:
+                future.set_exception(exception)
+            except:
+                # Cancelled by a caller
+                pass
+
+
+    def _cancelOrientationTimer(self):
+        """Stops the timeout of the pending orientation request. The
+        orientation lock must be held.
+        """
+        if self._orientation_timer is not None:
+            self._orientation_timer.cancel()
+            self._orientation_timer = None
+
+
     def _adjustAngle(self, angle):
         """Adjusts an angle according to the offset and invert parameters.
 
@@ -1355,20 +1637,32 @@ class BeltController():
         the command acknowledgment.
         """
         if self._belt_connection_state == BeltConnectionState.DISCONNECTED:
-            print("BeltCOntroller: Cannot send command without connection.")
+            _log.warning("BeltCOntroller: Cannot send command without connection.")
             return
         if wait_ack and ack_id is not None:
             # Set ACK flag
             self._wait_ack_id = ack_id
             self._wait_ack_event.clear()
+        if ack_id is not None:
+            # Time of the command, to measure the ACK latency
+            self._ack_send_times[ack_id] = time.perf_counter()
         # Send packet
         with self._output_lock:
-            if self._bt_socket is not None:
-                # Send via BT
-                self._bt_socket.send(packet)
-            elif self._serial_port is not None:
-                # Send via serial port
-                self._serial_port.write(packet)
+            try:
+                if self._bt_socket is not None:
+                    # Send via BT
+                    self._bt_socket.send(packet)
+                elif self._serial_port is not None:
+                    # Send via serial port
+                    self._serial_port.write(packet)
+            except Exception as e:
+                if self._watchdog is None:
+                    raise
+                # The watchdog reconnects, the command is lost
+                _log.warning("BeltController: Unable to send the command. "+
+                      "Connection lost.")
+                self._connectionLost(str(e))
+                return
         # Wait ACK with timeout
         if wait_ack and ack_id is not None:
             if not self._wait_ack_event.is_set():
@@ -1381,6 +1675,106 @@ class BeltController():
             self._wait_ack_event.clear()
             self._wait_ack_id = None
 
+    def _connectionLost(self, reason):
+        """Marks the connection as lost, the watchdog reconnects the belt.
+
+        Parameters
+        ----------
+        :param str reason:
+            The description of the loss for the log.
+        """
+        if not self._connection_lost:
+            self._connection_lost_time = time.perf_counter()
+            self._connection_lost_reason = reason
+            self._connection_lost = True
+        # The request is lost with the connection
+        with self._orientation_lock:
+            self._failOrientationRequest(IOError(
+                "BeltController: Connection lost before the orientation was "+
+                "received."))
+
+
+    def _reconnect(self, watchdog):
+        """Reconnects the belt on the cached serial port after a lost
+        connection and restores its mode. Runs in the watchdog thread.
+
+        Parameters
+        ----------
+        :param _ConnectionWatchdog watchdog:
+            The watchdog, whose stop flag cancels the reconnection.
+        """
+        lost_time = self._connection_lost_time
+        belt_mode = self._belt_mode
+        _log.warning("BeltController: Connection lost (%s). Gap starts at "
+                     "%.3f s, reconnecting to %s.", self._connection_lost_reason,
+                     lost_time, self._serial_port_name)
+        self._belt_connection_state = BeltConnectionState.CONNECTING
+        self._notifyConnectionState()
+        with self._orientation_lock:
+            self._belt_heading_time = None
+            self._failOrientationRequest(IOError(
+                "BeltController: Connection lost before the orientation was "+
+                "received."))
+        # Release the lost port, its listener stops
+        if self._belt_listener is not None:
+            self._belt_listener.stop_flag = True
+            self._belt_listener = None
+        if self._serial_port is not None:
+            try:
+                self._serial_port.close()
+            except:
+                pass
+            self._serial_port = None
+        # Reopen the port until the belt answers
+        serial_port = None
+        give_up_time = lost_time + RECONNECT_GIVE_UP_SEC
+        while (serial_port is None and not watchdog.stop_flag and
+               time.perf_counter() < give_up_time):
+            try:
+                serial_port = _openReadySerialPort(self._serial_port_name,
+                                                   RECONNECT_READY_TIMEOUT_SEC)
+            except Exception:
+                serial_port = None
+            if serial_port is None:
+                time.sleep(RECONNECT_RETRY_SEC)
+        if watchdog.stop_flag:
+            if serial_port is not None:
+                serial_port.close()
+            return
+        if serial_port is None:
+            _log.warning("BeltController: Reconnection failed for %.0f s.",
+                         RECONNECT_GIVE_UP_SEC)
+            self.disconnectBelt()
+            return
+        self._incoming_packet = []
+        self._serial_port = serial_port
+        self._belt_listener = _SerialPortListener(serial_port, self)
+        self._belt_listener.start()
+        # Handshake, a failure is retried by the watchdog
+        try:
+            self._send(b'\x90\x08\xAA\xAA\xAA\x0A', True, 0xD0,
+                       RECONNECT_READY_TIMEOUT_SEC)
+            self._send(b'\x90\x02\xAA\xAA\xAA\x0A', True, 0xD0,
+                       RECONNECT_READY_TIMEOUT_SEC)
+            self._send(b'\x90\x09\xAA\xAA\xAA\x0A', True, 0xD0,
+                       RECONNECT_READY_TIMEOUT_SEC)
+        except Exception as e:
+            _log.warning("BeltController: Handshake after reconnection failed.")
+            _log.warning('%s', e)
+            return
+        self._connection_lost = False
+        self._belt_connection_state = BeltConnectionState.CONNECTED
+        self._notifyConnectionState()
+        # Replay the mode
+        if belt_mode != BeltMode.UNKNOWN and self._belt_mode != belt_mode:
+            self.switchToMode(belt_mode, True)
+        restored_time = time.perf_counter()
+        self._connection_gaps.append((lost_time, restored_time))
+        _log.warning("BeltController: Connection restored, gap from %.3f s "
+                     "to %.3f s (%.3f s).", lost_time, restored_time,
+                     restored_time - lost_time)
+
+
     def _notifyBeltMode(self, button_id=0, press_type=0):
         """Notifies the belt mode to the delegate.
 
@@ -1402,9 +1796,10 @@ class BeltController():
     def _notifyConnectionState(self):
         """Notifies the connection state to the delegate.
         """
-        self._event_notifier.notifyEvent(
-                _BeltControllerEvent.BELT_CONNECTION_STATE_CHANGED,
-                (self._belt_connection_state))
+        if self._event_notifier is not None:
+            self._event_notifier.notifyEvent(
+                    _BeltControllerEvent.BELT_CONNECTION_STATE_CHANGED,
+                    (self._belt_connection_state))
 
 
     def _handleDataReceived(self, data_received):
@@ -1420,13 +1815,15 @@ class BeltController():
             if ((time.time()-self._incoming_packet_start_time) >
                 INCOMING_PACKET_TIMEOUT):
                 # Timeout, clear previous data
-                print("BeltController: Packet timeout.")
+                _log.warning("BeltController: Packet timeout.")
                 self._incoming_packet = []
         # Check data size
         if data_received is None:
             return
         if len(data_received) < 1:
             return
+        # The belt is alive
+        self._last_data_time = time.perf_counter()
         # Fill packet
         if len(self._incoming_packet) == 0:
             # Packet start
@@ -1446,7 +1843,7 @@ class BeltController():
                     self._handlePacketReceived(self._incoming_packet)
                     self._incoming_packet = []
                 else:
-                    print("BeltController: Malformed packet, no termination "+
+                    _log.warning("BeltController: Malformed packet, no termination "+
                           "byte.")
                     # Clear until '\x0A', to realign
                     try:
@@ -1463,7 +1860,7 @@ class BeltController():
             The data received.
         """
         if len(packet_received) != 6:
-            print("BeltController: Malformed packet, wrong length.")
+            _log.warning("BeltController: Malformed packet, wrong length.")
             return
 
         if packet_received[0] == 0x01:
@@ -1494,7 +1891,7 @@ class BeltController():
                          packet_received[1],    # Button ID
                          packet_received[2]))   # Press type
             else:
-                print("BeltController: Malformed button press notification.")
+                _log.warning("BeltController: Malformed button press notification.")
 
         elif packet_received[0] == 0xD0 or packet_received[0] == 0xD1:
             # Parameter value
@@ -1531,8 +1928,26 @@ class BeltController():
                 self._belt_heading_offset -= 65536
             self._belt_heading_offset = self._belt_heading_offset%360
             orientation = (self._belt_heading, self._belt_heading_offset)
-            self._event_notifier.notifyEvent(
-                _BeltControllerEvent.BELT_ORIENTATION_NOTIFIED, orientation)
+            # Resolve the pending request with the new orientation
+            with self._orientation_lock:
+                self._belt_heading_time = time.perf_counter()
+                future = self._orientation_future
+                self._orientation_future = None
+                self._cancelOrientationTimer()
+            if future is not None:
+                try:
+                    future.set_result(orientation)
+                except:
+                    # Cancelled by a caller
+                    pass
+            if self._event_notifier is not None:
+                self._event_notifier.notifyEvent(
+                    _BeltControllerEvent.BELT_ORIENTATION_NOTIFIED, orientation)
+
+        # ACK latency
+        send_time = self._ack_send_times.pop(packet_received[0], None)
+        if send_time is not None:
+            self._ack_latency = time.perf_counter() - send_time
 
         # ACK flag
         if self._wait_ack_id is not None:
@@ -1540,35 +1955,90 @@ class BeltController():
                 self._wait_ack_event.set()
 
 
+def startBTDiscovery(transport='bluetooth'):
+    """Starts the background discovery of Bluetooth devices.
+
+    The discovery repeats the lookup in its own thread and caches the devices
+    (see ``transports.BeltDiscovery``). Starting it before connecting, e.g.
+    when the experiment starts, lets ``connectBeltBT`` find the belt at once.
+
+    Parameters
+    ----------
+    :param str transport:
+        The name of the transport in ``transports.TRANSPORTS``.
+    """
+    transports.TRANSPORTS[transport].startDiscovery(BT_LOOKUP_DURATION)
+
+
 def findBeltBTAddress(name=None):
     """Searches for the Bluetooth address of a belt.
 
-    This function looks at the list of available Bluetooth devices and returns
-    the address that corresponds to the given name, or the first with
-    ``naviGuertel`` in the name.
+    This function looks at the devices cached by the background discovery and
+    returns the address that corresponds to the given name, or the first with
+    ``naviGuertel`` in the name. If no belt is cached, it starts the discovery
+    and waits for it (``transports.DISCOVERY_WAIT_SEC`` at most).
 
     Parameters
     ----------
     :param str name:
         The name of the belt, or a part of the name to look for.
 
+    Return
+    ------
+        :rtype str
+        The address, or None if no belt was found.
+    """
+    transport = transports.TRANSPORTS['bluetooth']
+    transport.startDiscovery(BT_LOOKUP_DURATION)
+    return transport.findAddress(name)
+
+def _openReadySerialPort(port_name, timeout_sec):
+    """Opens a serial port and waits until the belt answers a firmware
+    request.
+
+    Instead of reading for ``SERIAL_CONNECTION_INIT_WAIT``, the firmware
+    version is requested every ``READY_POLL_INTERVAL_SEC`` until its answer
+    arrives.
+
+    Parameters
+    ----------
+    :param str port_name:
+        The serial port.
+    :param float timeout_sec:
+        The time to wait for the answer.
+
+    Return
+    ------
+        :rtype Serial
+        The open port, or None if the belt did not answer within the timeout.
+
     Exception
     ---------
-    A ``BluetoothError`` or ``IOError`` is raised if a problem with
-    bluetooth communication occurs.
+    A ``SerialException`` is raised if the port cannot be opened.
     """
-    # Look at available devices
-    available_devices = bluetooth.discover_devices(duration=BT_LOOKUP_DURATION,
-                                                   lookup_names=True)
-
-    # Check device names
-    if (name is None):
-        name = 'naviGuertel'
-    for device in available_devices:
-        device_name = device[1]
-        if (device_name.find(name)!=-1):
-            return device[0]
-    return None
+    conn = serial.Serial(port_name, SERIAL_BAUDRATE,
+                         timeout=READY_POLL_INTERVAL_SEC,
+                         write_timeout=SERIAL_LOOKUP_WRITE_TIMEOUT)
+    try:
+        conn.reset_input_buffer()
+        timeout_time = time.perf_counter()+timeout_sec
+        while time.perf_counter() < timeout_time:
+            conn.write(b'\x90\x02\xAA\xAA\xAA\x0A')
+            received = b''
+            poll_time = time.perf_counter()+READY_POLL_INTERVAL_SEC
+            while time.perf_counter() < poll_time:
+                received += conn.read(max(1, conn.in_waiting))
+                start = received.find(b'\xD0')
+                if start >= 0 and len(received) >= start+6:
+                    # Belt ready, read the next packets with the listener
+                    conn.timeout = SERIAL_READ_TIMEOUT
+                    return conn
+        conn.close()
+        return None
+    except:
+        conn.close()
+        raise
+
 
 def findBeltSerialPort():
     """Searches for a serial port connected to a belt.
@@ -1586,7 +2056,7 @@ def findBeltSerialPort():
     for comm_port in ports:
         port_valid = False
         try:
-            print("Testing port: "+str(comm_port[0]))
+            _log.info("Testing port: "+str(comm_port[0]))
             # Connect to port
             with serial.Serial(comm_port[0],
                            SERIAL_BAUDRATE,
@@ -1612,7 +2082,7 @@ def findBeltSerialPort():
                         if (ord(b) == 0xD0):
                             port_valid = True
         except Exception as e:
-            print(e)
+            _log.warning(e)
             pass
         if port_valid:
             return comm_port[0]
@@ -1705,11 +2175,13 @@ class _BTSocketListener(threading.Thread):
     def run(self):
         """Starts the thread."""
         self.stop_flag = False
-        print("BTSocketListener: Start listening belt.")
+        _log.info("BTSocketListener: Start listening belt.")
         while not self.stop_flag:
             try:
                 # Blocking until data are received
                 data_str = self._bt_socket.recv(128)
+                if not data_str:
+                    raise IOError("Connection closed by the belt.")
                 data = []
                 # Convert to list of int
                 if data_str is not None and len(data_str) > 0:
@@ -1722,11 +2194,11 @@ class _BTSocketListener(threading.Thread):
                     self._belt_controller._handleDataReceived(data)
             except Exception as e:
                 if not self.stop_flag:
-                    print("BTSocketListener: Error when reading BT input.")
-                    print(e)
+                    _log.warning("BTSocketListener: Error when reading BT input.")
+                    _log.warning(e)
                 self._belt_controller.disconnectBelt()
                 break
-        print("BTSocketListener: Stop listening belt.")
+        _log.info("BTSocketListener: Stop listening belt.")
 
 
 class _SerialPortListener(threading.Thread):
@@ -1752,7 +2224,7 @@ class _SerialPortListener(threading.Thread):
     def run(self):
         """Starts the thread."""
         self.stop_flag = False
-        print("SerialPortListener: Start listening belt.")
+        _log.info("SerialPortListener: Start listening belt.")
         while not self.stop_flag:
             try:
                 # Blocking until data are received
@@ -1768,13 +2240,64 @@ class _SerialPortListener(threading.Thread):
                             data_buffer.append(ord(c))
                     self._belt_controller._handleDataReceived(data_buffer)
             except Exception as e:
-                if not self.stop_flag:
-                    print("SerialPortListener: Error when reading serial "+
-                          "input.")
-                    print(e)
-                self._belt_controller.disconnectBelt()
+                if self.stop_flag:
+                    # Port closed by the controller
+                    break
+                _log.warning("SerialPortListener: Error when reading serial "+
+                      "input.")
+                _log.warning(e)
+                if self._belt_controller._watchdog is not None:
+                    # The watchdog reconnects the belt
+                    self._belt_controller._connectionLost(str(e))
+                else:
+                    self._belt_controller.disconnectBelt()
                 break
-        print("SerialPortListener: Stop listening belt.")
+        _log.info("SerialPortListener: Stop listening belt.")
+
+
+class _ConnectionWatchdog(threading.Thread):
+    """Class for detecting a lost serial connection and reconnecting the belt.
+
+    See ``BeltController.enableWatchdog``.
+    """
+
+    def __init__(self, belt_controller):
+        """Constructor that configures the watchdog.
+
+        Parameters
+        ----------
+        :param BeltController belt_controller:
+            The belt controller.
+        """
+        threading.Thread.__init__(self, name="BeltWatchdog", daemon=True)
+        self._belt_controller = belt_controller
+
+        # Flag for stopping the thread
+        self.stop_flag = False
+
+    def run(self):
+        """Starts the thread."""
+        _log.info("BeltWatchdog: Start watching the connection.")
+        probe_time = None
+        while not self.stop_flag:
+            time.sleep(WATCHDOG_PERIOD_SEC)
+            controller = self._belt_controller
+            if controller._connection_lost:
+                controller._reconnect(self)
+                continue
+            if (controller._belt_connection_state !=
+                BeltConnectionState.CONNECTED):
+                continue
+            last_data_time = controller._last_data_time
+            silence = time.perf_counter()-last_data_time
+            if silence > KEEP_ALIVE_TIMEOUT_SEC:
+                controller._connectionLost("no data for %.1f s" % silence)
+            elif (silence > KEEP_ALIVE_PROBE_SEC and
+                  (probe_time is None or probe_time < last_data_time)):
+                # Request the firmware version once per silence
+                probe_time = time.perf_counter()
+                controller._send(b'\x90\x02\xAA\xAA\xAA\x0A', False)
+        _log.info("BeltWatchdog: Stop watching the connection.")
 
 
 class _BeltEventNotifier(threading.Thread):
@@ -1810,26 +2333,13 @@ class _BeltEventNotifier(threading.Thread):
     def run(self):
         """Starts the thread."""
         self.stop_flag = False
-        print("BeltEventNotifier: Event notifier started.")
+        _log.info("BeltEventNotifier: Event notifier started.")
         while (not self.stop_flag) or (not self._notification_queue.empty()):
             with self._notification_queue_lock:
                 if not self._notification_queue.empty():
                     # Notify next event in queue
                     event = self._notification_queue.get()
-                    try:
-                        if (event[0] == _BeltControllerEvent.BELT_MODE_CHANGED):
-                            self._delegate.onBeltModeChange(event[1])
-                        elif (event[0] ==
-                              _BeltControllerEvent.BELT_ORIENTATION_NOTIFIED):
-                            self._delegate.onBeltOrientationNotified(event[1])
-                        elif (event[0] ==
-                            _BeltControllerEvent.BELT_CONNECTION_STATE_CHANGED):
-                            self._delegate.onBeltConnectionStateChanged(
-                                event[1])
-                        else:
-                            print("BeltEventNotifier: Unknown event ID.")
-                    except:
-                        pass
+                    self._notifyDelegate(event)
                 else:
                     # Wait for an item in queue
                     # Note: Lock must has been acquired to wait
@@ -1838,9 +2348,33 @@ class _BeltEventNotifier(threading.Thread):
         try:
             self._belt_controller._event_notifier = None
         except:
-            print("BeltEventNotifier: Unable to clear reference to "
+            _log.warning("BeltEventNotifier: Unable to clear reference to "
                   "_BeltEventNotifier.")
-        print("BeltEventNotifier: Event notifier stopped.")
+        _log.info("BeltEventNotifier: Event notifier stopped.")
+
+
+    def _notifyDelegate(self, event):
+        """Calls the method of the delegate that handles the event.
+
+        Parameters
+        ----------
+        :param tuple event:
+            The event ID and the event data.
+        """
+        try:
+            if (event[0] == _BeltControllerEvent.BELT_MODE_CHANGED):
+                self._delegate.onBeltModeChange(event[1])
+            elif (event[0] ==
+                  _BeltControllerEvent.BELT_ORIENTATION_NOTIFIED):
+                self._delegate.onBeltOrientationNotified(event[1])
+            elif (event[0] ==
+                _BeltControllerEvent.BELT_CONNECTION_STATE_CHANGED):
+                self._delegate.onBeltConnectionStateChanged(
+                    event[1])
+            else:
+                _log.warning("BeltEventNotifier: Unknown event ID.")
+        except:
+            pass
 
 
     def notifyEvent(self, event_id, event_data=None):
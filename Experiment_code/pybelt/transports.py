@@ -0,0 +1,364 @@
+# Transports of the wireless belt connection
+
+"""Transports that carry the byte stream of a wireless belt connection.
+
+A transport finds the address of a belt and opens a socket-like object to
+it: ``send(bytes)``, a blocking ``recv(size)`` and ``close()``, which is the
+stream the ``_BTSocketListener`` of the belt controller reads.
+
+- BluetoothTransport: an RFCOMM socket of PyBluez. The addresses are found
+  by a background discovery and returned from its cache.
+- LoopbackTransport: a local socket pair with a ``BeltEmulator`` at its
+  other end, which stands in for a belt without Bluetooth hardware.
+
+The transports are registered by name in ``TRANSPORTS``, see
+``BeltController.connectBeltBT``. PyBluez is optional: without it the
+Bluetooth transport raises an IOError and the loopback transport still works.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import bluetooth # Bluetooth module from pyBluez
+except ImportError:
+    bluetooth = None
+
+DISCOVERY_DURATION = 3
+# Duration of one Bluetooth inquiry in seconds
+
+DISCOVERY_INTERVAL_SEC = 30.0
+# Waiting time between two inquiries of the background discovery
+
+DISCOVERY_WAIT_SEC = 8.0
+# Timeout to wait for the first inquiry if no belt is cached
+
+DISCOVERY_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.pybelt_devices.json')
+# File that keeps the discovered devices between sessions
+
+DEFAULT_BELT_NAME = 'naviGuertel'
+# Part of the Bluetooth name of a belt
+
+LOOPBACK_ADDRESS = 'loopback'
+# Address of the belt emulator of the loopback transport
+
+EMULATOR_FIRMWARE_VERSION = 40
+# Firmware version the belt emulator reports
+
+_log = logging.getLogger(__name__)
+# Logger of the transports and the discovery
+
+
+class BeltDiscovery(threading.Thread):
+    """Class for discovering Bluetooth devices in the background.
+
+    The thread repeats the inquiry every ``DISCOVERY_INTERVAL_SEC`` and keeps
+    the devices found, such that ``findBeltAddress`` answers from the cache
+    without waiting for an inquiry. The cache is stored in a file and loaded
+    at the start, thus a belt of an earlier session is found at once.
+    """
+
+    def __init__(self, duration=DISCOVERY_DURATION, cache_file=DISCOVERY_CACHE_FILE):
+        """Constructor that configures the discovery.
+
+        Parameters
+        ----------
+        :param int duration:
+            The duration of one inquiry in seconds.
+        :param str cache_file:
+            The file of the cached devices, or None to keep them in memory only.
+        """
+        threading.Thread.__init__(self, name="BeltDiscovery", daemon=True)
+        self._duration = duration
+        self._cache_file = cache_file
+        # Cached devices: name by address
+        self._devices = {}
+        self._condition = threading.Condition()
+        self._loadCache()
+
+        # Flag for stopping the thread
+        self.stop_flag = False
+
+    def run(self):
+        """Starts the thread."""
+        _log.info("BeltDiscovery: Discovery started.")
+        while not self.stop_flag:
+            try:
+                devices = bluetooth.discover_devices(duration=self._duration,
+                                                     lookup_names=True)
+            except Exception as e:
+                _log.warning("BeltDiscovery: Inquiry failed.")
+                _log.warning('%s', e)
+                devices = []
+            with self._condition:
+                for address, name in devices:
+                    self._devices[address] = name
+                self._condition.notify_all()
+            self._saveCache()
+            # Wait for the next inquiry
+            end_time = time.time()+DISCOVERY_INTERVAL_SEC
+            while not self.stop_flag and time.time() < end_time:
+                time.sleep(0.5)
+        _log.info("BeltDiscovery: Discovery stopped.")
+
+    def findBeltAddress(self, name=None, timeout_sec=DISCOVERY_WAIT_SEC):
+        """Returns the address of a belt.
+
+        A cached belt is returned at once. Otherwise the function waits until
+        an inquiry finds one, at most ``timeout_sec``.
+
+        Parameters
+        ----------
+        :param str name:
+            The name of the belt, or a part of the name.
+        :param float timeout_sec:
+            The time to wait if no belt is cached.
+
+        Return
+        ------
+            :rtype str
+            The address, or None if no belt was found.
+        """
+        if name is None:
+            name = DEFAULT_BELT_NAME
+        end_time = time.time()+timeout_sec
+        with self._condition:
+            while True:
+                for address, device_name in self._devices.items():
+                    if device_name is not None and device_name.find(name) != -1:
+                        return address
+                remaining = end_time-time.time()
+                if remaining <= 0 or not self.is_alive():
+                    return None
+                self._condition.wait(remaining)
+
+    def forgetAddress(self, address):
+        """Removes a device from the cache, e.g. after a failed connection."""
+        with self._condition:
+            self._devices.pop(address, None)
+        self._saveCache()
+
+    def getDevices(self):
+        """Returns the cached devices as a dictionary of names by address."""
+        with self._condition:
+            return dict(self._devices)
+
+    def _loadCache(self):
+        if self._cache_file is None or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file) as file:
+                self._devices.update(json.load(file))
+        except Exception as e:
+            _log.warning("BeltDiscovery: Unable to read the cache file.")
+            _log.warning('%s', e)
+
+    def _saveCache(self):
+        if self._cache_file is None:
+            return
+        try:
+            with open(self._cache_file, 'w') as file:
+                json.dump(self.getDevices(), file)
+        except Exception as e:
+            _log.warning("BeltDiscovery: Unable to write the cache file.")
+            _log.warning('%s', e)
+
+
+class BluetoothTransport():
+    """Transport over an RFCOMM socket of PyBluez."""
+
+    def __init__(self):
+        self._discovery = None
+        self._discovery_lock = threading.Lock()
+
+    def startDiscovery(self, duration=DISCOVERY_DURATION):
+        """Starts the background discovery, if it does not run yet.
+
+        Starting it early, e.g. when the experiment starts, fills the cache
+        before the belt is connected.
+
+        Return
+        ------
+            :rtype BeltDiscovery
+            The discovery.
+        """
+        with self._discovery_lock:
+            if self._discovery is None:
+                self._discovery = BeltDiscovery(duration)
+                if bluetooth is not None:
+                    self._discovery.start()
+                else:
+                    _log.warning("BluetoothTransport: PyBluez is not installed, "+
+                          "only cached devices are found.")
+            return self._discovery
+
+    def findAddress(self, name=None):
+        """Returns the address of a belt, from the cache if possible.
+
+        Parameters
+        ----------
+        :param str name:
+            The name of the belt, or a part of the name.
+        """
+        return self.startDiscovery().findBeltAddress(name)
+
+    def forgetAddress(self, address):
+        """Removes an address that failed to connect from the cache."""
+        if self._discovery is not None:
+            self._discovery.forgetAddress(address)
+
+    def open(self, address, port):
+        """Opens an RFCOMM socket to the belt.
+
+        Exception
+        ---------
+        Raises an IOError if PyBluez is not installed, and a
+        ``BluetoothError`` if the connection fails.
+        """
+        if bluetooth is None:
+            raise IOError("PyBluez is not installed.")
+        bt_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        bt_socket.connect((address, port))
+        return bt_socket
+
+
+class LoopbackTransport():
+    """Transport over a local socket pair with a belt emulator.
+
+    Attributes
+    ----------
+    emulator : BeltEmulator
+        The emulator of the last opened connection.
+    """
+
+    def __init__(self):
+        self.emulator = None
+
+    def startDiscovery(self, duration=DISCOVERY_DURATION):
+        pass
+
+    def findAddress(self, name=None):
+        return LOOPBACK_ADDRESS
+
+    def forgetAddress(self, address):
+        pass
+
+    def open(self, address, port):
+        """Opens a socket pair and starts the belt emulator at its other end."""
+        controller_socket, belt_socket = socket.socketpair()
+        self.emulator = BeltEmulator(belt_socket)
+        self.emulator.start()
+        return controller_socket
+
+
+class BeltEmulator(threading.Thread):
+    """Class that answers the commands of the belt controller like a belt.
+
+    It acknowledges the commands, reports its parameters and orientation, and
+    keeps the requested mode. Vibrations are only recorded.
+
+    Attributes
+    ----------
+    packets : list
+        The packets received, as bytes.
+    mode : int
+        The current mode.
+    """
+
+    def __init__(self, belt_socket, mode=1, firmware_version=EMULATOR_FIRMWARE_VERSION):
+        """Constructor that configures the emulator.
+
+        Parameters
+        ----------
+        :param socket belt_socket:
+            The belt end of the socket pair.
+        :param int mode:
+            The mode at the start (1 is the wait mode).
+        :param int firmware_version:
+            The firmware version to report.
+        """
+        threading.Thread.__init__(self, name="BeltEmulator", daemon=True)
+        self._socket = belt_socket
+        self._firmware_version = firmware_version
+        self.packets = []
+        self.mode = mode
+
+        # Flag for stopping the thread
+        self.stop_flag = False
+
+    def run(self):
+        """Starts the thread."""
+        received = b''
+        while not self.stop_flag:
+            try:
+                data = self._socket.recv(128)
+            except OSError:
+                break
+            if not data:
+                break
+            received += data
+            while received:
+                # Vibration commands 0x87 have 7 bytes, all others 6
+                length = 7 if received[0] == 0x87 else 6
+                if len(received) < length:
+                    break
+                packet, received = received[:length], received[length:]
+                if packet[-1] != 0x0A:
+                    # Realign after the next termination byte
+                    end = packet.find(b'\x0A')
+                    received = (packet[end+1:] if end >= 0 else b'')+received
+                    continue
+                self.packets.append(packet)
+                self._answer(packet)
+        self._socket.close()
+
+    def _answer(self, packet):
+        """Sends the answers of a packet."""
+        command = packet[0]
+        if command == 0x90:
+            # Parameter request
+            values = {0x02: self._firmware_version, 0x08: self.mode, 0x09: 50}
+            self._write([0xD0, packet[1], values.get(packet[1], 0), 0x00, 0x00])
+        elif command == 0x91:
+            # Mode change
+            self.mode = packet[2]
+            self._write([0xD1, 0x08, self.mode, 0x00, 0x00])
+        elif command == 0x92:
+            # Orientation
+            if packet[1] == 0x02:
+                # Requested orientation before the ACK, like the belt
+                self._write([0x03, 0x00, 0x00, 0x00, 0x00])
+            self._write([0xD2, packet[1], 0x00, 0x00, 0x00])
+        elif 0x84 <= command <= 0x88:
+            # Vibration commands
+            self._write([command | 0x40, 0x00, 0x00, 0x00, 0x00])
+
+    def _write(self, values):
+        try:
+            self._socket.sendall(bytes(values+[0x0A]))
+        except OSError:
+            self.stop_flag = True
+
+
+TRANSPORTS = {'bluetooth': BluetoothTransport(),
+              'loopback': LoopbackTransport()}
+# Transports of the wireless connection by name, see registerTransport
+
+
+def registerTransport(name, transport):
+    """Adds a transport for ``BeltController.connectBeltBT``.
+
+    Parameters
+    ----------
+    :param str name:
+        The name of the transport.
+    :param transport:
+        An object with the methods ``startDiscovery(duration)``,
+        ``findAddress(name)``, ``forgetAddress(address)`` and
+        ``open(address, port)``, which returns a socket-like object.
+    """
+    TRANSPORTS[name] = transport
@@ -0,0 +1,315 @@
+"""
+Real-time mode of a session on Linux.
+- RealtimeSession: applies the settings below when the session starts,
+  controls the garbage collector around every block and restores everything
+  at the end
+- set_affinity: pins a thread or process to CPU cores
+- set_process_affinity: pins every thread of another process to CPU cores
+- release_thread: returns a helper thread of the stimulus process to the
+  normal scheduling and the I/O cores
+- set_realtime_priority: requests SCHED_FIFO, or a lower nice value if that
+  is not allowed
+- lock_memory: locks the memory of the process in RAM (mlockall)
+- prefault_memory: touches a block of memory, such that the first allocations
+  of a block do not page fault
+
+During a block the garbage collector is frozen and disabled. The objects that
+exist at the start of the block are moved to the permanent generation, such
+that the next collection after the block does not scan them again. The
+collection itself runs before the ready screen, where the participant sets
+the pace.
+
+Every setting reports whether it took effect, because SCHED_FIFO and
+mlockall need privileges (CAP_SYS_NICE, CAP_IPC_LOCK or suitable rlimits)
+and a failed request must not stop the session. On other systems only the
+garbage collector control is applied.
+
+With SCHED_FIFO the stimulus thread is not preempted while it spins before a
+deadline (see scheduler.sleep_until), thus the belt threads should get their
+own io_cores; on the same core they only run while the stimulus thread sleeps.
+On Linux the policy and the affinity belong to a thread and are inherited by
+the threads it starts. The helper threads the stimulus thread starts during
+the session (the key listener and the writer of the fingertapping) therefore
+call release_thread first, and the threads of the I/O process are pinned one
+by one.
+"""
+
+import ctypes, ctypes.util, gc, os, sys, threading
+
+REALTIME_PRIORITY = 50
+# SCHED_FIFO priority of the stimulus thread (1-99), the priority of the
+# kernel's interrupt threads, above every normal process
+
+FALLBACK_NICE = -10
+# Nice value requested if SCHED_FIFO is not allowed
+
+PREFAULT_SIZE = 64 * 1024 * 1024
+# Bytes of memory touched before the first block
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+# Flags of mlockall (sys/mman.h)
+
+IO_THREAD_NAMES = ('SerialPortListener', 'BTSocketListener', 'BeltEventNotifier', 'BeltWatchdog')
+# Names of the belt threads that are pinned to the I/O cores. The watchdog
+# starts the listener of a reconnected belt, which inherits its cores.
+
+_helper_cores = None
+# Cores of the helper threads while a real-time session is entered, None otherwise
+
+
+def _is_linux():
+    return sys.platform.startswith('linux')
+
+
+def set_affinity(cores, thread_id=0):
+    """
+    Pins a thread or process to CPU cores.
+
+    Parameters
+    ----------
+    cores : list
+        The numbers of the cores.
+    thread_id : int
+        The native ID of a thread (threading.Thread.native_id) or the ID of a
+        process, 0 for the calling thread.
+
+    Returns
+    -------
+    tuple
+        (bool, str): whether it took effect and a description.
+    """
+    if not _is_linux():
+        return False, 'CPU affinity is only supported on Linux'
+    try:
+        os.sched_setaffinity(thread_id, set(cores))
+        return True, 'pinned to cores %s' % sorted(os.sched_getaffinity(thread_id))
+    except (OSError, ValueError) as e:
+        return False, 'affinity %s not set: %s' % (list(cores), e)
+
+
+def set_process_affinity(cores, process_id):
+    """
+    Pins every thread of a process to CPU cores. The threads the process
+    starts later inherit the cores of the thread that starts them.
+
+    Parameters
+    ----------
+    cores : list
+        The numbers of the cores.
+    process_id : int
+        The ID of the process.
+
+    Returns
+    -------
+    tuple
+        (bool, str): whether it took effect for all threads and a description.
+    """
+    if not _is_linux():
+        return False, 'CPU affinity is only supported on Linux'
+    try:
+        thread_ids = [int(thread_id) for thread_id in os.listdir('/proc/%i/task' % process_id)]
+    except OSError as e:
+        return False, 'threads of process %i not found: %s' % (process_id, e)
+    failed = []
+    for thread_id in thread_ids:
+        ok, description = set_affinity(cores, thread_id)
+        if not ok:
+            failed.append(description)
+    if failed:
+        return False, '%i of %i threads not pinned: %s' % (len(failed), len(thread_ids), failed[0])
+    return True, '%i threads pinned to cores %s' % (len(thread_ids), sorted(cores))
+
+
+def release_thread():
+    """
+    Returns the calling thread to the normal scheduling and pins it to the
+    I/O cores (or the cores of the process before the session), if a
+    real-time session is entered. Otherwise nothing is changed.
+
+    Helper threads of the stimulus process call it when they start, as they
+    would inherit the SCHED_FIFO policy and the cores of the stimulus thread.
+    """
+    if _helper_cores is None:
+        return
+    try:
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+    except OSError:
+        pass
+    set_affinity(_helper_cores)
+
+
+def set_realtime_priority(priority=REALTIME_PRIORITY, fallback_nice=FALLBACK_NICE):
+    """
+    Requests the SCHED_FIFO policy for the calling thread, or a lower nice
+    value of the process if that is not allowed.
+
+    Returns
+    -------
+    tuple
+        (bool, str): whether SCHED_FIFO or the nice value took effect and a description.
+    """
+    if not _is_linux():
+        return False, 'SCHED_FIFO is only supported on Linux'
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True, 'SCHED_FIFO priority %i' % priority
+    except (OSError, PermissionError) as e:
+        fifo_error = e
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, fallback_nice)
+        return True, 'SCHED_FIFO not allowed (%s), nice %i instead' % (fifo_error, fallback_nice)
+    except (OSError, PermissionError) as e:
+        return False, 'SCHED_FIFO not allowed (%s), nice %i not allowed (%s)' % (fifo_error, fallback_nice, e)
+
+
+def lock_memory():
+    """
+    Locks the current and future memory of the process in RAM, such that it
+    is never swapped out.
+
+    Returns
+    -------
+    tuple
+        (bool, str): whether it took effect and a description.
+    """
+    if not _is_linux():
+        return False, 'mlockall is only supported on Linux'
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        return False, 'mlockall failed: %s' % os.strerror(ctypes.get_errno())
+    return True, 'memory locked'
+
+
+def unlock_memory():
+    """Releases the memory locked by lock_memory."""
+    if _is_linux():
+        ctypes.CDLL(ctypes.util.find_library('c')).munlockall()
+
+
+def prefault_memory(size=PREFAULT_SIZE):
+    """
+    Touches every page of a block of memory and frees it again. The allocator
+    keeps most of it, thus the allocations of the next block find mapped
+    (and, with lock_memory, locked) pages.
+
+    Returns
+    -------
+    tuple
+        (bool, str): always True and the size.
+    """
+    block = bytearray(size)
+    for offset in range(0, size, 4096):
+        block[offset] = 1
+    del block
+    return True, '%i MB touched' % (size // (1024 * 1024))
+
+
+class RealtimeSession():
+    """
+    Applies the real-time settings to a session and controls the garbage
+    collector around its blocks.
+
+    Parameters
+    ----------
+    stimulus_cores : list
+        The cores of the stimulus (main) thread, empty to leave it unpinned.
+    io_cores : list
+        The cores of the belt threads and the I/O process, empty to leave them unpinned.
+    priority : int
+        The SCHED_FIFO priority, 0 to keep the normal scheduling.
+    memory_lock : bool
+        Locks the memory of the process (mlockall) and prefaults it.
+
+    Attributes
+    ----------
+    report : dict
+        For every setting whether it took effect and a description.
+    """
+
+    def __init__(self, stimulus_cores=(), io_cores=(), priority=REALTIME_PRIORITY, memory_lock=True):
+        self.stimulus_cores = list(stimulus_cores)
+        self.io_cores = list(io_cores)
+        self.priority = priority
+        self.memory_lock = memory_lock
+        self.report = {}
+        self._gc_was_enabled = gc.isenabled()
+        self._affinity = os.sched_getaffinity(0) if _is_linux() else None
+        self._policy = os.sched_getscheduler(0) if _is_linux() else None
+        self._nice = os.getpriority(os.PRIO_PROCESS, 0) if _is_linux() else None
+        self._in_block = False
+
+    def enter(self, io_process_id=None):
+        """
+        Applies the settings. Call it when the belt threads run, i.e. after
+        connecting the belt.
+
+        Parameters
+        ----------
+        io_process_id : int
+            The process ID of the I/O process, None without I/O process.
+
+        Returns
+        -------
+        dict
+            The report, see ``report``.
+        """
+        if self.stimulus_cores:
+            self.report['stimulus affinity'] = set_affinity(self.stimulus_cores)
+        if self.io_cores:
+            for thread in threading.enumerate():
+                if thread.name in IO_THREAD_NAMES:
+                    self.report['%s affinity' % thread.name] = set_affinity(self.io_cores, thread.native_id)
+            if io_process_id is not None:
+                self.report['I/O process affinity'] = set_process_affinity(self.io_cores, io_process_id)
+        if self.priority > 0:
+            self.report['priority'] = set_realtime_priority(self.priority)
+        if self.memory_lock:
+            self.report['memory lock'] = lock_memory()
+            self.report['prefault'] = prefault_memory()
+        self.report['garbage collector'] = (True, 'frozen and disabled during blocks')
+        if _is_linux():
+            global _helper_cores
+            _helper_cores = self.io_cores or sorted(self._affinity)
+        return self.report
+
+    def start_block(self):
+        """Collects the garbage, then freezes and disables the garbage collector until end_block."""
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self._in_block = True
+
+    def end_block(self):
+        """Enables the garbage collector again after a block."""
+        if not self._in_block:
+            return
+        gc.unfreeze()
+        if self._gc_was_enabled:
+            gc.enable()
+        self._in_block = False
+
+    def exit(self):
+        """Restores the scheduling, the affinity and the memory of the process."""
+        self.end_block()
+        if not _is_linux():
+            return
+        global _helper_cores
+        _helper_cores = None
+        try:
+            os.sched_setscheduler(0, self._policy, os.sched_param(0))
+            os.setpriority(os.PRIO_PROCESS, 0, self._nice)
+        except (OSError, PermissionError):
+            # A raised nice value cannot be lowered again without privileges
+            pass
+        try:
+            os.sched_setaffinity(0, self._affinity)
+        except OSError:
+            pass
+        if self.memory_lock:
+            unlock_memory()
+
+    def describe(self):
+        """Returns one line per setting: whether it took effect and how."""
+        return '\n'.join('%-28s %-4s %s' % (setting, 'ok' if ok else 'FAILED', description)
+                         for setting, (ok, description) in self.report.items())
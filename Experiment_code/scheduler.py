@@ -0,0 +1,142 @@
+"""
+Timing of the trials from absolute deadlines.
+- sleep_until: waits for a point in time, sleeping first and spinning for the
+  last milliseconds
+- DeadlineScheduler: plans the deadlines of a block from its start, such that
+  delays of single trials do not add up, and measures how late they are met
+
+With relative waits (sleep trial_break, then sleep trial_length) every trigger
+pulse, print and command adds to the stimulus onset asynchrony and the errors
+add up over the block. The scheduler instead waits until
+block start + planned time, so the time spent between two waits is absorbed.
+"""
+
+import time
+import numpy as np
+
+SPIN_THRESHOLD = 0.002
+# Time in seconds before a deadline at which the scheduler stops sleeping and
+# spins on the clock. time.sleep can overshoot by about a millisecond (more on
+# Windows), spinning cannot.
+
+
+def sleep_until(deadline, spin_threshold=SPIN_THRESHOLD):
+    """
+    Waits until ``time.perf_counter()`` reaches the deadline.
+
+    Parameters
+    ----------
+    deadline : float
+        The time of time.perf_counter() to wait for.
+    spin_threshold : float
+        The last part of the wait in seconds that is spent spinning instead of
+        sleeping.
+    """
+    remaining = deadline - time.perf_counter()
+    if remaining > spin_threshold:
+        time.sleep(remaining - spin_threshold)
+    while time.perf_counter() < deadline:
+        pass
+
+
+class DeadlineScheduler():
+    """
+    Plans the deadlines of a block relative to its start and waits for them.
+
+    ``wait`` advances the planned time and waits until it is reached, like a
+    relative wait would, but from the planned time of the previous deadline
+    instead of the moment it is called. When the stimuli are paced by someone
+    else (e.g. the flips of a frame-locked screen), ``advance`` and ``record``
+    only plan and measure the deadlines without waiting.
+
+    Parameters
+    ----------
+    name : str
+        Used to identify the scheduler in the timing report.
+    spin_threshold : float
+        The last part of every wait in seconds that is spent spinning.
+
+    Attributes
+    ----------
+    name : str
+        Stores the name of the scheduler.
+    spin_threshold : float
+        Stores the time spent spinning before a deadline.
+    block_start : float
+        The time of time.perf_counter() at which the block started.
+    planned : float
+        The planned time of the current deadline in seconds from the block start.
+    lateness : list
+        How late every deadline of the block was met, in seconds.
+    """
+
+    def __init__(self, name, spin_threshold=SPIN_THRESHOLD):
+        self.name = name
+        self.spin_threshold = spin_threshold
+        self.start_block()
+
+    def start_block(self):
+        """Starts the planning of a new block at the current time."""
+        self.block_start = time.perf_counter()
+        self.planned = 0.0
+        self.lateness = []
+
+    def deadline(self):
+        """Returns the current deadline as time of time.perf_counter()."""
+        return self.block_start + self.planned
+
+    def advance(self, seconds):
+        """Moves the deadline by the given time without waiting."""
+        self.planned += seconds
+
+    def record(self):
+        """Records how late the current deadline is met at this moment."""
+        self.lateness.append(time.perf_counter() - self.deadline())
+
+    def wait(self, seconds):
+        """
+        Moves the deadline by the given time and waits until it is reached.
+
+        Parameters
+        ----------
+        seconds : float
+            The planned time between the previous deadline and the next one.
+        """
+        self.advance(seconds)
+        sleep_until(self.deadline(), self.spin_threshold)
+        self.record()
+
+    def drift(self):
+        """Returns how late the last deadline was met in seconds, i.e. the drift accumulated in the block."""
+        return self.lateness[-1] if self.lateness else 0.0
+
+    def summary(self):
+        """
+        Returns the timing of the block.
+
+        Returns
+        -------
+        dict
+            'deadlines': number of deadlines, 'mean', 'sd' and 'max': lateness
+            of the deadlines, 'drift': lateness of the last deadline, all in
+            seconds, 'planned': planned duration of the block.
+        """
+        lateness = np.array(self.lateness) if self.lateness else np.zeros(1)
+        return {'deadlines': len(self.lateness), 'mean': lateness.mean(), 'sd': lateness.std(),
+                'max': lateness.max(), 'drift': self.drift(), 'planned': self.planned}
+
+    def report_args(self):
+        """
+        Returns the format and the arguments of the line of report, such that
+        a logger formats it in the console thread: log.info(*scheduler.report_args()).
+        """
+        summary = self.summary()
+        return ('%s timing: %i deadlines, lateness mean %.3f ms, sd %.3f ms, max %.3f ms, '
+                'cumulative drift %.3f ms over %.1f s',
+                self.name, summary['deadlines'], summary['mean'] * 1000, summary['sd'] * 1000,
+                summary['max'] * 1000, summary['drift'] * 1000, summary['planned'])
+
+    def report(self):
+        """Returns a line describing the timing of the block, e.g. for printing and the session log."""
+        message, *args = self.report_args()
+        return message % tuple(args)
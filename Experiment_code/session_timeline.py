@@ -0,0 +1,469 @@
+"""
+Compilation of a session into one timeline of typed events.
+- Event: one event of the session with its planned time
+- compile_session: the timeline of a session from the parameters, the block order
+  and the trial sequences
+- predicted_duration: the duration of a session without (or with assumed)
+  participant responses
+- save_timeline: writes the timeline to a CSV file
+- TimelineExecutor: runs a timeline in real time without hardware
+- ConsoleExecutor: prints every event when it is due (dry run of the triggers)
+- SimulatedExecutor: runs a timeline on a virtual clock
+
+The timeline follows what Experiment.start, the ScreenController and the
+VibrationController do. Times are in seconds from the start of the session
+and do not include the self-paced waits (WAIT_FOR_KEY events), which take
+as long as the participant needs. Every event after such a wait is due its
+planned time plus the time spent waiting.
+
+With a frame rate every flip of the screen is moved to the next frame of a
+grid that starts with the session, like a window waits for the vertical
+blank. The phase of the real grid after a self-paced wait depends on the
+participant, thus each flip after such a wait may still come up to one frame
+later than planned. Without a frame rate the flips are not modelled and each
+screen trigger may come up to one frame late.
+
+Usage for predicting the duration of a participant's session:
+    python session_timeline.py [frame rate]
+"""
+
+import collections, csv, math, os, sys, time
+import console
+
+Event = collections.namedtuple('Event', ['time', 'duration', 'kind', 'name', 'value', 'block', 'trial'])
+# One event of the timeline. time and duration are in seconds, block and trial
+# count from 1 (0 outside of a block or trial).
+
+SCREEN = 'screen'
+TRIGGER = 'trigger'
+BELT = 'belt'
+STIMULUS_ONSET = 'stimulus_onset'
+STIMULUS_OFFSET = 'stimulus_offset'
+FINGERTAPPING = 'fingertapping'
+WAIT_FOR_KEY = 'wait_for_key'
+# Kinds of events
+
+TRIGGER_PULSE = 0.01
+# Length of a trigger pulse set with setData(code), core.wait(0.01), setData(0)
+
+BELT_COMMAND_WAIT = 0.01
+# Wait of classicbelt.vibrateAtPositions before the vibration command. Its
+# trigger pulse is commented out, the vibration onset has no trigger.
+
+BELT_CONNECT_WAIT = 5.0
+# Time the belt controller flushes the serial port after connecting
+# (SERIAL_CONNECTION_INIT_WAIT in pybelt/classicbelt.py)
+
+BLOCK_PAUSE = 1.0
+# Pause before the ready screen of every block (Experiment.start)
+
+TAPPING_DURATION = 30.0
+# Length of a fingertapping round (ScreenController.tapping_duration)
+
+FINGERTAPPING_END_WAIT = 3.0
+# Time the end of the fingertapping round is shown
+
+FRAME_TOLERANCE = 1e-6
+# Fraction of a frame below which a planned time counts as on the frame
+
+READY_TRIGGER = 21
+FIXATION_TRIGGER = 16
+SEQUENCE_TRIGGER = 17
+TAPPING_END_TRIGGER = 19
+PAUSE_TRIGGER = 20
+# Trigger codes of the screens (see TriggerNumbers.md)
+
+log = console.get_logger(__name__)
+# Console output of the summary (see console.py)
+
+
+def next_frame(seconds, frame_rate, last_frame=None):
+    """
+    Returns the number of the frame in which a flip requested at the given
+    time is shown: the first frame after the time, as a flip requested at a
+    vertical blank misses it, and never the frame of the last flip. Times
+    within FRAME_TOLERANCE below a frame count as on it, such that rounding
+    errors of the times do not change the frame.
+    """
+    frame = math.floor(seconds * frame_rate + FRAME_TOLERANCE) + 1
+    if last_frame is not None:
+        frame = max(frame, last_frame + 1)
+    return frame
+
+
+class _TimelineBuilder():
+    """Collects the events of a timeline and keeps track of the planned time."""
+
+    def __init__(self, frame_rate=None):
+        self.events = []
+        self.time = 0.0
+        self.block = 0
+        self.trial = 0
+        self.frame_rate = frame_rate
+        self.last_frame = None
+
+    def add(self, kind, name, value=None, duration=0.0):
+        """Adds an event at the current time without advancing the time."""
+        self.events.append(Event(self.time, duration, kind, name, value, self.block, self.trial))
+
+    def wait(self, seconds):
+        """Advances the planned time."""
+        self.time += seconds
+
+    def flip(self):
+        """
+        Advances the planned time to the frame of the next flip (see
+        next_frame), if the frame rate is known. Returns the number of the
+        frame or None.
+        """
+        if self.frame_rate is None:
+            return None
+        self.last_frame = next_frame(self.time, self.frame_rate, self.last_frame)
+        self.time = self.last_frame / self.frame_rate
+        return self.last_frame
+
+    def pulse(self, name, code, duration=TRIGGER_PULSE, blocking=True):
+        """Adds a trigger pulse. A blocking pulse waits for its end like core.wait does."""
+        self.add(TRIGGER, name, code, duration)
+        if blocking:
+            self.wait(duration)
+
+
+def _frames(seconds, frame_rate):
+    """Returns the duration of ``seconds`` rounded to whole frames, as ScreenController does."""
+    return int(round(seconds * frame_rate)) / frame_rate
+
+
+def _compile_visual_block(builder, sequence, params, swapped, frame_rate):
+    """Adds the trials of a visual oddball block (ScreenController.present_trial)."""
+    triggers = params.visual_swapped_trigger if swapped else params.visual_trigger
+    color_standard, color_oddball = params.circle_colors
+    if swapped:
+        color_standard, color_oddball = color_oddball, color_standard
+
+    if frame_rate is not None:
+        # The block starts with a flip and shows its frames without a gap
+        first_frame = builder.flip()
+        trial_frames = int(round(params.trial_break * frame_rate)) + int(round(params.trial_length * frame_rate))
+
+    for i, stimulus in enumerate(sequence):
+        builder.trial = i + 1
+        oddball = stimulus == 1
+        col = color_oddball if oddball else color_standard
+        circle_trigger = triggers[1] if col == 'cyan' else triggers[0]
+        label = 'oddball' if oddball else 'standard'
+
+        if frame_rate is not None:
+            # The triggers are set with the first flip and reset with the next one
+            trial_break = _frames(params.trial_break, frame_rate)
+            trial_length = _frames(params.trial_length, frame_rate)
+            builder.add(SCREEN, 'fixation', duration=trial_break)
+            builder.pulse('break', triggers[2], 1.0 / frame_rate, blocking=False)
+            builder.wait(trial_break)
+            builder.add(SCREEN, 'circle', col, trial_length)
+            builder.add(STIMULUS_ONSET, label, col, trial_length)
+            builder.pulse(label, circle_trigger, 1.0 / frame_rate, blocking=False)
+            builder.wait(trial_length)
+        else:
+            # The trigger pulses are part of the waits of the DeadlineScheduler
+            builder.add(SCREEN, 'fixation', duration=params.trial_break)
+            builder.pulse('break', triggers[2], blocking=False)
+            builder.wait(params.trial_break)
+            builder.add(SCREEN, 'circle', col, params.trial_length)
+            builder.add(STIMULUS_ONSET, label, col, params.trial_length)
+            builder.pulse(label, circle_trigger, blocking=False)
+            builder.wait(params.trial_length)
+        builder.add(STIMULUS_OFFSET, label, col)
+    builder.trial = 0
+    if frame_rate is not None and len(sequence) > 0:
+        # The block returns with its last flip
+        builder.last_frame = first_frame + len(sequence) * trial_frames - 1
+        builder.time = builder.last_frame / frame_rate
+
+
+def _compile_vibrotactile_block(builder, sequence, params, swapped):
+    """Adds the trials of a vibrotactile oddball block (VibrationController.start_trial)."""
+    triggers = params.ankle_swapped_trigger if swapped else params.ankle_trigger
+    intensity_standard, intensity_oddball = params.vibration_weak, params.vibration_strong
+    if swapped:
+        intensity_standard, intensity_oddball = intensity_oddball, intensity_standard
+
+    for i, stimulus in enumerate(sequence):
+        builder.trial = i + 1
+        oddball = stimulus == 1
+        intensity = intensity_oddball if oddball else intensity_standard
+        label = 'oddball' if oddball else 'standard'
+
+        # vibrateAtPositions waits before the vibration command and sends no
+        # trigger. The vibration stops trial_length after the planned onset
+        # of the trial (DeadlineScheduler), the break trigger is part of the break.
+        builder.wait(BELT_COMMAND_WAIT)
+        builder.add(BELT, 'vibrate', intensity)
+        builder.add(STIMULUS_ONSET, label, intensity, params.trial_length - BELT_COMMAND_WAIT)
+        builder.wait(params.trial_length - BELT_COMMAND_WAIT)
+        builder.add(BELT, 'stop')
+        builder.add(STIMULUS_OFFSET, label, intensity)
+        builder.pulse('break', triggers[2], blocking=False)
+        builder.wait(params.trial_break)
+    builder.trial = 0
+
+
+def _compile_fingertapping(builder, ft_round):
+    """
+    Adds a fingertapping round (ScreenController.start_fingertapping_screen).
+    The key press triggers depend on the participant and are not planned.
+    """
+    builder.flip()
+    builder.add(SCREEN, 'fingertapping_instructions')
+    builder.add(WAIT_FOR_KEY, 'fingertapping_instructions')
+    builder.flip()
+    builder.add(SCREEN, 'fingertapping_sequence', duration=TAPPING_DURATION)
+    builder.add(FINGERTAPPING, 'start', ft_round, TAPPING_DURATION)
+    builder.pulse('fingertapping_sequence', SEQUENCE_TRIGGER, blocking=False)
+    builder.wait(TAPPING_DURATION)
+    builder.add(FINGERTAPPING, 'end', ft_round)
+    builder.flip()
+    builder.add(SCREEN, 'fingertapping_end', duration=FINGERTAPPING_END_WAIT)
+    builder.wait(FINGERTAPPING_END_WAIT)
+    builder.pulse('fingertapping_end', TAPPING_END_TRIGGER)
+    builder.flip()
+    builder.add(SCREEN, 'pause')
+    builder.pulse('pause', PAUSE_TRIGGER)
+    builder.add(WAIT_FOR_KEY, 'pause')
+
+
+def compile_session(block_names, sequences, params, frame_rate=None):
+    """
+    Compiles a session into a timeline of events.
+
+    Parameters
+    ----------
+    block_names : list
+        The names of the block functions in the order they are run, see
+        block_order.BLOCK_NAMES.
+    sequences : ndarray
+        The stimulus sequences of the blocks, in the same order.
+    params : module
+        The parameter module, or any object with its attributes (trial_break,
+        trial_length, circle_colors, the trigger lists and the vibration
+        intensities).
+    frame_rate : float
+        The refresh rate the visual stimuli are locked to, or None if the
+        stimulus durations are waited in seconds (parameter.frame_locked).
+        With a frame rate the flips of the screens are moved to the frame
+        grid, see the module docstring.
+
+    Returns
+    -------
+    list
+        The events of the session, ordered by time.
+    """
+    builder = _TimelineBuilder(frame_rate)
+    builder.add(BELT, 'connect', duration=BELT_CONNECT_WAIT)
+    builder.wait(BELT_CONNECT_WAIT)
+    builder.flip()
+    builder.add(SCREEN, 'instructions')
+    builder.add(WAIT_FOR_KEY, 'instructions')
+
+    ft_round = 0
+    for i, (name, sequence) in enumerate(zip(block_names, sequences)):
+        builder.block = i + 1
+        builder.wait(BLOCK_PAUSE)
+        builder.flip()
+        builder.add(SCREEN, 'ready')
+        builder.pulse('ready', READY_TRIGGER)
+        builder.add(WAIT_FOR_KEY, 'ready')
+        builder.flip()
+        builder.add(SCREEN, 'fixation')
+        builder.pulse('fixation', FIXATION_TRIGGER)
+
+        if name in ('visual_oddball', 'visual_swapped_oddball'):
+            _compile_visual_block(builder, sequence, params, name == 'visual_swapped_oddball', frame_rate)
+        elif name in ('vibrotactile_oddball_ankle', 'vibrotactile_swapped_oddball_ankle'):
+            _compile_vibrotactile_block(builder, sequence, params, name == 'vibrotactile_swapped_oddball_ankle')
+        else:
+            raise ValueError('Unknown block: %s' % name)
+
+        if i % 2 == 0:
+            ft_round += 1
+            _compile_fingertapping(builder, ft_round)
+
+    builder.block = 0
+    builder.add(BELT, 'disconnect')
+    builder.flip()
+    builder.add(SCREEN, 'thank_you')
+    builder.add(WAIT_FOR_KEY, 'thank_you')
+    return builder.events
+
+
+def predicted_duration(events, key_wait=0.0):
+    """
+    Returns the predicted duration of a session in seconds.
+
+    Parameters
+    ----------
+    events : list
+        The timeline of the session.
+    key_wait : float
+        The assumed time the participant needs at every self-paced wait.
+    """
+    if not events:
+        return 0.0
+    n_waits = sum(1 for event in events if event.kind == WAIT_FOR_KEY)
+    return max(event.time + event.duration for event in events) + n_waits * key_wait
+
+
+def save_timeline(file_name, events):
+    """Writes the events to a CSV file with one column per field of Event."""
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(Event._fields)
+        writer.writerows(events)
+
+
+def print_summary(events, key_wait=0.0):
+    """Prints the predicted duration of the session and of every block."""
+    n_waits = sum(1 for event in events if event.kind == WAIT_FOR_KEY)
+    log.info('Predicted session duration: %.1f s (%.1f min) without participant responses, %i self-paced waits',
+             predicted_duration(events), predicted_duration(events) / 60, n_waits)
+    if key_wait > 0:
+        log.info('With %.1f s per self-paced wait: %.1f min', key_wait, predicted_duration(events, key_wait) / 60)
+    for block in sorted(set(event.block for event in events) - {0}):
+        block_events = [event for event in events if event.block == block]
+        start = block_events[0].time
+        end = max(event.time + event.duration for event in block_events)
+        log.info('Block %i: %.1f s to %.1f s', block, start, end)
+
+
+class TimelineExecutor():
+    """
+    Runs a timeline: waits until every event is due and passes it to ``handle``.
+
+    The base class runs in real time and does nothing with the events, the
+    self-paced waits return immediately. Subclasses override ``handle`` to
+    drive the hardware or a simulation and ``clock``, ``sleep`` and
+    ``wait_for_key`` to change how time passes.
+
+    Parameters
+    ----------
+    events : list
+        The timeline to run.
+
+    Attributes
+    ----------
+    events : list
+        Stores the timeline to run.
+    executed : list
+        A tuple (event, time in seconds from the start) for every event that
+        was run.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.executed = []
+
+    def clock(self):
+        """Returns the current time in seconds."""
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        """Waits for the given time."""
+        time.sleep(seconds)
+
+    def wait_for_key(self, event):
+        """Waits until the participant continues."""
+        pass
+
+    def handle(self, event):
+        """Runs an event."""
+        pass
+
+    def run(self):
+        """
+        Runs all events at their planned time plus the time spent in the
+        self-paced waits before them.
+
+        Returns
+        -------
+        float
+            The duration of the session in seconds.
+        """
+        start = self.clock()
+        waited = 0.0
+        for event in self.events:
+            delay = start + waited + event.time - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            self.executed.append((event, self.clock() - start))
+            if event.kind == WAIT_FOR_KEY:
+                wait_start = self.clock()
+                self.wait_for_key(event)
+                waited += self.clock() - wait_start
+            else:
+                self.handle(event)
+        return self.clock() - start
+
+
+class ConsoleExecutor(TimelineExecutor):
+    """Prints every event when it is due, e.g. to check the triggers without hardware."""
+
+    def handle(self, event):
+        print('%9.3f  block %i  trial %3i  %-15s %-26s %s'
+              % (event.time, event.block, event.trial, event.kind, event.name,
+                 '' if event.value is None else event.value))
+
+
+class SimulatedExecutor(TimelineExecutor):
+    """
+    Runs a timeline on a virtual clock, without waiting.
+
+    Parameters
+    ----------
+    events : list
+        The timeline to run.
+    key_wait : float
+        The time the simulated participant needs at every self-paced wait.
+
+    Attributes
+    ----------
+    time : float
+        The virtual time in seconds.
+    """
+
+    def __init__(self, events, key_wait=0.0):
+        TimelineExecutor.__init__(self, events)
+        self.key_wait = key_wait
+        self.time = 0.0
+
+    def clock(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+    def wait_for_key(self, event):
+        self.time += self.key_wait
+
+
+def main():
+    """Prints the predicted session duration of the participant entered in parameter.py."""
+    import parameter
+    import block_order
+    import trial_sequences
+
+    frame_rate = float(sys.argv[1]) if len(sys.argv) > 1 else None
+    planner = block_order.BlockOrderPlanner(parameter.block_order_file_name)
+    block_names = planner.names_for_participant(parameter.participant_ID)
+    seed = trial_sequences.session_seed(parameter.participant_ID, parameter.random_seed)
+    sequences = trial_sequences.generate_session_sequences(len(block_names), parameter.trials,
+                                                           parameter.oddball_ratio, seed,
+                                                           parameter.max_oddball_run,
+                                                           parameter.min_standards_after)
+    events = compile_session(block_names, sequences, parameter, frame_rate)
+    print_summary(events)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,592 @@
+"""
+Dry run of the full Experiment on a virtual clock, without belt, parallel port,
+display or participant.
+- VirtualClock: a clock that advances when the experiment sleeps or waits
+- RealClock: the same interface on the real clock, for headless runs in real
+  time
+- HeadlessWindow / HeadlessStim: stand in for the PsychoPy window and stimuli,
+  a flip advances the clock to the next frame
+- RecordingPort: stands in for the parallel port and records every trigger
+- FakeBeltController: stands in for the BeltController
+- SimulatedParticipant: presses a key after every self-paced screen and taps
+  the fingertapping sequence shown on the screen
+- ExperimentSimulation: runs Experiment.start with all of the above swapped in
+- compare_triggers: compares the recorded triggers with the compiled timeline
+
+The simulation swaps the module globals the experiment uses (time, core,
+visual, event, keyboard, classicbelt.p, ...) for the duration of the run and
+restores them afterwards, such that the experiment code runs unchanged. The
+session data (session file, timeline, fingertapping CSV and store) is written
+to the output directory.
+
+Usage:
+    python simulation.py [participant ID] [output directory] [--name=value ...]
+
+The --name=value arguments override the settings of config.py, e.g.
+--trials=200.
+"""
+
+import importlib, os, queue, sys, time, types
+import numpy as np
+import config, console, session_timeline
+
+CLOCK_TICK = 1e-5
+# Time in seconds that passes on every read of the virtual clock, such that
+# loops that spin on the clock come to an end
+
+FRAME_RATE = 60.0
+# Refresh rate of the headless window
+
+BELT_CONNECT_WAIT = session_timeline.BELT_CONNECT_WAIT
+# Time the fake belt needs to connect, like the serial port flush of the real one
+
+KEY_PRESS = 'key_press'
+# Kind of the events of the simulated fingertapping key presses
+
+
+class VirtualClock():
+    """
+    A clock that only advances when it is slept on or read.
+
+    It provides the functions of the time module the experiment uses, thus it
+    can be put in place of the module.
+
+    Parameters
+    ----------
+    tick : float
+        The time that passes on every read.
+
+    Attributes
+    ----------
+    now : float
+        The current virtual time in seconds.
+    """
+
+    def __init__(self, tick=CLOCK_TICK):
+        self.tick = tick
+        self.now = 0.0
+
+    def perf_counter(self):
+        self.now += self.tick
+        return self.now
+
+    time = perf_counter
+    monotonic = perf_counter
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def wait_until(self, moment):
+        """Advances the clock to the given time, if it is not past it already."""
+        self.now = max(self.now, moment)
+
+
+class RealClock():
+    """
+    Stands in for the time module like VirtualClock, but on the real clock.
+    A headless run on it takes as long as the real session and shows how the
+    timing holds up against the scheduling of the operating system.
+
+    Attributes
+    ----------
+    now : float
+        The time in seconds since the clock was created.
+    """
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+
+    @property
+    def now(self):
+        return time.perf_counter() - self._origin
+
+    def perf_counter(self):
+        return self.now
+
+    time = perf_counter
+    monotonic = perf_counter
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait_until(self, moment):
+        """Waits until the clock reaches the given time."""
+        self.sleep(moment - self.now)
+        while self.now < moment:
+            pass
+
+
+class VirtualTimer():
+    """Stands in for psychopy.core.Clock: the time since the last reset."""
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._start = clock.now
+
+    def reset(self):
+        self._start = self._clock.now
+
+    def getTime(self):
+        return self._clock.now - self._start
+
+    def getLastResetTime(self):
+        return self._start
+
+
+class HeadlessStim():
+    """
+    Stands in for a PsychoPy stimulus (TextStim, Circle, ShapeStim). Drawing
+    it adds it to the next flip of its window.
+    """
+
+    def __init__(self, win, kind, text=None, fillColor=None, **kwargs):
+        self.win = win
+        self.kind = kind
+        self.text = text
+        self.fillColor = fillColor
+
+    def draw(self):
+        self.win.drawn.append(self)
+
+    def describe(self):
+        """Returns a short name of the stimulus for the event log."""
+        if self.text is not None:
+            return 'text: ' + ' '.join(self.text.split())[:40]
+        if self.fillColor is not None:
+            return '%s: %s' % (self.kind, self.fillColor)
+        return self.kind
+
+
+class HeadlessWindow():
+    """
+    Stands in for psychopy.visual.Window. A flip waits for the next frame of
+    the virtual clock, runs the functions registered with callOnFlip and
+    records the screen in the event log when its content changes.
+    """
+
+    def __init__(self, simulation, *args, **kwargs):
+        self.simulation = simulation
+        self.drawn = []
+        self.recordFrameIntervals = False
+        self.frameIntervals = []
+        self.refreshThreshold = None
+        self._on_flip = []
+        self._last_frame = None
+        self._screen = None
+        simulation.window = self
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.simulation.frame_rate
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._on_flip.append((function, args, kwargs))
+
+    def clearBuffer(self):
+        self.drawn = []
+
+    def flip(self):
+        # Frames are counted in integers, such that rounding cannot give two
+        # flips in the same frame, with the rule of the planned timeline
+        clock = self.simulation.clock
+        frame = session_timeline.next_frame(clock.now, self.simulation.frame_rate, self._last_frame)
+        flip_time = frame / self.simulation.frame_rate
+        clock.wait_until(flip_time)
+        if self.recordFrameIntervals and self._last_frame is not None:
+            self.frameIntervals.append((frame - self._last_frame) / self.simulation.frame_rate)
+        self._last_frame = frame
+
+        on_flip, self._on_flip = self._on_flip, []
+        for function, args, kwargs in on_flip:
+            function(*args, **kwargs)
+
+        screen = ', '.join(stim.describe() for stim in self.drawn)
+        if screen != self._screen:
+            self.simulation.record(session_timeline.SCREEN, screen or 'empty')
+            self._screen = screen
+        self.simulation.screen_texts = [stim.text for stim in self.drawn if stim.text is not None]
+        self.drawn = []
+        return flip_time
+
+    def close(self):
+        pass
+
+
+class RecordingPort():
+    """Stands in for the parallel port (classicbelt.p) and records every change of the data."""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def setData(self, data):
+        self.simulation.record(session_timeline.TRIGGER, 'setData', int(data))
+
+
+class FakeBeltController():
+    """
+    Stands in for classicbelt.BeltController. Connecting takes
+    BELT_CONNECT_WAIT and a vibration waits 10 ms before its command like the
+    real controller, which sends no trigger (its p.setData calls are commented
+    out), all other commands only go to the event log.
+    """
+
+    def __init__(self, simulation, *args, **kwargs):
+        self.simulation = simulation
+        self.connected = False
+
+    def getBeltMode(self):
+        return 0
+
+    def getBeltConnectionState(self):
+        return 2 if self.connected else 0
+
+    def connectBeltSerial(self, port=None):
+        self.simulation.clock.sleep(BELT_CONNECT_WAIT)
+        self.connected = True
+        self.simulation.record(session_timeline.BELT, 'connect')
+
+    def connectBeltBT(self, address=None, name=None, transport='bluetooth'):
+        self.connectBeltSerial()
+
+    def disconnectBelt(self, join=False):
+        self.connected = False
+        self.simulation.record(session_timeline.BELT, 'disconnect')
+
+    def vibrateAtPositions(self, indexes, trigger_number, channel_idx=0, intensity=-1, *args, **kwargs):
+        self.simulation.clock.sleep(0.01)
+        self.simulation.record(session_timeline.BELT, 'vibrate', intensity)
+
+    def stopVibration(self, channel_idx=-1, wait_ack=False):
+        self.simulation.record(session_timeline.BELT, 'stop')
+
+    def getAckLatency(self):
+        return None
+
+    def getOutputQueueDepth(self):
+        return 0
+
+    def enableWatchdog(self, enabled=True):
+        pass
+
+    def getConnectionGaps(self):
+        return []
+
+    def getRecoveryTimes(self):
+        return []
+
+
+class SimulatedParticipant():
+    """
+    Presses a key after every self-paced screen and taps the fingertapping
+    sequence shown on the screen at a constant rate.
+
+    Parameters
+    ----------
+    response_time : float
+        The time in seconds the participant needs to continue at a
+        self-paced screen.
+    tap_interval : float
+        The time in seconds between two key presses in the fingertapping task.
+    error_rate : float
+        The probability of a wrong key press.
+    seed : int
+        The seed of the wrong key presses.
+    """
+
+    def __init__(self, response_time=0.0, tap_interval=0.25, error_rate=0.0, seed=0):
+        self.response_time = response_time
+        self.tap_interval = tap_interval
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+
+    def tap(self, sequence_text, tap_index):
+        """Returns the key of the tap_index-th press while ``sequence_text`` (e.g. '2 - 3 - 1 - 4 - 2') is shown."""
+        digits = [digit for digit in sequence_text if digit.isdigit()][:4]
+        if self.error_rate > 0 and self.rng.random() < self.error_rate:
+            return str(self.rng.integers(1, 5))
+        return digits[tap_index % len(digits)]
+
+
+class ScriptedKeyboard():
+    """Stands in for psychopy.hardware.keyboard.Keyboard: only its clock is used."""
+
+    def __init__(self, simulation, *args, **kwargs):
+        self.simulation = simulation
+        self.clock = VirtualTimer(simulation.clock)
+
+    def clearEvents(self):
+        pass
+
+    def getKeys(self, *args, **kwargs):
+        return []
+
+
+class ScriptedKeyListener():
+    """
+    Stands in for fingertapping_functions.TappingKeyListener. Instead of
+    reading the keyboard in a thread, ``get_key`` advances the clock to the
+    next key press of the simulated participant.
+    """
+
+    def __init__(self, keyboard, key_list):
+        self.keyboard = keyboard
+        self.simulation = keyboard.simulation
+        self.key_queue = queue.Queue()
+        self._taps = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_key(self, deadline):
+        participant = self.simulation.participant
+        clock = self.simulation.clock
+        onset = self.keyboard.clock.getLastResetTime()
+        tap_time = onset + (self._taps + 1) * participant.tap_interval
+        if tap_time >= deadline:
+            clock.wait_until(deadline)
+            return None
+        clock.wait_until(tap_time)
+
+        sequence_text = next((text for text in self.simulation.screen_texts if ' - ' in text), '1 - 2 - 3 - 4')
+        key = participant.tap(sequence_text, self._taps)
+        self._taps += 1
+        self.simulation.record(KEY_PRESS, 'tap', int(key))
+        return key, tap_time - onset
+
+
+class ExperimentSimulation():
+    """
+    Runs the full Experiment on a virtual clock.
+
+    Parameters
+    ----------
+    participant_ID : int
+        The ID of the simulated participant. It selects the block order and
+        the seed of the trial sequences like a real one.
+    output_directory : str
+        The directory that receives the session data of the simulation.
+    participant : SimulatedParticipant
+        The simulated participant, or None for one that responds at once.
+    frame_rate : float
+        The refresh rate of the headless window.
+    frame_locked : bool
+        Overrides parameter.frame_locked, or None to keep it.
+    realtime : bool
+        Runs the session on the real clock (RealClock) instead of the virtual one.
+
+    Attributes
+    ----------
+    clock : VirtualClock or RealClock
+        The clock of the run.
+    port : RecordingPort
+        The trigger port of the run.
+    events : list
+        The events of the run as session_timeline.Event, times in seconds
+        from the start of the session.
+    duration : float
+        The virtual duration of the session in seconds.
+    session_file_name : str
+        The session file (seed, block order, sequences) of the run.
+    """
+
+    def __init__(self, participant_ID, output_directory, participant=None, frame_rate=FRAME_RATE,
+                 frame_locked=None, realtime=False):
+        self.participant_ID = participant_ID
+        self.output_directory = output_directory
+        self.participant = participant if participant is not None else SimulatedParticipant()
+        self.frame_rate = frame_rate
+        self.frame_locked = frame_locked
+        self.clock = RealClock() if realtime else VirtualClock()
+        self.port = RecordingPort(self)
+        self.window = None
+        self.screen_texts = []
+        self.events = []
+        self.duration = None
+        self.session_file_name = os.path.join(output_directory, 'Session_participant_%s.npz' % participant_ID)
+        self._start = 0.0
+        self._swapped = []
+
+    def record(self, kind, name, value=None):
+        """Adds an event at the current virtual time to the event log."""
+        self.events.append(session_timeline.Event(self.clock.now - self._start, 0.0, kind, name, value, 0, 0))
+
+    def wait_keys(self, *args, **kwargs):
+        """Stands in for psychopy.event.waitKeys."""
+        self.record(session_timeline.WAIT_FOR_KEY, 'waitKeys')
+        self.clock.sleep(self.participant.response_time)
+        return ['space']
+
+    def _swap(self, module, name, value):
+        """Replaces a module global until the end of the run."""
+        self._swapped.append((module, name, getattr(module, name, None), hasattr(module, name)))
+        setattr(module, name, value)
+
+    def _restore(self):
+        for module, name, value, existed in reversed(self._swapped):
+            if existed:
+                setattr(module, name, value)
+            else:
+                delattr(module, name)
+        self._swapped = []
+
+    def _import_parameter(self):
+        """Imports the parameter module with the simulated participant ID, such that it does not ask for one."""
+        if 'parameter' in sys.modules:
+            return sys.modules['parameter']
+        for name, value in config.environment_overrides({'participant_ID': self.participant_ID}).items():
+            os.environ.setdefault(name, value)
+        return importlib.import_module('parameter')
+
+    def run(self, resume=False):
+        """
+        Runs Experiment.start and returns the event log.
+
+        Parameters
+        ----------
+        resume : bool
+            Resumes the session from the checkpoint of an earlier run in the
+            same output directory.
+
+        Returns
+        -------
+        list
+            The events of the session, see ``events``.
+        """
+        parameter = self._import_parameter()
+        import experiment_code, visual_functions, vibrotactile_functions
+        import scheduler, fingertapping_functions
+        from pybelt import classicbelt
+
+        os.makedirs(self.output_directory, exist_ok=True)
+        output = lambda name: os.path.join(self.output_directory, name)
+        core = types.SimpleNamespace(wait=self.clock.sleep, Clock=lambda: VirtualTimer(self.clock),
+                                     quit=lambda: None)
+        visual = types.SimpleNamespace(Window=lambda *args, **kwargs: HeadlessWindow(self, *args, **kwargs),
+                                       TextStim=lambda win, **kwargs: HeadlessStim(win, 'text', **kwargs),
+                                       Circle=lambda win, **kwargs: HeadlessStim(win, 'circle', **kwargs),
+                                       ShapeStim=lambda win, **kwargs: HeadlessStim(win, 'fixation', **kwargs))
+
+        try:
+            # Parameters of the simulated session
+            self._swap(parameter, 'participant_ID', self.participant_ID)
+            self._swap(parameter, 'io_process', False)
+            if self.frame_locked is not None:
+                self._swap(parameter, 'frame_locked', self.frame_locked)
+            self._swap(parameter, 'fingertapping_file_name',
+                       output('Fingertapping_participant_%s.csv' % self.participant_ID))
+            self._swap(parameter, 'fingertapping_store_directory', output('store'))
+            self._swap(parameter, 'session_file_name', self.session_file_name)
+            self._swap(parameter, 'timeline_file_name', output('Timeline_participant_%s.csv' % self.participant_ID))
+            self._swap(parameter, 'block_order_file_name', output('block_orders.npz'))
+            self._swap(parameter, 'trace_file_name', output('Trace_participant_%s.json' % self.participant_ID))
+            self._swap(parameter, 'checkpoint_file_name', output('Checkpoint_participant_%s.json' % self.participant_ID))
+
+            # Clock, screen, keyboard, belt and trigger port
+            for module in (experiment_code, visual_functions, vibrotactile_functions, scheduler):
+                self._swap(module, 'time', self.clock)
+            for module in (visual_functions, vibrotactile_functions):
+                self._swap(module, 'core', core)
+            self._swap(visual_functions, 'visual', visual)
+            self._swap(visual_functions, 'event', types.SimpleNamespace(waitKeys=self.wait_keys))
+            self._swap(visual_functions, 'keyboard',
+                       types.SimpleNamespace(Keyboard=lambda *args, **kwargs: ScriptedKeyboard(self)))
+            self._swap(fingertapping_functions, 'TappingKeyListener', ScriptedKeyListener)
+            self._swap(classicbelt, 'BeltController', lambda *args, **kwargs: FakeBeltController(self))
+            self._swap(classicbelt, 'p', self.port)
+
+            experiment = experiment_code.Experiment()
+            self._start = self.clock.now
+            self.events = []
+            experiment.start(resume)
+            self.duration = self.clock.now - self._start
+        finally:
+            self._restore()
+
+        session_timeline.save_timeline(output('Simulated_events_participant_%s.csv' % self.participant_ID),
+                                       self.events)
+        return self.events
+
+
+def compare_triggers(recorded, planned, response_time=0.0):
+    """
+    Compares the recorded trigger onsets of a simulation with the planned ones.
+
+    The planned times are shifted by ``response_time`` for every self-paced
+    wait before them. Key press triggers are not planned and are left out.
+
+    Parameters
+    ----------
+    recorded : list
+        The events of a simulation.
+    planned : list
+        The compiled timeline of the same session.
+    response_time : float
+        The response time of the simulated participant.
+
+    Returns
+    -------
+    dict
+        'triggers': number of planned triggers, 'mismatches': number of
+        positions at which the trigger codes differ, 'max_deviation': largest
+        difference between recorded and planned onset, 'max_block_deviation':
+        the same relative to the first trigger of every block, in seconds.
+    """
+    planned_codes, planned_times, planned_blocks = [], [], []
+    waits = 0
+    for event in planned:
+        if event.kind == session_timeline.WAIT_FOR_KEY:
+            waits += 1
+        elif event.kind == session_timeline.TRIGGER:
+            planned_codes.append(event.value)
+            planned_times.append(event.time + waits * response_time)
+            planned_blocks.append(event.block)
+
+    # A trigger is planned at the onset of its pulse; key press triggers (18) are not planned
+    onsets = [event for event in recorded
+              if event.kind == session_timeline.TRIGGER and event.value not in (0, 18)]
+    n = min(len(onsets), len(planned_codes))
+    recorded_codes = np.array([event.value for event in onsets[:n]])
+    deviation = np.array([event.time for event in onsets[:n]]) - np.array(planned_times[:n])
+    blocks = np.array(planned_blocks[:n])
+
+    block_deviation = np.zeros(n)
+    for block in np.unique(blocks[blocks > 0]):
+        in_block = blocks == block
+        block_deviation[in_block] = deviation[in_block] - deviation[in_block][0]
+
+    return {'triggers': len(planned_codes),
+            'mismatches': int(np.sum(recorded_codes != np.array(planned_codes[:n]))) +
+                          abs(len(onsets) - len(planned_codes)),
+            'max_deviation': float(np.abs(deviation).max()) if n else 0.0,
+            'max_block_deviation': float(np.abs(block_deviation).max()) if n else 0.0}
+
+
+def main():
+    """Simulates the session of a participant and compares its triggers with the compiled timeline."""
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    participant_ID = int(arguments[0]) if len(arguments) > 0 else 1
+    output_directory = arguments[1] if len(arguments) > 1 else 'Simulation_Data'
+
+    simulation = ExperimentSimulation(participant_ID, output_directory)
+    events = simulation.run()
+
+    import parameter, trial_sequences
+    seed, block_names, sequences = trial_sequences.load_session(simulation.session_file_name)
+    planned = session_timeline.compile_session(block_names, sequences, parameter,
+                                               simulation.frame_rate if parameter.frame_locked else None)
+    comparison = compare_triggers(events, planned, simulation.participant.response_time)
+
+    # Print after the console output of the session
+    console.flush()
+    print('Simulated session: %.1f s virtual time, %i events' % (simulation.duration, len(events)))
+    print('Planned duration: %.1f s' % session_timeline.predicted_duration(planned))
+    print('Triggers: %i planned, %i mismatches, max deviation %.3f ms, max deviation within a block %.3f ms'
+          % (comparison['triggers'], comparison['mismatches'], comparison['max_deviation'] * 1000,
+             comparison['max_block_deviation'] * 1000))
+
+if __name__ == "__main__":
+    main()
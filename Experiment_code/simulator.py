@@ -0,0 +1,346 @@
+"""
+Monte Carlo simulation of the block orders and stimulus sequences of many sessions.
+- session_block_orders: the block orders of a batch of participants
+- generate_sequence_batch: the stimulus orders of a batch of blocks at once
+- block_statistics: block positions, block transitions and the blocks before
+  every fingertapping round
+- sequence_statistics: oddball probability per trial, stimulus transitions and
+  oddball run lengths
+- simulate: runs the simulation in batches, optionally on several processes
+- print_report: prints the statistics of a simulation
+
+Every batch is generated with numpy arrays of shape (sessions, ...), there is no
+loop over sessions, blocks or trials. The sequences follow the same
+distribution as those of trial_sequences, but not the same random stream, i.e.
+a simulated session is not the session of the participant with that ID.
+
+Usage:
+    python simulator.py [sessions] [processes] [planner|uniform]
+"""
+
+import os, sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import block_order
+import trial_sequences
+
+BATCH_SIZE = 20000
+# Number of sessions generated at once by one process
+
+BLOCKS_PER_FINGERTAPPING = 2
+# A fingertapping round follows every second block, starting after the first one
+
+
+def session_block_orders(participant_IDs, valid_orders, assignment, rng=None):
+    """
+    Returns the block orders of a batch of participants.
+
+    Parameters
+    ----------
+    participant_IDs : ndarray
+        The IDs of the participants, starting at 1.
+    valid_orders : ndarray
+        All valid block orders (see block_order.enumerate_valid_orders).
+    assignment : ndarray
+        The orders assigned to consecutive participant IDs (see
+        block_order.balanced_assignment), or None to draw every order
+        uniformly from the valid orders, which is what a random shuffle
+        without counterbalancing gives.
+    rng : numpy.random.Generator
+        The random generator, only used if ``assignment`` is None.
+
+    Returns
+    -------
+    ndarray
+        uint8 array of shape (n_participants, n_positions).
+    """
+    if assignment is None:
+        return valid_orders[rng.integers(len(valid_orders), size=len(participant_IDs))]
+    return valid_orders[assignment[(np.asarray(participant_IDs) - 1) % len(assignment)]]
+
+
+def _choose_per_row(rng, n_places, n_chosen, max_places):
+    """
+    Chooses ``n_chosen[i]`` of the first ``n_places[i]`` places of every row
+    without replacement. Returns a bool array of shape (rows, max_places).
+    """
+    keys = rng.random((len(n_places), max_places))
+    keys[np.arange(max_places)[None, :] >= n_places[:, None]] = np.inf
+    # The chosen places are those with the n_chosen smallest keys
+    kth = np.take_along_axis(np.sort(keys, axis=1), np.maximum(n_chosen - 1, 0)[:, None], axis=1)
+    return (keys <= kth) & (n_chosen[:, None] > 0)
+
+
+def generate_sequence_batch(n_sequences, trials, oddball_ratio, rng, max_oddball_run=None, min_standards_after=0):
+    """
+    Generates the stimulus orders of many blocks at once.
+
+    Without constraints the oddballs are placed at random, like
+    trial_sequences.generate_block_sequence. With constraints the construction
+    of trial_sequences.generate_constrained_block_sequence is done for all
+    blocks at once: the run lengths (trial_sequences.draw_run_lengths) and the
+    gaps between the runs are drawn row by row with the same probabilities.
+
+    Parameters
+    ----------
+    n_sequences : int
+        The number of blocks.
+    trials : int
+        The number of trials per block.
+    oddball_ratio : float
+        The proportion of oddball stimuli.
+    rng : numpy.random.Generator
+        The random generator.
+    max_oddball_run : int
+        The maximum number of consecutive oddballs, or None for sequences
+        without constraints.
+    min_standards_after : int
+        The minimum number of standards after every run of oddballs.
+
+    Returns
+    -------
+    ndarray
+        uint8 array of shape (n_sequences, trials), ODDBALL or STANDARD per trial.
+    """
+    n_oddballs = trial_sequences.oddball_count(trials, oddball_ratio)
+    n_standards = trials - n_oddballs
+    if n_oddballs == 0:
+        return np.full((n_sequences, trials), trial_sequences.STANDARD, dtype=np.uint8)
+
+    if max_oddball_run is None:
+        oddball = _choose_per_row(rng, np.full(n_sequences, trials), np.full(n_sequences, n_oddballs), trials)
+        return np.where(oddball, trial_sequences.ODDBALL, trial_sequences.STANDARD).astype(np.uint8)
+
+    n_runs, run_lengths = trial_sequences.draw_run_lengths(n_oddballs, n_standards, max_oddball_run,
+                                                           min_standards_after, rng, n_sequences)
+    max_runs = int(n_runs.max())
+    run_lengths = run_lengths[:, :max_runs]
+    rows = np.arange(n_sequences)
+    run_index = np.arange(max_runs)[None, :]
+
+    # Split the free standards into n_runs + 1 gaps (stars and bars). The
+    # standards before the first bar form gap 0, those after bar j gap j.
+    free_standards = trial_sequences._free_standards(n_standards, n_runs, min_standards_after)
+    n_places = free_standards + n_runs
+    max_places = int(n_places.max())
+    bars = _choose_per_row(rng, n_places, n_runs, max_places)
+    is_star = ~bars & (np.arange(max_places)[None, :] < n_places[:, None])
+    gap_of_star = np.cumsum(bars, axis=1)
+    gaps = np.bincount((rows[:, None] * (max_runs + 1) + gap_of_star)[is_star],
+                       minlength=n_sequences * (max_runs + 1)).reshape(n_sequences, max_runs + 1)
+    gap_index = np.arange(max_runs + 1)[None, :]
+    gaps += np.where((gap_index >= 1) & (gap_index < n_runs[:, None]), max(min_standards_after, 1), 0)
+    gaps += np.where(gap_index == n_runs[:, None], min_standards_after, 0)
+
+    # Run j starts after gaps 0..j and runs 0..j-1; mark starts with +1 and
+    # ends with -1 and sum up along the trials
+    run_starts = np.cumsum(gaps[:, :-1], axis=1) + np.cumsum(run_lengths, axis=1) - run_lengths
+    run_ends = run_starts + run_lengths
+    valid = run_index < n_runs[:, None]
+    width = trials + 1
+    offsets = rows[:, None] * width
+    marks = (np.bincount((offsets + run_starts)[valid], minlength=n_sequences * width) -
+             np.bincount((offsets + run_ends)[valid], minlength=n_sequences * width))
+    oddball = np.cumsum(marks.reshape(n_sequences, width), axis=1)[:, :trials]
+    return oddball.astype(np.uint8)
+
+
+def block_statistics(orders, n_blocks=len(block_order.BLOCK_NAMES)):
+    """
+    Counts the block positions and transitions of a batch of block orders.
+
+    Parameters
+    ----------
+    orders : ndarray
+        The block orders, shape (n_sessions, n_positions).
+    n_blocks : int
+        The number of block types.
+
+    Returns
+    -------
+    dict
+        'positions': counts of shape (n_positions, n_blocks), how often a block
+        is run at a position.
+        'transitions': counts of shape (n_blocks, n_blocks), how often the
+        block of the column directly follows the block of the row.
+        'fingertapping': counts of shape (n_rounds, n_blocks), how often a
+        block is run directly before a fingertapping round.
+    """
+    orders = np.asarray(orders, dtype=np.int64)
+    n_positions = orders.shape[1]
+    positions = np.bincount((np.arange(n_positions)[None, :] * n_blocks + orders).ravel(),
+                            minlength=n_positions * n_blocks).reshape(n_positions, n_blocks)
+    transitions = np.bincount((orders[:, :-1] * n_blocks + orders[:, 1:]).ravel(),
+                              minlength=n_blocks * n_blocks).reshape(n_blocks, n_blocks)
+    fingertapping = positions[::BLOCKS_PER_FINGERTAPPING]
+    return {'positions': positions, 'transitions': transitions, 'fingertapping': fingertapping}
+
+
+def sequence_statistics(sequences):
+    """
+    Counts the oddballs per trial, the stimulus transitions and the oddball runs
+    of a batch of sequences.
+
+    Parameters
+    ----------
+    sequences : ndarray
+        The stimulus orders, shape (n_sequences, trials).
+
+    Returns
+    -------
+    dict
+        'oddballs_per_trial': oddball count per trial of the block.
+        'transitions': counts of shape (2, 2), how often the stimulus of the
+        column (STANDARD, ODDBALL) directly follows the one of the row.
+        'run_lengths': count of oddball runs per run length (index).
+        'sequences': the number of sequences.
+    """
+    sequences = np.asarray(sequences, dtype=np.int64)
+    n_sequences, trials = sequences.shape
+    oddballs_per_trial = sequences.sum(axis=0)
+    transitions = np.bincount((sequences[:, :-1] * 2 + sequences[:, 1:]).ravel(), minlength=4).reshape(2, 2)
+
+    # Runs start where the padded sequence rises and end where it falls, the
+    # starts and ends of all rows are found in the same order
+    padded = np.zeros((n_sequences, trials + 2), dtype=np.int8)
+    padded[:, 1:-1] = sequences
+    steps = np.diff(padded, axis=1)
+    lengths = np.flatnonzero(steps == -1) - np.flatnonzero(steps == 1)
+    run_lengths = np.bincount(lengths, minlength=trials + 1)
+    return {'oddballs_per_trial': oddballs_per_trial, 'transitions': transitions,
+            'run_lengths': run_lengths, 'sequences': n_sequences}
+
+
+def simulate_batch(task):
+    """
+    Simulates one batch of sessions. Runs in a worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        (first participant ID, number of sessions, numpy.random.SeedSequence,
+        settings dict of ``simulate``, valid orders, assignment or None).
+
+    Returns
+    -------
+    dict
+        The block statistics and the sequence statistics of the batch.
+    """
+    first_ID, n_sessions, seed_sequence, settings, valid_orders, assignment = task
+    rng = np.random.default_rng(seed_sequence)
+    orders = session_block_orders(np.arange(first_ID, first_ID + n_sessions), valid_orders, assignment, rng)
+    sequences = generate_sequence_batch(n_sessions * orders.shape[1], settings['trials'],
+                                        settings['oddball_ratio'], rng, settings['max_oddball_run'],
+                                        settings['min_standards_after'])
+    return {'blocks': block_statistics(orders), 'sequences': sequence_statistics(sequences)}
+
+
+def _add_statistics(total, batch):
+    """Adds the counts of a batch to the total counts."""
+    if total is None:
+        return batch
+    return {part: {name: total[part][name] + batch[part][name] for name in total[part]} for part in total}
+
+
+def simulate(n_sessions, trials=20, oddball_ratio=0.3, max_oddball_run=None, min_standards_after=0,
+             counterbalanced=True, seed=0, processes=None, batch_size=BATCH_SIZE):
+    """
+    Simulates the block orders and stimulus sequences of many sessions.
+
+    Parameters
+    ----------
+    n_sessions : int
+        The number of sessions, i.e. participants with IDs 1 to n_sessions.
+    trials, oddball_ratio, max_oddball_run, min_standards_after
+        The settings of the sequences, as in parameter.py.
+    counterbalanced : bool
+        If True, the block orders are those of the BlockOrderPlanner, otherwise
+        they are drawn uniformly from all valid orders.
+    seed : int
+        The seed of the simulation.
+    processes : int
+        The number of worker processes, None for one per CPU or 1 to run in
+        this process.
+    batch_size : int
+        The number of sessions per batch.
+
+    Returns
+    -------
+    dict
+        'blocks': the summed block statistics (see block_statistics),
+        'sequences': the summed sequence statistics (see sequence_statistics),
+        'sessions': the number of sessions.
+    """
+    valid_orders = block_order.enumerate_valid_orders()
+    assignment = block_order.balanced_assignment(valid_orders) if counterbalanced else None
+    settings = {'trials': trials, 'oddball_ratio': oddball_ratio,
+                'max_oddball_run': max_oddball_run, 'min_standards_after': min_standards_after}
+
+    first_IDs = np.arange(1, n_sessions + 1, batch_size)
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(first_IDs))
+    tasks = [(int(first_ID), int(min(batch_size, n_sessions + 1 - first_ID)), seed_sequence, settings,
+              valid_orders, assignment)
+             for first_ID, seed_sequence in zip(first_IDs, seed_sequences)]
+
+    total = None
+    if processes == 1 or len(tasks) == 1:
+        for task in tasks:
+            total = _add_statistics(total, simulate_batch(task))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for batch in executor.map(simulate_batch, tasks):
+                total = _add_statistics(total, batch)
+    total['sessions'] = n_sessions
+    return total
+
+
+def print_report(results):
+    """Prints the positional bias, the transition matrices and the run lengths of a simulation."""
+    blocks = results['blocks']
+    sequences = results['sequences']
+    names = block_order.BLOCK_NAMES
+    n_blocks = len(names)
+    n_sessions = results['sessions']
+
+    print('Simulated sessions: %i' % n_sessions)
+    print('\nBlock per position (share of sessions, balanced: %.3f)' % (1 / n_blocks))
+    print('position  ' + '  '.join('%8s' % ('block %i' % i) for i in range(n_blocks)))
+    for position, counts in enumerate(blocks['positions']):
+        print('%8i  ' % (position + 1) + '  '.join('%8.3f' % share for share in counts / n_sessions))
+    bias = np.abs(blocks['positions'] / n_sessions - 1 / n_blocks).max()
+    print('largest deviation from balance: %.4f' % bias)
+
+    print('\nBlock transitions (share of transitions from the block of the row)')
+    shares = blocks['transitions'] / np.maximum(blocks['transitions'].sum(axis=1, keepdims=True), 1)
+    for i, row in enumerate(shares):
+        print('block %i   ' % i + '  '.join('%8.3f' % share for share in row))
+
+    print('\nBlock before the fingertapping rounds (share of sessions)')
+    for ft_round, counts in enumerate(blocks['fingertapping']):
+        print('round %i   ' % (ft_round + 1) + '  '.join('%8.3f' % share for share in counts / n_sessions))
+    for i, name in enumerate(names):
+        print('block %i: %s' % (i, name))
+
+    print('\nOddball probability per trial (%i blocks)' % sequences['sequences'])
+    print(' '.join('%.3f' % p for p in sequences['oddballs_per_trial'] / sequences['sequences']))
+
+    transitions = sequences['transitions'] / sequences['transitions'].sum(axis=1, keepdims=True)
+    print('\nStimulus transitions     standard   oddball')
+    print('after a standard       %9.3f  %8.3f' % tuple(transitions[0]))
+    print('after an oddball       %9.3f  %8.3f' % tuple(transitions[1]))
+
+    print('\nOddball run lengths (share of runs)')
+    run_lengths = sequences['run_lengths']
+    for length in np.flatnonzero(run_lengths):
+        print('%2i: %.4f' % (length, run_lengths[length] / run_lengths.sum()))
+
+
+def main():
+    """Simulates a number of sessions with the default parameters and prints the report."""
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    counterbalanced = (sys.argv[3] != 'uniform') if len(sys.argv) > 3 else True
+    print_report(simulate(n_sessions, counterbalanced=counterbalanced, processes=processes))
+
+if __name__ == "__main__":
+    main()
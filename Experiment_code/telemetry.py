@@ -0,0 +1,296 @@
+"""
+Live timing telemetry of a running session for the experimenter.
+- MetricsBuffer: a ring buffer of trial records, written by the stimulus
+  thread without locks
+- publish: adds the record of a trial, does nothing if telemetry is off
+- register_gauge: adds a value (e.g. the belt ACK latency) that the server
+  samples itself, off the stimulus thread
+- TelemetryServer: an HTTP server on localhost that serves the records as JSON
+  and streams them as server-sent events
+- start_telemetry / stop_telemetry: switch the telemetry on and off
+
+Publishing a trial only stores a tuple in a preallocated list, all encoding
+and network I/O happens in the threads of the server. Open
+http://localhost:<port>/ in a browser to watch the trials, or read
+/metrics?since=<n> and /stream from a script.
+
+Usage:
+    python telemetry.py [port]
+runs a server with dummy trials, to try the page without an experiment.
+"""
+
+import json, math, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import console
+
+TELEMETRY_PORT = 8765
+# Default port of the telemetry server
+
+BUFFER_CAPACITY = 4096
+# Number of trial records the ring buffer holds
+
+STREAM_INTERVAL = 0.05
+# Time in seconds between two messages of the event stream
+
+FIELDS = ('time', 'block', 'trial', 'stimulus', 'onset_error', 'dropped_frames')
+# Fields of a trial record: time of time.perf_counter() at publishing, block
+# name, trial number, 'oddball' or 'standard', lateness of the trial onset in
+# seconds (nan if unknown) and number of dropped frames
+
+metrics = None
+# The MetricsBuffer of the running telemetry, None if telemetry is off
+
+_gauges = {}
+# Functions of the gauges, sampled by the server
+
+log = console.get_logger(__name__)
+# Console output of the telemetry (see console.py)
+
+
+class MetricsBuffer():
+    """
+    A ring buffer of trial records for one writer (the stimulus thread) and
+    any number of readers.
+
+    The writer stores the record first and counts it afterwards. Both are
+    single assignments, which the GIL makes atomic, thus a reader never sees a
+    counted record that is incomplete. A reader that falls more than the
+    capacity behind loses the oldest records.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of records the buffer holds.
+
+    Attributes
+    ----------
+    written : int
+        The number of records written since the start.
+    """
+
+    def __init__(self, capacity=BUFFER_CAPACITY):
+        self.capacity = capacity
+        self.written = 0
+        self._slots = [None] * capacity
+
+    def publish(self, record):
+        """Stores a record (a tuple of FIELDS)."""
+        self._slots[self.written % self.capacity] = record
+        self.written += 1
+
+    def read(self, since=0):
+        """
+        Returns the records after the first ``since`` ones.
+
+        Returns
+        -------
+        records : list
+            The records that are still in the buffer, oldest first.
+        written : int
+            The number of records written, the ``since`` of the next read.
+        lost : int
+            The number of requested records that were already overwritten.
+        """
+        written = self.written
+        first = max(since, written - self.capacity)
+        records = [self._slots[index % self.capacity] for index in range(first, written)]
+        return records, written, first - since
+
+
+def publish(block, trial, stimulus, onset_error=math.nan, dropped_frames=0):
+    """
+    Adds the record of a trial to the telemetry. Called on the stimulus
+    thread after every trial; does nothing if telemetry is off.
+
+    Parameters
+    ----------
+    block : str
+        The name of the block.
+    trial : int
+        The number of the trial in the block, starting at 1.
+    stimulus : str
+        'oddball' or 'standard'.
+    onset_error : float
+        How late the trial started against its deadline, in seconds.
+    dropped_frames : int
+        The number of frames dropped in the trial.
+    """
+    if metrics is not None:
+        metrics.publish((time.perf_counter(), block, trial, stimulus, onset_error, dropped_frames))
+
+
+def register_gauge(name, function):
+    """
+    Adds a gauge: a function without arguments that returns a number or None.
+    The server samples the gauges for every message, in its own thread.
+    """
+    _gauges[name] = function
+
+
+def sample_gauges():
+    """Returns the current values of the gauges, None for a gauge that fails."""
+    values = {}
+    for name, function in list(_gauges.items()):
+        try:
+            values[name] = function()
+        except Exception:
+            values[name] = None
+    return values
+
+
+def _message(records, written, lost):
+    """Returns the JSON message with the given records and the current gauges."""
+    trials = [{name: (None if isinstance(value, float) and math.isnan(value) else value)
+               for name, value in zip(FIELDS, record)} for record in records]
+    return json.dumps({'next': written, 'lost': lost, 'trials': trials, 'gauges': sample_gauges()})
+
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>Session telemetry</title>
+<style>body{font-family:monospace} td,th{padding:0 8px;text-align:right} .late{color:red}</style></head>
+<body><h3>Session telemetry</h3><p id="gauges"></p>
+<table><thead><tr><th>block</th><th>trial</th><th>stimulus</th><th>onset error ms</th><th>dropped frames</th></tr></thead>
+<tbody id="trials"></tbody></table>
+<script>
+var source = new EventSource('/stream');
+source.onmessage = function(event) {
+  var message = JSON.parse(event.data);
+  document.getElementById('gauges').textContent = JSON.stringify(message.gauges);
+  var body = document.getElementById('trials');
+  message.trials.forEach(function(t) {
+    var row = body.insertRow(0);
+    var error = t.onset_error === null ? '' : (t.onset_error * 1000).toFixed(3);
+    [t.block, t.trial, t.stimulus, error, t.dropped_frames].forEach(function(value) {
+      row.insertCell().textContent = value;
+    });
+    if (t.onset_error > 0.001 || t.dropped_frames > 0) row.className = 'late';
+  });
+  while (body.rows.length > 200) body.deleteRow(-1);
+};
+</script></body></html>
+"""
+# Page that shows the streamed trials, newest first
+
+
+class _TelemetryHandler(BaseHTTPRequestHandler):
+    """Serves the page, the records as JSON (/metrics) and the event stream (/stream)."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/':
+            self._send(200, 'text/html', PAGE.encode())
+        elif url.path == '/metrics':
+            since = int(parse_qs(url.query).get('since', ['0'])[0])
+            self._send(200, 'application/json', _message(*self.server.buffer.read(since)).encode())
+        elif url.path == '/stream':
+            self._stream()
+        else:
+            self._send(404, 'text/plain', b'Not found')
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        since = self.server.buffer.written
+        try:
+            while not self.server.stop_flag:
+                records, since, lost = self.server.buffer.read(since)
+                self.wfile.write(('data: %s\n\n' % _message(records, since, lost)).encode())
+                self.wfile.flush()
+                time.sleep(STREAM_INTERVAL)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        # No console output for the requests
+        pass
+
+
+class TelemetryServer(threading.Thread):
+    """
+    Runs the HTTP server of the telemetry in a daemon thread. Every client of
+    the event stream is served by its own thread.
+
+    Parameters
+    ----------
+    buffer : MetricsBuffer
+        The buffer the records are read from.
+    port : int
+        The port on localhost.
+
+    Attributes
+    ----------
+    stop_flag : bool
+        Stops the thread and the event streams.
+    """
+
+    def __init__(self, buffer, port=TELEMETRY_PORT):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = port
+        self.stop_flag = False
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _TelemetryHandler)
+        self._server.daemon_threads = True
+        self._server.buffer = buffer
+        self._server.stop_flag = False
+
+    def run(self):
+        self._server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        """Stops the server and closes its socket."""
+        self.stop_flag = True
+        self._server.stop_flag = True
+        self._server.shutdown()
+        self._server.server_close()
+
+
+_server = None
+# The TelemetryServer of the running telemetry
+
+
+def start_telemetry(port=TELEMETRY_PORT, capacity=BUFFER_CAPACITY):
+    """Switches the telemetry on and starts its server. Returns the server."""
+    global metrics, _server
+    metrics = MetricsBuffer(capacity)
+    _server = TelemetryServer(metrics, port)
+    _server.start()
+    log.info('Telemetry on http://localhost:%i/', port)
+    return _server
+
+
+def stop_telemetry():
+    """Stops the server and switches the telemetry off."""
+    global metrics, _server
+    if _server is not None:
+        _server.stop()
+    metrics = None
+    _server = None
+    _gauges.clear()
+
+
+def main():
+    """Runs the telemetry with a dummy trial every 1.5 s, until interrupted."""
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else TELEMETRY_PORT
+    console.start_console()
+    start_telemetry(port)
+    register_gauge('ack_latency', lambda: 0.004)
+    trial = 0
+    try:
+        while True:
+            trial += 1
+            publish('dummy block', trial, 'oddball' if trial % 3 == 0 else 'standard', 0.0001 * (trial % 5))
+            time.sleep(1.5)
+    except KeyboardInterrupt:
+        stop_telemetry()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Generation of the stimulus sequences of the oddball blocks.
+- session_seed: the seed of a participant's session
+- generate_block_sequence: the stimulus order of one block
+- generate_constrained_block_sequence: the stimulus order of one block with limited
+  oddball runs and a minimum number of standards after every run
+- draw_run_lengths: the oddball runs of constrained blocks, many blocks at once
+- generate_session_sequences: the stimulus orders of all blocks of a session
+- save_session / load_session: store the seed, block order and sequences with the session
+
+All sequences of a session are generated before the first block, such that the
+blocks only iterate over them. A sequence is a uint8 array with one entry per
+trial: 1 for an oddball and 0 for a standard stimulus.
+"""
+
+import functools, os, math
+import numpy as np
+
+ODDBALL = 1
+STANDARD = 0
+# Codes of the stimuli in a sequence
+
+
+def session_seed(participant_ID, random_seed=None):
+    """
+    Returns the seed of a participant's session.
+
+    Parameters
+    ----------
+    participant_ID : int
+        The ID of the participant. Used as seed if no seed is given.
+    random_seed : int
+        A seed that overrides the participant ID, or None.
+    """
+    if random_seed is not None:
+        return int(random_seed)
+    return int(participant_ID)
+
+
+def oddball_count(trials, oddball_ratio):
+    """Returns the number of oddballs in a block, rounded to the nearest integer."""
+    return int(round(trials * oddball_ratio))
+
+
+def generate_block_sequence(trials, oddball_ratio, rng):
+    """
+    Generates the stimulus order of one block.
+
+    Exactly ``trials`` stimuli are generated, ``oddball_count(trials, oddball_ratio)``
+    of them oddballs, in random order.
+
+    Parameters
+    ----------
+    trials : int
+        The number of trials in the block.
+    oddball_ratio : float
+        The proportion of oddball stimuli.
+    rng : numpy.random.Generator
+        The random generator of the session.
+
+    Returns
+    -------
+    ndarray
+        uint8 array of length ``trials``, ODDBALL or STANDARD per trial.
+    """
+    sequence = np.full(trials, STANDARD, dtype=np.uint8)
+    sequence[:oddball_count(trials, oddball_ratio)] = ODDBALL
+    rng.shuffle(sequence)
+    return sequence
+
+
+def _free_standards(n_standards, n_runs, min_standards_after):
+    """
+    Returns the number of standards that are not required to separate the
+    oddball runs. Runs are separated by at least one standard (otherwise they
+    would form one run) and at least ``min_standards_after`` follow every run.
+    """
+    separation = max(min_standards_after, 1)
+    return n_standards - (n_runs - 1) * separation - min_standards_after
+
+
+def _log_binomial(n, k):
+    """Returns log(n choose k) for integer arrays n >= k >= 0."""
+    lgamma = np.vectorize(math.lgamma, otypes=[np.float64])
+    return lgamma(n + 1.0) - lgamma(k + 1.0) - lgamma(n - k + 1.0)
+
+
+def _solve_increasing(function, target, low=-30.0, high=30.0, iterations=60):
+    """Returns x in [low, high] with function(x) = target for an increasing function, by bisection."""
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        if function(middle) < target:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+@functools.lru_cache(maxsize=64)
+def _run_length_proposal(n_oddballs, n_standards, max_oddball_run, min_standards_after):
+    """
+    Returns the proposal of draw_run_lengths for blocks with these numbers of
+    stimuli and constraints: the probabilities of the run lengths 1 to
+    max_oddball_run, and for every number of runs k (0 to n_oddballs) the log
+    probability with which a proposal of k runs is accepted.
+
+    The lengths are proposed with probabilities proportional to t**length, so
+    a proposal of k runs that adds up to n_oddballs has a probability
+    proportional to y**k, with y = 1 / (t + t**2 + ... + t**max_oddball_run).
+    Accepting it with a probability proportional to (gap splits of k) / y**k
+    gives every sequence the same probability. t is chosen such that the
+    proposed number of runs is near the most likely one, where the log of
+    the gap splits falls by log(y) per run, which keeps the acceptance high.
+    """
+    run_counts = np.arange(n_oddballs + 1)
+    free_standards = _free_standards(n_standards, run_counts, min_standards_after)
+    feasible = (run_counts >= 1) & (run_counts * max_oddball_run >= n_oddballs) & (free_standards >= 0)
+    if not feasible.any():
+        raise ValueError('No sequence with %i oddballs, %i standards, runs of at most %i oddballs and '
+                         '%i standards after every run exists.'
+                         % (n_oddballs, n_standards, max_oddball_run, min_standards_after))
+    candidates = run_counts[feasible]
+    # Number of ways to split the free standards into the k + 1 gaps (stars and bars)
+    log_gap_splits = np.full(n_oddballs + 1, -np.inf)
+    log_gap_splits[feasible] = _log_binomial(free_standards[feasible] + candidates, candidates)
+
+    lengths = np.arange(1, max_oddball_run + 1)
+
+    def log_length_sum(log_t):
+        exponents = lengths * log_t
+        return exponents.max() + np.log(np.exp(exponents - exponents.max()).sum())
+
+    def mean_length(log_t):
+        return (lengths * np.exp(lengths * log_t - log_length_sum(log_t))).sum()
+
+    # Keep the proposed number of runs (about n_oddballs / mean length) in the feasible range
+    low = _solve_increasing(mean_length, n_oddballs / candidates[-1])
+    high = _solve_increasing(mean_length, n_oddballs / candidates[0])
+    if len(candidates) > 1:
+        slopes = np.diff(log_gap_splits[candidates])
+
+        def balance(log_t):
+            runs = n_oddballs / mean_length(log_t)
+            return np.interp(runs, candidates[:-1] + 0.5, slopes) + log_length_sum(log_t)
+
+        log_t = _solve_increasing(balance, 0.0, low, high)
+    else:
+        log_t = (low + high) / 2
+
+    probabilities = np.exp(lengths * log_t - log_length_sum(log_t))
+    log_accept = log_gap_splits + run_counts * log_length_sum(log_t)
+    log_accept -= log_accept[feasible].max()
+    return probabilities / probabilities.sum(), log_accept
+
+
+def draw_run_lengths(n_oddballs, n_standards, max_oddball_run, min_standards_after, rng, size=1):
+    """
+    Draws the lengths of the oddball runs of constrained blocks, such that
+    every block sequence that satisfies the constraints is equally likely once
+    the standards are split into the gaps between the runs.
+
+    Run lengths are proposed independently until they add up to exactly
+    n_oddballs, and a proposal is accepted with a probability that depends on
+    its number of runs only (see _run_length_proposal). On average a few
+    proposals are needed, each of O(n_oddballs), and all blocks are drawn at
+    once.
+
+    Parameters
+    ----------
+    n_oddballs : int
+        The number of oddballs per block.
+    n_standards : int
+        The number of standards per block.
+    max_oddball_run : int
+        The maximum number of consecutive oddballs.
+    min_standards_after : int
+        The minimum number of standards after every run of oddballs.
+    rng : numpy.random.Generator
+        The random generator.
+    size : int
+        The number of blocks.
+
+    Returns
+    -------
+    n_runs : ndarray
+        The number of runs of every block, shape (size,).
+    run_lengths : ndarray
+        The run lengths, shape (size, n_oddballs), zero after the last run.
+
+    Exception
+    ---------
+    Raises a ValueError if no sequence satisfies the constraints.
+    """
+    probabilities, log_accept = _run_length_proposal(n_oddballs, n_standards, max_oddball_run,
+                                                     min_standards_after)
+    n_runs = np.zeros(size, dtype=np.int64)
+    run_lengths = np.zeros((size, n_oddballs), dtype=np.int64)
+    pending = np.arange(size)
+    while len(pending) > 0:
+        proposals = 1 + rng.choice(max_oddball_run, size=(len(pending), n_oddballs), p=probabilities)
+        ends = np.cumsum(proposals, axis=1)
+        runs = (ends <= n_oddballs).sum(axis=1)
+        hit = (runs > 0) & (ends[np.arange(len(pending)), np.maximum(runs - 1, 0)] == n_oddballs)
+        accepted = hit & (np.log(rng.random(len(pending))) < log_accept[runs])
+        rows = pending[accepted]
+        n_runs[rows] = runs[accepted]
+        run_lengths[rows] = np.where(np.arange(n_oddballs)[None, :] < runs[accepted, None], proposals[accepted], 0)
+        pending = pending[~accepted]
+    return n_runs, run_lengths
+
+
+def generate_constrained_block_sequence(trials, oddball_ratio, rng, max_oddball_run=1, min_standards_after=1):
+    """
+    Generates the stimulus order of one block in which oddballs come in runs of
+    at most ``max_oddball_run`` and every run is followed by at least
+    ``min_standards_after`` standards.
+
+    The sequence is constructed from its oddball runs: first the run lengths
+    are drawn (see draw_run_lengths), then the number of standards between
+    them, such that every sequence that satisfies the constraints is equally
+    likely. The number of oddballs is exactly
+    ``oddball_count(trials, oddball_ratio)``.
+
+    Parameters
+    ----------
+    trials : int
+        The number of trials in the block.
+    oddball_ratio : float
+        The proportion of oddball stimuli.
+    rng : numpy.random.Generator
+        The random generator of the session.
+    max_oddball_run : int
+        The maximum number of consecutive oddballs.
+    min_standards_after : int
+        The minimum number of standards after every run of oddballs.
+
+    Returns
+    -------
+    ndarray
+        uint8 array of length ``trials``, ODDBALL or STANDARD per trial.
+
+    Exception
+    ---------
+    Raises a ValueError if no sequence satisfies the constraints.
+    """
+    n_oddballs = oddball_count(trials, oddball_ratio)
+    n_standards = trials - n_oddballs
+    if n_oddballs == 0:
+        return np.full(trials, STANDARD, dtype=np.uint8)
+
+    n_runs, run_lengths = draw_run_lengths(n_oddballs, n_standards, max_oddball_run, min_standards_after, rng)
+    n_runs = int(n_runs[0])
+    run_lengths = run_lengths[0, :n_runs]
+
+    # Split the free standards into n_runs + 1 gaps (stars and bars)
+    free_standards = _free_standards(n_standards, n_runs, min_standards_after)
+    bars = np.sort(rng.choice(free_standards + n_runs, size=n_runs, replace=False))
+    gaps = np.diff(np.concatenate([[-1], bars, [free_standards + n_runs]])) - 1
+    gaps[1:-1] += max(min_standards_after, 1)
+    gaps[-1] += min_standards_after
+
+    # Interleave gap 0, run 1, gap 1, ..., run k, gap k
+    lengths = np.empty(2 * n_runs + 1, dtype=np.int64)
+    lengths[0::2] = gaps
+    lengths[1::2] = run_lengths
+    values = np.full(2 * n_runs + 1, STANDARD, dtype=np.uint8)
+    values[1::2] = ODDBALL
+    return np.repeat(values, lengths)
+
+
+def generate_session_sequences(n_blocks, trials, oddball_ratio, seed, max_oddball_run=None, min_standards_after=0):
+    """
+    Generates the stimulus orders of all blocks of a session.
+
+    Parameters
+    ----------
+    n_blocks : int
+        The number of blocks in the session.
+    trials : int
+        The number of trials per block.
+    oddball_ratio : float
+        The proportion of oddball stimuli.
+    seed : int
+        The seed of the session. The same seed gives the same sequences.
+    max_oddball_run : int
+        The maximum number of consecutive oddballs, or None for sequences
+        without constraints.
+    min_standards_after : int
+        The minimum number of standards after every run of oddballs. Only used
+        together with ``max_oddball_run``.
+
+    Returns
+    -------
+    ndarray
+        uint8 array of shape (n_blocks, trials).
+    """
+    rng = np.random.default_rng(seed)
+    sequences = np.empty((n_blocks, trials), dtype=np.uint8)
+    for block in range(n_blocks):
+        if max_oddball_run is None:
+            sequences[block] = generate_block_sequence(trials, oddball_ratio, rng)
+        else:
+            sequences[block] = generate_constrained_block_sequence(trials, oddball_ratio, rng,
+                                                                   max_oddball_run, min_standards_after)
+    return sequences
+
+
+def save_session(file_name, seed, block_order, sequences):
+    """
+    Saves the seed, block order and stimulus sequences of a session.
+
+    Parameters
+    ----------
+    file_name : str
+        The .npz file of the session.
+    seed : int
+        The seed of the session.
+    block_order : list
+        The names of the blocks in the order they are run.
+    sequences : ndarray
+        The sequences of the blocks, in the same order.
+    """
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    np.savez(file_name, seed=seed, block_order=np.array(block_order), sequences=sequences)
+
+
+def load_session(file_name):
+    """
+    Loads a session saved by ``save_session``.
+
+    Returns
+    -------
+    seed : int
+        The seed of the session.
+    block_order : list
+        The names of the blocks in the order they are run.
+    sequences : ndarray
+        The sequences of the blocks, in the same order.
+    """
+    with np.load(file_name) as session:
+        return int(session['seed']), session['block_order'].tolist(), session['sequences']
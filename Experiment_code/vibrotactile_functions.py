@@ -13,7 +13,16 @@ from pybelt import classicbelt
 import parallel
 import random, time
 import numpy as np
+import trial_sequences
+import scheduler
+import io_process
+import telemetry
+import console
 from psychopy import core
+
+log = console.get_logger(__name__)
+# Console output of the belt blocks (see console.py)
+
 class VibrationController():
     """
     The VibrationController controls the connection to the feelSpace belt.
@@ -31,6 +40,17 @@ class VibrationController():
         The length of the break between stimuli presentations in seconds.
     trial_length : float
         Defines the length of the trial (each stimulus presentation) in seconds.
+    belt_watchdog : bool
+        Reconnects the belt automatically when the connection is lost (see
+        BeltController.enableWatchdog).
+    gap_trigger : int
+        The trigger code sent at the onset of a vibration that the belt
+        cannot play because it is reconnecting, 0 for none.
+    belt_interface : str
+        How the belt is connected: 'usb', 'bluetooth' or 'loopback' (a belt
+        emulator, see pybelt/transports.py).
+    belt_name : str
+        The Bluetooth name of the belt or a part of it, '' for any belt.
 
     Attributes
     ----------
@@ -47,13 +67,35 @@ class VibrationController():
         Stores the length of the break between stimuli presentations in seconds.
     trial_length : float
         Stores the length of the trial (stimulus presentation) in seconds.
+    scheduler : DeadlineScheduler
+        Plans the stimulus onsets and offsets of a block from its start.
+    io_client : IOProcessClient
+        The client of the belt and trigger I/O process, or None if the belt is
+        controlled in this process. With the I/O process, the commands of a
+        block are sent ahead with their deadlines instead of waiting for them.
+    gap_trigger : int
+        Stores the trigger code of a vibration lost while the belt reconnects.
+    block_gaps : int
+        The number of connection gaps of the belt before the current block.
+    onset_error : float
+        How late the vibration of the last trial started against its deadline
+        in seconds, nan with the I/O process (see its report instead).
     """
 
     def __init__(self, ankle_vibromotor, ankle_trigger, ankle_swapped_trigger,
-                vibration_strong, vibration_weak, trial_break, trial_length):
+                vibration_strong, vibration_weak, trial_break, trial_length, io_client=None,
+                belt_watchdog=False, gap_trigger=0, belt_interface='usb', belt_name=''):
         """Constructor that initializes the belt controller."""
-        # Instantiate a belt controller
-        self.belt_controller = classicbelt.BeltController(delegate=self)
+        # Instantiate a belt controller, unless the I/O process owns it
+        self.io_client = io_client
+        if io_client is None:
+            self.belt_controller = classicbelt.BeltController(delegate=self)
+            self.belt_controller.enableWatchdog(belt_watchdog)
+            if belt_interface == 'bluetooth':
+                # Look for the belt in the background until it is connected
+                classicbelt.startBTDiscovery()
+        else:
+            self.belt_controller = None
         self.ankle_vibromotor = ankle_vibromotor
         self.ankle_trigger = ankle_trigger
         self.ankle_swapped_trigger = ankle_swapped_trigger
@@ -61,67 +103,110 @@ class VibrationController():
         self.vibration_weak = vibration_weak
         self.trial_break = trial_break
         self.trial_length = trial_length
+        self.gap_trigger = gap_trigger
+        self.belt_interface = belt_interface
+        self.belt_name = belt_name
+        self.block_gaps = 0
+        self.scheduler = scheduler.DeadlineScheduler('vibrotactile block')
+        self.onset_error = float('nan')
 
     def connect_to_USB(self):
-        """Connect the belt to the serial port (USB)"""
+        """Connect the belt to the serial port (USB), or via Bluetooth or the loopback emulator if configured"""
+        if self.belt_interface != 'usb':
+            log.info("Connect belt via %s.", self.belt_interface)
+            self.belt_controller.connectBeltBT(name=self.belt_name or None, transport=self.belt_interface)
+            return
         # connect belt to usb serial port
-        print("Connect belt via USB.")
-        print("Mode of the belt: ", self.belt_controller.getBeltMode())
+        log.info("Connect belt via USB.")
+        if self.io_client is not None:
+            log.info('Belt connected in the I/O process: %s', self.io_client.connect())
+            return
+        log.info('Mode of the belt: %s', self.belt_controller.getBeltMode())
         self.belt_controller.connectBeltSerial()
 
     def disconnect_belt(self):
         """Disconnect belt from serial port (USB)"""
+        if self.io_client is not None:
+            self.io_client.disconnect()
+            return
         self.belt_controller.disconnectBelt()
 
-    def vibrotactile_oddball_ankle(self, trials, oddball_ratio):
+    def start_block(self):
+        """
+        Starts the timing of a block. With the I/O process the first deadline
+        lies LEAD_TIME in the future, such that the first commands arrive in time.
+        """
+        self.scheduler.start_block()
+        if self.io_client is not None:
+            self.scheduler.advance(io_process.LEAD_TIME)
+        else:
+            self.block_gaps = len(self.belt_controller.getConnectionGaps())
+
+    def wait(self, seconds):
+        """
+        Waits for the next deadline. With the I/O process the deadline is only
+        planned, the I/O process keeps the time.
+        """
+        if self.io_client is None:
+            self.scheduler.wait(seconds)
+        else:
+            self.scheduler.advance(seconds)
+
+    def finish_block(self):
+        """Waits until the last deadline of the block and prints the timing and the belt reconnections of the block."""
+        if self.io_client is not None:
+            self.scheduler.wait(0.0)
+            log.info(*self.io_client.report_args())
+        log.info(*self.scheduler.report_args())
+        if self.io_client is None:
+            recovery_times = self.belt_controller.getRecoveryTimes()[self.block_gaps:]
+            if recovery_times:
+                log.warning('Belt reconnected %i times in this block, recovery time max %.3f s',
+                            len(recovery_times), max(recovery_times))
+
+    def vibrotactile_oddball_ankle(self, sequence):
         """
         Start oddball vibration pattern at the ankle.
 
         Parameters:
         ----------
-        trials : int
-            A decimal integer indicating the nr. of trials
-        oddball_ratio : float
-            Indicating the proportion of odd stimuli
+        sequence : ndarray
+            The stimulus order of this block, one entry per trial
+            (1 = oddball, 0 = standard), see trial_sequences.py.
         """
         # Output used as control option for the experimenter.
-        print('-----------------------------------')
-        print('           VIBROTACTILE ANKLE          ')
-        print('-----------------------------------\n')
-
-        total_trial_standard = np.zeros(int(trials*(1-oddball_ratio)))
-        total_trial_oddball = np.ones(int(trials*(oddball_ratio)))
-        total_trial = np.concatenate([total_trial_oddball, total_trial_standard])
+        log.info('-----------------------------------')
+        log.info('           VIBROTACTILE ANKLE          ')
+        log.info('-----------------------------------\n')
 
         oddball_count = 0
         standard_count = 0
         swapped = False
 
-        for i in range(trials):
-
-            np.random.shuffle(total_trial)
-            random_number = total_trial[0]
+        # The trials are timed from the start of the block
+        self.start_block()
+        for i, trial in enumerate(sequence):
 
-            if random_number==1:
+            if trial == trial_sequences.ODDBALL:
                 mode = "oddball"
                 oddball_count += 1
             else:
                 mode = "standard"
                 standard_count += 1
 
-            print('MODE (standard or oddball): ', mode)
+            log.info('MODE (standard or oddball): %s', mode)
 
             self.start_trial(mode, swapped, [self.ankle_vibromotor], self.ankle_trigger)
-
-            total_trial = np.delete(total_trial, 0)
+            telemetry.publish('vibrotactile_oddball_ankle', i+1, mode, self.onset_error)
 
             # break between trials
-            time.sleep(self.trial_break)
+            self.wait(self.trial_break)
 
-        print('oddballs', oddball_count)
-        print('standards', standard_count)
+        log.info('oddballs %i', oddball_count)
+        log.info('standards %i', standard_count)
+        self.finish_block()
 
-    def vibrotactile_swapped_oddball_ankle(self, trials, oddball_ratio):
+    def vibrotactile_swapped_oddball_ankle(self, sequence):
         """
         Start oddball vibration pattern at the ankle but with swapped intensity for
         the oddball/standard condition. In the swapped condition the oddball
@@ -129,52 +214,47 @@ class VibrationController():
 
         Parameters:
         ----------
-        trials : int
-            A decimal integer indicating the nr. of trials
-        oddball_ratio : float
-            Indicating the proportion of odd stimuli
+        sequence : ndarray
+            The stimulus order of this block, one entry per trial
+            (1 = oddball, 0 = standard), see trial_sequences.py.
         """
         # Output used as control option for the experimenter.
-        print('-----------------------------------------------')
-        print('           VIBROTACTILE ANKLE SWAPPED         ')
-        print('-----------------------------------------------\n')
-
-        total_trial_standard = np.zeros(int(trials*(1-oddball_ratio)))
-        total_trial_oddball = np.ones(int(trials*(oddball_ratio)))
-        total_trial = np.concatenate([total_trial_oddball, total_trial_standard])
+        log.info('-----------------------------------------------')
+        log.info('           VIBROTACTILE ANKLE SWAPPED         ')
+        log.info('-----------------------------------------------\n')
 
         oddball_count = 0
         standard_count = 0
         swapped = True
 
-        for i in range(trials):
+        # The trials are timed from the start of the block
+        self.start_block()
+        for i, trial in enumerate(sequence):
 
-            np.random.shuffle(total_trial)
-            random_number = total_trial[0]
-
-            if random_number==1:
+            if trial == trial_sequences.ODDBALL:
                 stimulus = "oddball"
                 oddball_count += 1
             else:
                 stimulus = "standard"
                 standard_count += 1
 
-            print('Stimulus (standard or oddball): ', stimulus)
+            log.info('Stimulus (standard or oddball): %s', stimulus)
 
             self.start_trial(stimulus, swapped, [self.ankle_vibromotor], self.ankle_swapped_trigger)
-
-            total_trial = np.delete(total_trial, 0)
+            telemetry.publish('vibrotactile_swapped_oddball_ankle', i+1, stimulus, self.onset_error)
 
             # break between trials
-            time.sleep(self.trial_break)
+            self.wait(self.trial_break)
 
-        print('oddballs', oddball_count)
-        print('standards', standard_count)
+        log.info('oddballs %i', oddball_count)
+        log.info('standards %i', standard_count)
+        self.finish_block()
 
 
     def start_trial(self, stimulus, swapped, vibromotors, trigger_codes):
         """
-        Either an oddball or a standard vibration starts.
+        Either an oddball or a standard vibration starts. The vibration is
+        stopped trial_length after the planned onset of the trial.
 
         Parameters
         ----------
@@ -195,15 +275,35 @@ class VibrationController():
             vibration_standard = self.vibration_strong
             vibration_oddball = self.vibration_weak
 
+        if self.io_client is not None:
+            # Send the trial to the I/O process with its deadlines
+            onset = self.scheduler.deadline()
+            if stimulus == "standard":
+                self.io_client.vibrate(vibromotors[0], vibration_standard, trigger_codes[1], onset)
+            elif stimulus == "oddball":
+                self.io_client.vibrate(vibromotors[0], vibration_oddball, trigger_codes[0], onset)
+            self.io_client.stop_vibration(onset + self.trial_length)
+            self.io_client.pulse(trigger_codes[2], onset + self.trial_length)
+            self.scheduler.advance(self.trial_length)
+            return
+
+        self.onset_error = time.perf_counter() - self.scheduler.deadline()
+        if self.belt_controller.getBeltConnectionState() != classicbelt.BeltConnectionState.CONNECTED:
+            # Mark the trial without vibration in the EEG
+            log.warning('No vibration in this trial, the belt is not connected')
+            if self.gap_trigger:
+                classicbelt.p.setData(self.gap_trigger)
+                core.wait(0.01)
+                classicbelt.p.setData(0)
         if stimulus == "standard":
             self.belt_controller.vibrateAtPositions(vibromotors, trigger_codes[1], 1, vibration_standard)
-            time.sleep(self.trial_length)
+            self.scheduler.wait(self.trial_length)
             self.belt_controller.stopVibration()
 
         elif stimulus == "oddball":
             # Vibrate a first time (trigger is set in classicbelt function)
             self.belt_controller.vibrateAtPositions(vibromotors, trigger_codes[0], 1, vibration_oddball)
-            time.sleep(self.trial_length)
+            self.scheduler.wait(self.trial_length)
             self.belt_controller.stopVibration()
 
         # Trigger break
@@ -10,12 +10,21 @@ This file includes functions for the visual oddball part that used in the Experi
 """
 
 from psychopy import visual, event, data, logging, core
+from psychopy.hardware import keyboard
 import random, datetime, time
 import parameter
 import numpy as np
-import csv
+import fingertapping_functions
+import fingertapping_store
+import trial_sequences
+import scheduler
+import telemetry
+import console
 from pybelt import classicbelt # we need this to set the trigger
 
+log = console.get_logger(__name__)
+# Console output of the screen (see console.py)
+
 class ScreenController():
     """
 
@@ -47,10 +56,44 @@ class ScreenController():
         Stores the ID of the current participant.
     fingertapping_file_name : str
         Stores the name of the file that saves the fingertapping data.
+    fingertapping_store : FingertappingStore
+        The columnar store that receives every fingertapping round.
     win : Window (object of psychoPy library)
         Represents the window that is monitoring stimuli, text and fixation cross.
     globalClock : Clock (object of core package)
         Stores the exact current time. Used for measuring reaction times in fingertapping.
+    keyboard : Keyboard (object of psychopy.hardware.keyboard)
+        Records the fingertapping key presses with device timestamps.
+    tapping_duration : float
+        The length of a fingertapping round in seconds.
+    cache_circle_stimuli : bool
+        If True, the circle stimuli are taken from ``circle_stims`` instead of
+        being created in every trial.
+    circle_stims : dict
+        One pre-built circle stimulus per color in ``circle_colors``.
+    draw_flip_times : list
+        Duration of draw() + flip() in seconds for every circle presentation
+        of the current block.
+    frame_locked : bool
+        If True, stimulus durations are counted in frames instead of waited
+        in seconds.
+    frame_rate : float
+        The refresh rate of the screen measured at startup (frames per second).
+    trial_length_frames : int
+        The length of the trial (stimulus presentation) in frames.
+    trial_break_frames : int
+        The length of the break between stimuli presentations in frames.
+    dropped_frames : int
+        Number of dropped frames in the current block.
+    scheduler : DeadlineScheduler
+        Plans the fixation and circle onsets of a block from its start. With
+        frame-locked stimuli the flips pace the trials and the scheduler only
+        measures the drift of the trial onsets.
+    onset_error : float
+        How late the last trial started against its deadline in seconds: the
+        first flip of the fixation cross if frame-locked, else the circle onset.
+    trial_dropped_frames : int
+        Number of dropped frames in the last trial.
 
     Visual stimuli and text that will be presented during the experiment have to be
     defined in the constructor directly.
@@ -68,11 +111,38 @@ class ScreenController():
         # Used for saving fingertapping data into file
         self.participant_ID = parameter.participant_ID
         self.fingertapping_file_name = parameter.fingertapping_file_name
+        self.fingertapping_store = fingertapping_store.FingertappingStore(parameter.fingertapping_store_directory)
+
+        self.cache_circle_stimuli = parameter.cache_circle_stimuli
+        self.draw_flip_times = []
+        self.frame_locked = parameter.frame_locked
+        self.dropped_frames = 0
+        self.scheduler = scheduler.DeadlineScheduler('visual block')
+        self.onset_error = float('nan')
+        self.trial_dropped_frames = 0
 
         # set window
         self.win = visual.Window([800, 680], units='height', fullscr=False)
         self.globalClock = core.Clock()
 
+        # keyboard for the fingertapping task
+        self.keyboard = keyboard.Keyboard()
+        self.tapping_duration = 30
+
+        # Measure the refresh rate and convert the trial durations into frames
+        if self.frame_locked:
+            self.frame_rate = self.win.getActualFrameRate(nIdentical=20, nMaxFrames=200, nWarmUpFrames=20)
+            if self.frame_rate is None:
+                log.info('Unable to measure the refresh rate. Stimulus durations are not frame-locked.')
+                self.frame_locked = False
+            else:
+                # an interval longer than one frame + 4 ms counts as dropped frame
+                self.win.refreshThreshold = 1.0 / self.frame_rate + 0.004
+                self.trial_length_frames = int(round(self.trial_length * self.frame_rate))
+                self.trial_break_frames = int(round(self.trial_break * self.frame_rate))
+                logging.exp('Refresh rate: %.3f Hz, trial length: %i frames, trial break: %i frames'
+                            % (self.frame_rate, self.trial_length_frames, self.trial_break_frames))
+
         #------------------------
         # Visual stimuli and text
         #------------------------
@@ -113,6 +183,185 @@ class ScreenController():
                 lineColor = 'cyan'
             )
 
+        # Build one circle per color beforehand and draw it once into the back
+        # buffer, such that vertices and shaders are set up before the first trial
+        self.circle_stims = {}
+        for col in self.circle_colors:
+            self.circle_stims[col] = visual.Circle(self.win,
+                    radius = 0.07,
+                    fillColor = col,
+                    lineColor = col
+                )
+            self.circle_stims[col].draw()
+        self.win.clearBuffer()
+
+    def get_circle(self, col):
+        """
+        Returns the circle stimulus for the given color.
+
+        Parameters
+        ----------
+        col : str
+            The color of the circle, one of ``circle_colors``.
+        """
+        if self.cache_circle_stimuli:
+            return self.circle_stims[col]
+
+        return visual.Circle(self.win,
+                radius = 0.07,
+                fillColor = col,
+                lineColor = col
+            )
+
+    def present_frames(self, stim, n_frames, trigger):
+        """
+        Show a stimulus for a fixed number of frames. The trigger is set with
+        the first flip and reset with the second one.
+
+        Parameters
+        ----------
+        stim : visual stimulus (object of psychoPy library)
+            The stimulus to draw on every frame.
+        n_frames : int
+            Number of frames (flips) the stimulus is shown.
+        trigger : int
+            The trigger code that marks the stimulus onset.
+
+        Returns
+        -------
+        float
+            Duration of the first draw() + flip() in seconds.
+        """
+        self.win.callOnFlip(classicbelt.p.setData, trigger)
+        start_draw = time.perf_counter()
+        stim.draw()
+        self.win.flip()
+        first_draw_flip = time.perf_counter() - start_draw
+
+        self.win.callOnFlip(classicbelt.p.setData, 0)
+        for frame in range(1, n_frames):
+            stim.draw()
+            self.win.flip()
+
+        # reset the trigger if the stimulus lasted only one frame
+        if n_frames < 2:
+            classicbelt.p.setData(0)
+
+        return first_draw_flip
+
+    def present_trial(self, fixation_trigger, col, circle_trigger, trial_label):
+        """
+        Show the fixation cross for the trial break and afterwards the circle
+        for the trial length.
+
+        Parameters
+        ----------
+        fixation_trigger : int
+            Trigger code for the fixation cross.
+        col : str
+            The color of the circle, one of ``circle_colors``.
+        circle_trigger : int
+            Trigger code for the circle.
+        trial_label : str
+            Used to identify the trial in the session log.
+        """
+        self.circle_stim = self.get_circle(col)
+
+        if self.frame_locked:
+            # Frame intervals are recorded during the whole block. The first
+            # interval of a trial is the last frame of the previous circle.
+            if not self.win.recordFrameIntervals:
+                self.win.recordFrameIntervals = True
+            self.win.frameIntervals = []
+
+            # Dropped frames delay the first flip of the trial against the planned one
+            self.win.callOnFlip(self.scheduler.record)
+            self.scheduler.advance((self.trial_break_frames + self.trial_length_frames) / self.frame_rate)
+
+            self.present_frames(self.fixation, self.trial_break_frames, fixation_trigger)
+            self.draw_flip_times.append(
+                self.present_frames(self.circle_stim, self.trial_length_frames, circle_trigger))
+            self.onset_error = self.scheduler.drift()
+
+            self.log_frame_statistics(trial_label)
+            return
+
+        # fixation cross
+        self.fixation.draw()
+        self.win.flip()
+
+        # TRIGGER
+        classicbelt.p.setData(fixation_trigger)
+        core.wait(0.01)
+        classicbelt.p.setData(0)
+
+        # always pause some miliseconds after the stimulus is shown
+        self.scheduler.wait(self.trial_break)
+        self.onset_error = self.scheduler.drift()
+
+        # Display the coloured circle on the screen
+        start_draw = time.perf_counter()
+        self.circle_stim.draw()
+        self.win.flip()
+        self.draw_flip_times.append(time.perf_counter() - start_draw)
+
+        # Set the trigger
+        classicbelt.p.setData(circle_trigger)
+        core.wait(0.01)
+        classicbelt.p.setData(0)
+
+        # Show the circle for 800 ms
+        self.scheduler.wait(self.trial_length)
+
+    def start_block_timing(self):
+        """
+        Start the timing of a block. With frame-locked stimuli the block starts
+        with its first flip.
+        """
+        self.scheduler.start_block()
+        if self.frame_locked:
+            self.win.callOnFlip(self.scheduler.start_block)
+
+    def log_frame_statistics(self, trial_label):
+        """
+        Write the frame intervals and dropped frames of the last trial to the
+        session log.
+
+        Parameters
+        ----------
+        trial_label : str
+            Used to identify the trial in the session log.
+        """
+        intervals = np.array(self.win.frameIntervals)
+        if len(intervals) == 0:
+            self.trial_dropped_frames = 0
+            return
+        dropped = int(np.sum(intervals > self.win.refreshThreshold))
+        self.trial_dropped_frames = dropped
+        self.dropped_frames += dropped
+        logging.exp('%s: %i frame intervals, mean %.3f ms, sd %.3f ms, max %.3f ms, dropped frames %i'
+                    % (trial_label, len(intervals), intervals.mean() * 1000, intervals.std() * 1000,
+                       intervals.max() * 1000, dropped))
+
+    def report_block_timing(self):
+        """
+        Print the draw() + flip() times, dropped frames and drift of the last
+        block and reset them for the next one.
+        """
+        log.info(*self.scheduler.report_args())
+        logging.exp(self.scheduler.report())
+        if self.draw_flip_times:
+            times_ms = np.array(self.draw_flip_times) * 1000
+            log.info('Draw + flip time per trial (ms): mean %.3f, median %.3f, max %.3f (cached stimuli: %s)',
+                     times_ms.mean(), np.median(times_ms), times_ms.max(), self.cache_circle_stimuli)
+        if self.frame_locked:
+            self.win.recordFrameIntervals = False
+            log.info('Dropped frames in this block: %i', self.dropped_frames)
+            logging.exp('Dropped frames in block: %i' % self.dropped_frames)
+            logging.flush()
+        self.draw_flip_times = []
+        self.dropped_frames = 0
+
     def show_instructions(self):
         """
         Set up the screen for the experiment and show instructions.
@@ -154,43 +403,54 @@ class ScreenController():
         fingertapping_sequence = visual.TextStim(self.win,
                   text= ' - '.join([str(number) for number in new_sequence]), height=0.05)
         fingertapping_sequence.draw()
+
+        # The key times are taken by the keyboard relative to the sequence onset
+        self.keyboard.clearEvents()
+        self.win.callOnFlip(self.keyboard.clock.reset)
         self.win.flip()
+        tapping_end = time.perf_counter() + self.tapping_duration
+
+        # Collect the key presses in a background thread
+        key_listener = fingertapping_functions.TappingKeyListener(self.keyboard, ['1','2','3','4'])
+        key_listener.start()
 
         # Set trigger for showing the sequence
         classicbelt.p.setData(17)
         core.wait(0.01)
         classicbelt.p.setData(0)
 
-        tapping_Clock = core.Clock() #creates a clock time
-        start_tapping_time = tapping_Clock.getTime() # gets time at this point
-
-        file = open(self.fingertapping_file_name, 'a', newline ='')
-        with file:
-            header = ['KeysPressed', 'StartTappingTime', 'FingertappingRound', 'CorrectSequence', 'ParticipantID']
-            writer = csv.DictWriter(file, fieldnames = header)
-
-            if ft_round == 1:
-                print("first tapping round")
-                writer.writeheader()
+        # The key presses are buffered and written to the file in a background thread
+        tapping_writer = fingertapping_functions.FingertappingWriter(self.fingertapping_file_name, ft_round,
+                                                                     ''.join([str(j) for j in new_sequence]),
+                                                                     self.participant_ID,
+                                                                     store=self.fingertapping_store)
+        tapping_writer.start()
 
+        try:
             while True:
 
-                if (tapping_Clock.getTime() - start_tapping_time) > 30:
+                # Blocks until the next key press, None after 30 seconds
+                keyPressed = key_listener.get_key(tapping_end)
+                if keyPressed is None:
                     "Stop fingertapping"
                     break
 
-                keyPressed = event.getKeys(keyList=['1','2','3','4'], modifiers=False, timeStamped=tapping_Clock)
+                classicbelt.p.setData(18)
+                core.wait(0.01)
+                classicbelt.p.setData(0)
+                tapping_writer.add(int(keyPressed[0]), keyPressed[1])
+
+            key_listener.stop()
+
+            # Keys that were pressed in time but not yet delivered
+            while not key_listener.key_queue.empty():
+                keyPressed = key_listener.key_queue.get()
+                if keyPressed[1] <= self.tapping_duration:
+                    tapping_writer.add(int(keyPressed[0]), keyPressed[1])
+        finally:
+            tapping_writer.close()
 
-                if keyPressed:
-                    print(keyPressed)
-                    classicbelt.p.setData(18)
-                    core.wait(0.01)
-                    classicbelt.p.setData(0)
-                    writer.writerow({header[0] : keyPressed[0][0],
-                                     header[1] : keyPressed[0][1],
-                                     header[2] : ft_round,
-                                     header[3] : ''.join([str(j) for j in new_sequence]),
-                                     header[4] : self.participant_ID})
+        log.info('Fingertapping round %i: %i keys pressed', ft_round, len(tapping_writer))
 
         self.fingertapping_end.draw()
         self.win.flip()
@@ -238,149 +498,88 @@ class ScreenController():
         classicbelt.p.setData(0)
 
 
-    def visual_oddball(self, trials, oddball_ratio):
+    def visual_oddball(self, sequence):
         """
         Function that runs the trials of the visual oddball stimulus.
 
         Parameters
         ----------
-        trials : int
-            The number of trials in this condition (visual).
-        oddball_ratio : float
-            The frequency of displaying the oddball stimulus.
+        sequence : ndarray
+            The stimulus order of this block, one entry per trial
+            (1 = oddball, 0 = standard), see trial_sequences.py.
         """
 
-        print('-----------------------------------')
-        print('           VISUAL ODDBALL          ')
-        print('-----------------------------------\n')
+        log.info('-----------------------------------')
+        log.info('           VISUAL ODDBALL          ')
+        log.info('-----------------------------------\n')
 
-        total_trial_standard = np.zeros(int(trials*(1-oddball_ratio)))
-        total_trial_oddball = np.ones(int(trials*(oddball_ratio)))
-        total_trial = np.concatenate([total_trial_oddball, total_trial_standard])
-
-        for i in range(trials):
-            # fixation cross
-            self.fixation.draw()
-            self.win.flip()
-
-            # TRIGGER
-            classicbelt.p.setData(self.visual_trigger[2])
-            core.wait(0.01)
-            classicbelt.p.setData(0)
-
-            # always pause some miliseconds after the stimulus is shown
-            time.sleep(self.trial_break)
+        color_oddball = self.circle_colors[1]
+        color_standard = self.circle_colors[0]
 
+        # The trials are timed from the start of the block
+        self.start_block_timing()
+        for i, stimulus in enumerate(sequence):
             # Change the color of the circle. This will be 30% pink=oddball and
             # 70% cyan for the baseline stimulus
-            # create random number between 0 and 1
-            np.random.shuffle(total_trial)
-            random_number = total_trial[0]
-            color_oddball = self.circle_colors[1]
-            color_standard = self.circle_colors[0]
-
-            if random_number==1:
+            if stimulus == trial_sequences.ODDBALL:
                 col = color_oddball
             else:
                 col = color_standard
 
-            self.circle_stim = visual.Circle(self.win,
-                    radius = 0.07,
-                    fillColor = col,
-                    lineColor = col
-                )
-
-            total_trial = np.delete(total_trial, 0)
-
-
             if col == "cyan":
                 trigger_visual = self.visual_trigger[1]
             else:
                 trigger_visual = self.visual_trigger[0]
 
-            # Display the coloured circle on the screen
-            self.circle_stim.draw()
-            self.win.flip()
-
-            # Set the trigger
-            classicbelt.p.setData(trigger_visual)
-            core.wait(0.01)
-            classicbelt.p.setData(0)
+            # Fixation cross for the break, then the circle for 800 ms
+            self.present_trial(self.visual_trigger[2], col, trigger_visual,
+                               'visual_oddball trial %i' % (i+1))
+            telemetry.publish('visual_oddball', i+1,
+                              'oddball' if stimulus == trial_sequences.ODDBALL else 'standard',
+                              self.onset_error, self.trial_dropped_frames)
 
-            # Show the circle for 800 ms
-            core.wait(self.trial_length)
+        self.report_block_timing()
 
-    def visual_swapped_oddball(self, trials, oddball_ratio):
+    def visual_swapped_oddball(self, sequence):
         """
         Function that runs the trials of the visual oddball stimulus but with
         swapped color for the odd/standard stimulus.
 
         Parameters
         ----------
-        trials : int
-            The number of trials in this condition (visual).
-        oddball_ratio : float
-            The frequency of displaying the oddball stimulus.
+        sequence : ndarray
+            The stimulus order of this block, one entry per trial
+            (1 = oddball, 0 = standard), see trial_sequences.py.
         """
 
-        print('-------------------------------------------')
-        print('           VISUAL ODDBALL SWAPPED         ')
-        print('-------------------------------------------\n')
-
-        total_trial_standard = np.zeros(int(trials*(1-oddball_ratio)))
-        total_trial_oddball = np.ones(int(trials*(oddball_ratio)))
-        total_trial = np.concatenate([total_trial_oddball, total_trial_standard])
-
-        for i in range(trials):
-            # fixation cross
-            self.fixation.draw()
-            self.win.flip()
-
-            # TRIGGER
-            classicbelt.p.setData(self.visual_swapped_trigger[2])
-            core.wait(0.01)
-            classicbelt.p.setData(0)
+        log.info('-------------------------------------------')
+        log.info('           VISUAL ODDBALL SWAPPED         ')
+        log.info('-------------------------------------------\n')
 
-            # always pause some miliseconds after the stimulus is shown
-            time.sleep(self.trial_break)
+        color_oddball = self.circle_colors[0]
+        color_standard = self.circle_colors[1]
 
+        # The trials are timed from the start of the block
+        self.start_block_timing()
+        for i, stimulus in enumerate(sequence):
             # Change the color of the circle. This will be 30% oddball and
             # 70% standard for the baseline stimulus. The color depends on how
             # you specify it in the parameter file.
-
-            # Create random number between 0 and 1 to select either oddball or
-            # standard.
-            np.random.shuffle(total_trial)
-            random_number = total_trial[0]
-            color_oddball = self.circle_colors[0]
-            color_standard = self.circle_colors[1]
-
-            if random_number==1:
+            if stimulus == trial_sequences.ODDBALL:
                 col = color_oddball
             else:
                 col = color_standard
 
-            self.circle_stim = visual.Circle(self.win,
-                    radius = 0.07,
-                    fillColor = col,
-                    lineColor = col
-                )
-
-            total_trial = np.delete(total_trial, 0)
-
             if col == "cyan":
                 trigger_visual = self.visual_swapped_trigger[1]
             else:
                 trigger_visual = self.visual_swapped_trigger[0]
 
-            # Display the coloured circle on the screen
-            self.circle_stim.draw()
-            self.win.flip()
-
-            # Set the trigger
-            classicbelt.p.setData(trigger_visual)
-            core.wait(0.01)
-            classicbelt.p.setData(0)
+            # Fixation cross for the break, then the circle for 800 ms
+            self.present_trial(self.visual_swapped_trigger[2], col, trigger_visual,
+                               'visual_swapped_oddball trial %i' % (i+1))
+            telemetry.publish('visual_swapped_oddball', i+1,
+                              'oddball' if stimulus == trial_sequences.ODDBALL else 'standard',
+                              self.onset_error, self.trial_dropped_frames)
 
-            # Show the circle for 800 ms
-            core.wait(self.trial_length)
+        self.report_block_timing()